@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   async_engine.py
+@Description    :   基于asyncio和aiohttp的下载引擎：检索、重定向/jumpServlet解析和图片下载都是协程，
+                    一个线程中的事件循环即可让多篇论文的上千个页面请求同时排队，
+                    实际发出的请求与线程下载共用ratelimit.py中每个主机的令牌桶和AIMD并发上限
+
+同步调用方式与downloader相同：
+    from async_engine import download_main_info, download_jpg, paper_download
+'''
+import asyncio
+import functools
+import inspect
+import json
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager
+
+# aiohttp is optional, the threaded engine in downloader.py works without it
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+    aiohttp = None
+
+import downloader
+import metrics
+from downloader import (
+    PdfAssembler, PageProbe, PageEnd, fetch_state, head_exists, page_retry_kind, page_url, jpg_writer,
+    remove_pages_after, collect_results, store_result_page, make_paper_filename, memory_usage, format_retries,
+    PAGE_OK, PAGE_NOT_FOUND, PAGE_OUTCOMES,
+    DEFAULT_WORKERS, MAX_WORKERS, DEFAULT_PAPER_WORKERS, DEFAULT_MEMORY_LIMIT,
+)
+from http_client import HEADERS, DEFAULT_TIMEOUT, POOL_MAXSIZE
+from ratelimit import RequestSlot, get_limiter, OUTCOME_OK, OUTCOME_ERROR, OUTCOME_NEUTRAL
+from resolver_cache import get_resolver_cache
+from result_cache import get_result_cache
+from retry import RetryBudget, RetryState, RETRY_CONNECTION, RETRY_NOT_FOUND
+
+# 协程只占用内存，同时下载的论文篇数可以比线程版本多，真正的并发由主机限流控制
+MAX_ASYNC_PAPER_WORKERS = 16
+
+# 需要退避重试的网络错误
+CONNECTION_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) \
+    if AIOHTTP_AVAILABLE else ()
+
+# 与requests.Response字段相同，可以直接交给downloader.fetch_state分类
+AsyncResponse = namedtuple('AsyncResponse', ['status_code', 'headers', 'content'])
+
+
+def _wake(loop, waiter):
+    """在其他线程释放名额后唤醒等待的协程；事件循环已经结束时忽略"""
+    def set_result():
+        if not waiter.done():
+            waiter.set_result(None)
+    try:
+        loop.call_soon_threadsafe(set_result)
+    except RuntimeError:
+        pass
+
+
+class AsyncHostLimiter:
+    """在事件循环中使用ratelimit中按主机共享的AdaptiveLimiter
+        与线程下载、GUI检索以及其他AsyncEngine共用同一个令牌桶、并发上限和AIMD调整，等待时不阻塞事件循环
+    """
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    async def acquire(self):
+        """等待并发空位和令牌
+            :return: 请求开始时间
+        """
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        while True:
+            waiter = loop.create_future()
+            if self.limiter.try_enter(functools.partial(_wake, loop, waiter)):
+                break
+            await waiter
+        try:
+            while True:
+                delay = self.limiter.bucket.try_acquire()
+                if not delay:
+                    break
+                await asyncio.sleep(delay)
+        except BaseException:
+            self.limiter.release(time.monotonic(), OUTCOME_NEUTRAL)
+            raise
+        now = time.monotonic()
+        with self.limiter.cond:
+            self.limiter.throttled_seconds += now - started
+        return now
+
+    @asynccontextmanager
+    async def request(self):
+        """async with limiter.request() as slot: ...; slot.outcome = OUTCOME_SHORT"""
+        slot = RequestSlot()
+        started = await self.acquire()
+        try:
+            yield slot
+        except asyncio.CancelledError:
+            # 其他页面失败或用户取消，不是网站的问题
+            slot.outcome = OUTCOME_NEUTRAL
+            raise
+        except BaseException:
+            slot.outcome = OUTCOME_ERROR
+            raise
+        finally:
+            self.limiter.release(started, slot.outcome)
+
+
+class AsyncPdfAssembler:
+    """在事件循环中使用PdfAssembler：压缩中的图片用asyncio.wrap_future等待，
+    打开文档、插入页面、增量保存和保存都在线程池中进行（仍通过PDF_LOCK与其他线程串行），PyMuPDF不阻塞事件循环
+    """
+    def __init__(self, assembler):
+        self.assembler = assembler
+        self.lock = asyncio.Lock()  # 同一篇论文的文档操作逐个进行
+        self.busy = None  # 线程池中正在进行的文档操作
+
+    @classmethod
+    async def open(cls, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return cls(await loop.run_in_executor(None, functools.partial(PdfAssembler, *args, **kwargs)))
+
+    async def run(self, func, *args):
+        """在线程池中执行文档操作；协程被取消时操作仍会完成，close()等它结束后才关闭文档"""
+        # 线程池中写入PDF的用时同样计入当前论文
+        self.busy = asyncio.get_running_loop().run_in_executor(None, metrics.propagate(func), *args)
+        return await asyncio.shield(self.busy)
+
+    async def add_page(self, i, content):
+        self.assembler.submit(i, content)
+        await self.insert_ready()
+
+    async def insert_ready(self, wait=False):
+        """与PdfAssembler.insert_ready相同，但等待压缩和写入文档时不阻塞事件循环"""
+        async with self.lock:
+            while True:
+                image = self.assembler.next_image(wait)
+                if image is not None:
+                    await asyncio.wrap_future(image)
+                elif not self.assembler.has_ready_page():
+                    return
+                await self.run(self.assembler.insert_done)
+
+    async def save(self):
+        await self.insert_ready(wait=True)
+        async with self.lock:
+            await self.run(self.assembler.save)
+
+    async def close(self):
+        if self.busy is not None:
+            await asyncio.wait([self.busy])
+        await self.run(self.assembler.close)
+
+
+async def run_all(coros):
+    """并发运行所有协程，任何一个抛出异常时取消其余的协程"""
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def wait_retry(end, i, delay):
+    """与PageEnd.wait_retry相同，在协程中等待delay秒后重试第i页"""
+    deadline = time.monotonic() + delay
+    try:
+        await asyncio.wait_for(end.found.wait(), delay)
+    except asyncio.TimeoutError:
+        pass
+    if not end.after_end(i):
+        await asyncio.sleep(max(0, deadline - time.monotonic()))
+
+
+def status_outcome(response):
+    """普通请求的结果：5xx降低并发"""
+    return OUTCOME_ERROR if response.status_code >= 500 else OUTCOME_OK
+
+
+def page_outcome(response):
+    """图片请求的结果：截断降低并发，404不参与调整"""
+    return PAGE_OUTCOMES[fetch_state(response)]
+
+
+class AsyncEngine:
+    """协程下载引擎，一个实例对应一次事件循环：
+        engine = AsyncEngine(workers=4)
+        engine.run(engine.download_papers, papers)    # 同步调用，阻塞到完成
+        engine.cancel()                               # 可以在其他线程中调用
+        :param workers: 单篇论文同时在途的页面请求数
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT, headers=HEADERS):
+        if not AIOHTTP_AVAILABLE:
+            raise ImportError("协程下载引擎需要aiohttp，请运行: pip install aiohttp")
+        self.workers = max(1, min(workers, MAX_WORKERS))
+        self.timeout = timeout
+        self.headers = headers
+        self.session = None
+        self.loop = None
+        self.task = None
+        self.cancelled = False
+
+    def run(self, func, *args, **kwargs):
+        """在新的事件循环中运行协程方法 func(*args, **kwargs)，返回其结果"""
+        return asyncio.run(self._main(func, *args, **kwargs))
+
+    async def _main(self, func, *args, **kwargs):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        if self.cancelled:
+            raise asyncio.CancelledError()
+        connector = aiohttp.TCPConnector(limit_per_host=POOL_MAXSIZE)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+        async with aiohttp.ClientSession(headers=self.headers, connector=connector, timeout=timeout) as session:
+            self.session = session
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.session = None
+
+    def cancel(self):
+        """取消正在运行的全部请求，run()抛出asyncio.CancelledError；可以在其他线程中调用"""
+        self.cancelled = True
+        if self.loop is not None and self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+    def limiter(self, url):
+        return AsyncHostLimiter(get_limiter(url))
+
+    async def request_once(self, url, stage, method='GET', outcome=status_outcome):
+        """经过主机限流发出一个请求，不跟随重定向，也不重试
+            :param outcome: outcome(响应)给出调整并发数的请求结果，默认5xx降低并发
+            :return: AsyncResponse
+        """
+        start = time.perf_counter()
+        async with self.limiter(url).request() as slot:
+            metrics.record(metrics.STAGE_LIMITER, time.perf_counter() - start)
+            with metrics.timed(stage) as sample:
+                async with self.session.request(method, url, allow_redirects=False) as response:
+                    content = await response.read()
+                sample['bytes'] = len(content)
+            result = AsyncResponse(response.status, response.headers, content)
+            slot.outcome = outcome(result)
+        return result
+
+    async def request(self, url, stage, method='GET', outcome=status_outcome):
+        """同request_once，连接错误按retry.POLICIES的策略退避重试"""
+        retry = RetryState()
+        while True:
+            try:
+                return await self.request_once(url, stage, method, outcome)
+            except CONNECTION_ERRORS:
+                await asyncio.sleep(retry.next_delay(RETRY_CONNECTION))
+
+    # 检索
+
+    async def fetch_result_page(self, info_url, page):
+        """:return: (论文列表, 总记录数)"""
+        cached = get_result_cache().get(info_url, page)
+        if cached is not None:
+            return cached
+        response = await self.request(info_url + str(page), metrics.STAGE_SEARCH)
+        return store_result_page(info_url, page, response.content)
+
+    async def search(self, info_url, pages):
+        """并发抓取pages中的检索结果页
+            :return: (论文列表, 总记录数, 总页数)
+        """
+        print("正在抓取第{}页的info".format(','.join(str(page) for page in pages)))
+        results = await run_all(self.fetch_result_page(info_url, page) for page in pages)
+        return collect_results(pages, results)
+
+    # 解析阅读全文链接
+
+    async def resolve_viewer(self, url):
+        """三次重定向得到阅读器的查询参数，再由jumpServlet得到图片地址前缀
+            :return: (图片地址前缀, 查询参数)
+        """
+        for error in ("无法获取重定向地址，可能是论文未公开或链接失效", "第二次重定向失败", "第三次重定向失败"):
+            response = await self.request(url, metrics.STAGE_REDIRECT)
+            if 'Location' not in response.headers:
+                raise Exception(error)
+            url = response.headers['Location']
+        url_bix = url.split('?')[1]
+        response = await self.request(downloader.READ_URL + "jumpServlet?page=1&" + url_bix, metrics.STAGE_JUMP)
+        urls = json.loads(response.content.decode())
+        return urls['list'][0]['src'].split('_')[0], url_bix
+
+    async def page_exists(self, image_base, i):
+        fig_url = page_url(image_base, i)
+        response = await self.request(fig_url, metrics.STAGE_PROBE, method='HEAD')
+        exists = head_exists(response.status_code, response.headers.get('Content-Type', ''))
+        if exists is None:
+            # 不支持HEAD时退回GET
+            return fetch_state(await self.request(fig_url, metrics.STAGE_PROBE, outcome=page_outcome)) != PAGE_NOT_FOUND
+        return exists
+
+    async def probe_page_count(self, image_base):
+        """与downloader.probe_page_count相同，用PageProbe探测总页数"""
+        probe = PageProbe()
+        while not probe.done:
+            probe.report(await self.page_exists(image_base, probe.page))
+        return probe.page_count
+
+    async def locate_pages(self, url):
+        """获取图片地址前缀并探测总页数，优先使用解析缓存，探测页数的同时校验缓存
+            :return: (图片地址前缀, 总页数)
+        """
+        cache = get_resolver_cache()
+        cached = cache.get(url)
+        page_count = 0
+        if cached is not None:
+            print("使用缓存的图片地址")
+            image_base = cached[0]
+            page_count = await self.probe_page_count(image_base)
+            if page_count == 0:
+                cache.invalidate(url)
+        if page_count == 0:
+            print("开始获取图片地址")
+            image_base, token = await self.resolve_viewer(url)
+            cache.put(url, image_base, token)
+            print("已经获取到图片地址")
+            page_count = await self.probe_page_count(image_base)
+        if page_count == 0:
+            raise Exception("论文没有可下载的页面")
+        print("论文共{}页".format(page_count))
+        return image_base, page_count
+
+    # 下载页面
+
+    async def fetch_page(self, fig_url, budget=None, end=None, i=None):
+        """下载单页图片，重试策略与downloader.fetch_page_with_retry相同
+            :param end: 论文的PageEnd（found为asyncio.Event），用法与fetch_page_with_retry相同
+            :return: (PAGE_OK, 图片内容) 或 (PAGE_NOT_FOUND, None)
+        """
+        retry = RetryState(budget)
+        try:
+            while True:
+                if end is not None and end.after_end(i):
+                    return PAGE_NOT_FOUND, None
+                if end is not None and end.held(i):
+                    await wait_retry(end, i, retry.policies[RETRY_NOT_FOUND].base_delay)
+                    continue
+                try:
+                    response = await self.request_once(fig_url, metrics.STAGE_PAGE, outcome=page_outcome)
+                except CONNECTION_ERRORS:
+                    kind = RETRY_CONNECTION
+                else:
+                    state = fetch_state(response)
+                    if state == PAGE_OK:
+                        return state, response.content
+                    kind = page_retry_kind(retry, state)
+                    if kind is None:
+                        return PAGE_NOT_FOUND, None
+                    if kind == RETRY_NOT_FOUND and end is not None:
+                        end.miss(i)
+                        if end.after_end(i) or end.held(i):
+                            continue
+                if end is None:
+                    await asyncio.sleep(retry.next_delay(kind))
+                else:
+                    await wait_retry(end, i, retry.next_delay(kind))
+        finally:
+            if end is not None:
+                end.resolve(i)
+
+    async def download_pages(self, image_base, save_page, page_count, on_page=None, budget=None):
+        """为每一页创建一个协程，同时在途的请求不超过workers个
+            页面按完成顺序交给save_page(页码, 内容)，save_page也可以是协程函数
+            论文在哪里结束与downloader.download_pages相同，见PageEnd
+            :return: 总页数
+        """
+        semaphore = asyncio.Semaphore(self.workers)
+        end = PageEnd(image_base, page_count, found=asyncio.Event())
+        done = 0
+        total = page_count
+
+        async def one(i):
+            nonlocal done
+            async with semaphore:
+                if end.after_end(i):
+                    return
+                state, content = await self.fetch_page(page_url(image_base, i), budget, end, i)
+            if not end.accept(i, state):
+                return
+            saved = save_page(i, content)
+            if inspect.isawaitable(saved):
+                await saved
+            done += 1
+            if on_page is not None:
+                on_page(done, total)
+
+        await run_all(one(i) for i in range(1, page_count + 1))
+        next_page = page_count + 1
+        # 只请求一次，不等待404重试，连接错误仍按策略重试
+        response = await self.request(page_url(image_base, next_page), metrics.STAGE_PAGE, outcome=page_outcome)
+        if not end.confirm(next_page, fetch_state(response)):
+            # 与线程引擎相同，之后逐页下载，由重试后仍然404的页面决定结尾
+            total = 0
+            while end.end is None:
+                await run_all(one(i) for i in range(next_page, next_page + self.workers))
+                next_page += self.workers
+        return end.end - 1
+
+    async def download_jpg(self, url, jpg_dir, on_page=None, budget=None):
+        """与downloader.download_jpg相同，把论文的所有页面保存到jpg_dir"""
+        image_base, page_count = await self.locate_pages(url)
+        page_count = await self.download_pages(image_base, jpg_writer(jpg_dir, page_count), page_count, on_page=on_page,
+                                               budget=budget)
+        remove_pages_after(jpg_dir, page_count)
+        return page_count
+
+    async def download_paper(self, paper, on_page=None, memory_limit=DEFAULT_MEMORY_LIMIT, image_preset=None):
+        """下载单篇论文，图片直接写入PDF
+            写PDF经AsyncPdfAssembler在线程池中进行，按页码顺序插入并通过PDF_LOCK与其他线程串行
+            :return: 统计信息 {'pages', 'rss_mb', 'peak_rss_mb', 'retries'}
+        """
+        paper_filename = make_paper_filename(paper)
+        budget = RetryBudget()
+        with metrics.paper_scope(paper_filename) as paper_metrics:
+            image_base, page_count = await self.locate_pages(paper['link'])
+            writer = await AsyncPdfAssembler.open(paper_filename, memory_limit=memory_limit, image_preset=image_preset)
+            assembler = writer.assembler
+            try:
+                await self.download_pages(image_base, writer.add_page, page_count, on_page=on_page, budget=budget)
+                await writer.save()
+            finally:
+                await writer.close()
+            paper_metrics.pages = assembler.next_index - 1
+        return {'pages': assembler.next_index - 1, 'rss_mb': memory_usage(), 'peak_rss_mb': assembler.peak_rss,
+                'retries': budget.snapshot()}
+
+    async def download_papers(self, papers, paper_workers=DEFAULT_PAPER_WORKERS, on_page=None, on_done=None,
+                              memory_limit=DEFAULT_MEMORY_LIMIT, image_preset=None):
+        """同时下载多篇论文，单篇失败不影响其他论文
+            :param on_page: 回调 on_page(论文, 已完成页数, 总页数)
+            :param on_done: 每篇论文结束后回调 on_done(论文, 统计信息, 异常)，成功时异常为None
+        """
+        semaphore = asyncio.Semaphore(max(1, min(paper_workers, MAX_ASYNC_PAPER_WORKERS)))
+
+        async def one(paper):
+            async with semaphore:
+                page_callback = None if on_page is None else (lambda done, total: on_page(paper, done, total))
+                try:
+                    stats = await self.download_paper(paper, on_page=page_callback, memory_limit=memory_limit,
+                                                      image_preset=image_preset)
+                except Exception as e:
+                    if on_done is not None:
+                        on_done(paper, None, e)
+                else:
+                    if on_done is not None:
+                        on_done(paper, stats, None)
+
+        await run_all(one(paper) for paper in papers)
+
+
+def download_main_info(info_url: str, pages: list):
+    """downloader.download_main_info的协程版本，所有页面并发抓取"""
+    engine = AsyncEngine()
+    return engine.run(engine.search, info_url, pages)
+
+
+def download_jpg(url: str, jpg_dir: str, on_page=None, workers=DEFAULT_WORKERS, budget=None):
+    """downloader.download_jpg的协程版本"""
+    engine = AsyncEngine(workers=workers)
+    return engine.run(engine.download_jpg, url, jpg_dir, on_page=on_page, budget=budget)
+
+
+def download_paper(paper, workers=DEFAULT_WORKERS, on_page=None, memory_limit=DEFAULT_MEMORY_LIMIT, image_preset=None):
+    """下载单篇论文，图片直接写入PDF"""
+    engine = AsyncEngine(workers=workers)
+    return engine.run(engine.download_paper, paper, on_page=on_page, memory_limit=memory_limit,
+                      image_preset=image_preset)
+
+
+def paper_download(papers, workers=DEFAULT_WORKERS, paper_workers=DEFAULT_PAPER_WORKERS, on_page=None, on_done=None,
+                   memory_limit=DEFAULT_MEMORY_LIMIT, image_preset=None):
+    """在一个事件循环中下载全部论文，参数与AsyncEngine.download_papers相同"""
+    if on_done is None:
+        def on_done(paper, stats, error):
+            if error is not None:
+                print(error)
+            else:
+                retry_text = "，重试 " + format_retries(stats['retries']) if stats['retries'] else ""
+                print("论文{}下载完成，共{}页{}".format(paper['filename'], stats['pages'], retry_text))
+    engine = AsyncEngine(workers=workers)
+    engine.run(engine.download_papers, papers, paper_workers=paper_workers, on_page=on_page, on_done=on_done,
+               memory_limit=memory_limit, image_preset=image_preset)
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   batch_cli.py
+@Description    :   无交互的批量命令行：检索参数、页码范围、任务文件、并发数，可输出JSON格式的进度，适合在服务器或cron中运行
+
+调用方式：
+    python downloader.py --major 计算机 --pages 1-2
+    python batch_cli.py --title 深度学习 --degree 博士 --pages 1-3,5 --paper-workers 2
+    python batch_cli.py --jobs jobs.json --progress json > progress.jsonl
+    python batch_cli.py --author 张三 --pages all --list-only
+
+任务文件为JSON（对象列表，或 {"jobs": [...]}）或带表头的CSV，每个任务的字段：
+    content, choose_key, xuewei, px, pages
+字段可以使用网站的参数值（topic、1）或中文名称（主题、博士），未填写的字段使用命令行参数
+'''
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from downloader import (
+    build_info_url, parse_pages, fetch_result_page, harvest_results, download_paper, pipeline_download,
+    make_paper_filename, verify_name, format_retries, print_run_summary,
+    CHOOSE_KEY_CODES, XUEWEI_CODES, PX_CODES, DEFAULT_WORKERS, MAX_WORKERS, DEFAULT_PAPER_WORKERS, MAX_PAPER_WORKERS,
+    DEFAULT_SEARCH_WORKERS, MODE_STREAM, MODE_DISK, MODE_PIPELINE, MODE_ASYNC,
+)
+from async_engine import paper_download as async_paper_download, AIOHTTP_AVAILABLE, MAX_ASYNC_PAPER_WORKERS
+from image_processing import PRESETS, PRESET_ORIGINAL
+import metrics
+from results_parser import total_pages_for
+
+PAGES_ALL = 'all'
+# 按字段检索的快捷参数：--major 计算机 相当于 --choose-key subject --content 计算机
+FIELD_OPTIONS = (('topic', 'topic'), ('title', 'title'), ('keyword', 'keyword'), ('author', 'author'),
+                 ('department', 'department'), ('major', 'subject'), ('subject', 'subject'),
+                 ('teacher', 'teacher'), ('year', 'year'))
+DEGREE_ALIASES = {'all': '0', 'phd': '1', 'doctor': '1', 'master': '2'}
+SORT_ALIASES = {'title': '1', 'year': '2'}
+JOB_FIELDS = ('content', 'choose_key', 'xuewei', 'px', 'pages')
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+
+
+def normalize_code(value, codes, aliases=None, name=''):
+    """把中文名称或别名转换为网站的参数值，已经是参数值时原样返回"""
+    value = str(value).strip()
+    valid = set(codes.values())
+    if value in valid:
+        return value
+    if value in codes:
+        return codes[value]
+    if aliases and value.lower() in aliases:
+        return aliases[value.lower()]
+    raise ValueError("{}的取值无效: {}，可选: {}".format(name, value, '、'.join(list(codes) + sorted(valid))))
+
+
+class Job:
+    """一个检索任务
+        :param pages: 页码列表，或 PAGES_ALL 表示全部页面
+    """
+    def __init__(self, content, choose_key='topic', xuewei='0', px='1', pages=None):
+        content = (content or '').strip()
+        if not content:
+            raise ValueError("检索词不能为空")
+        self.content = content
+        self.choose_key = normalize_code(choose_key, CHOOSE_KEY_CODES, name='检索方式')
+        self.xuewei = normalize_code(xuewei, XUEWEI_CODES, DEGREE_ALIASES, name='学位类型')
+        self.px = normalize_code(px, PX_CODES, SORT_ALIASES, name='排序方式')
+        pages = pages or '1'
+        self.pages = PAGES_ALL if str(pages).strip().lower() == PAGES_ALL else parse_pages(str(pages))
+        self.info_url = build_info_url(self.content, self.choose_key, self.xuewei, self.px)
+
+    def describe(self):
+        return {'content': self.content, 'choose_key': self.choose_key, 'xuewei': self.xuewei, 'px': self.px,
+                'pages': self.pages}
+
+
+def load_jobs(path, defaults):
+    """读取JSON或CSV任务文件，缺少的字段使用defaults"""
+    with open(path, encoding='utf-8-sig') as f:
+        if os.path.splitext(path)[1].lower() == '.csv':
+            rows = list(csv.DictReader(f))
+        else:
+            rows = json.load(f)
+            if isinstance(rows, dict):
+                rows = rows.get('jobs', [])
+            if not isinstance(rows, list):
+                raise ValueError("任务文件{}应为任务列表或 {{\"jobs\": [...]}}".format(path))
+    jobs = []
+    for number, row in enumerate(rows, 1):
+        if not isinstance(row, dict):
+            raise ValueError("任务文件{}第{}个任务应为对象（字段 {}），实际为: {}".format(
+                path, number, ', '.join(JOB_FIELDS), json.dumps(row, ensure_ascii=False)))
+        fields = dict(defaults)
+        fields.update({key: value for key, value in row.items() if key in JOB_FIELDS and value not in (None, '')})
+        try:
+            jobs.append(Job(**fields))
+        except ValueError as e:
+            raise ValueError("任务文件{}第{}个任务: {}".format(path, number, e))
+    return jobs
+
+
+class ProgressReporter:
+    """输出进度：text为便于阅读的文字，json为每行一个JSON对象，多个线程同时调用时不会交错"""
+    TEXT_FORMATS = {
+        'job': "检索: {content}（{choose_key}，页码 {pages}）",
+        'job_error': "✗ 检索失败: {content}（{choose_key}，页码 {pages}） - {error}",
+        'search_page': "已抓取第{page}页，{papers}篇，共{total_pages}页",
+        'paper_skip': "论文已存在: {file}",
+        'paper_start': "正在下载: {file}",
+        'paper_done': "✓ 完成: {file}（{pages}页，用时{seconds}秒{retries}）",
+        'paper_error': "✗ 错误: {file} - {error}",
+        'paper': "{year}  {filename}  {author}  {mentor}",
+        'summary': "共{papers}篇：完成{done}篇，已存在{skipped}篇，失败{failed}篇，检索失败{failed_jobs}个任务，用时{seconds}秒",
+    }
+
+    def __init__(self, fmt='text', stream=None):
+        self.fmt = fmt
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        if self.fmt == 'json':
+            line = json.dumps(dict(event=event, time=round(time.time(), 3), **fields), ensure_ascii=False)
+        else:
+            template = self.TEXT_FORMATS.get(event)
+            if template is None:
+                return
+            if event == 'paper_done':
+                fields = dict(fields, retries="，重试 " + format_retries(fields['retries']) if fields['retries'] else "")
+            line = template.format(**fields)
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+
+def search_job(job, reporter, search_workers=DEFAULT_SEARCH_WORKERS, max_pages=None):
+    """抓取一个任务的所有页面，返回按页码排列的论文列表"""
+    reporter.emit('job', **job.describe())
+    pages = {}
+    if job.pages == PAGES_ALL:
+        for page, papers, total_pages in harvest_results(job.info_url, workers=search_workers, max_pages=max_pages):
+            pages[page] = papers
+            reporter.emit('search_page', page=page, papers=len(papers), total_pages=total_pages)
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, search_workers)) as pool:
+            results = pool.map(lambda page: fetch_result_page(job.info_url, page), job.pages)
+            for page, (papers, total_count) in zip(job.pages, results):
+                pages[page] = papers
+                reporter.emit('search_page', page=page, papers=len(papers), total_pages=total_pages_for(total_count))
+    return [paper for page in sorted(pages) for paper in pages[page]]
+
+
+def download_all(papers, reporter, workers=DEFAULT_WORKERS, mode=MODE_STREAM, resume=False,
+                 paper_workers=DEFAULT_PAPER_WORKERS, image_preset=None):
+    """下载论文并报告进度
+        :return: (完成篇数, 已存在篇数, 失败篇数)
+    """
+    counts = {'done': 0, 'skipped': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+    started = {}
+
+    def count(key):
+        with counts_lock:
+            counts[key] += 1
+
+    todo = []
+    for paper in papers:
+        paper_filename = make_paper_filename(paper)
+        if verify_name(paper_filename):
+            reporter.emit('paper_skip', file=paper_filename, link=paper['link'])
+            count('skipped')
+        else:
+            todo.append(paper)
+
+    def on_page(paper, done, total):
+        started.setdefault(id(paper), time.time())
+        reporter.emit('page', file=make_paper_filename(paper), done=done, total=total)
+
+    def on_finished(paper, stats, error):
+        paper_filename = make_paper_filename(paper)
+        seconds = round(time.time() - started.get(id(paper), time.time()), 1)
+        if error is not None:
+            reporter.emit('paper_error', file=paper_filename, link=paper['link'], error=str(error))
+            count('failed')
+        else:
+            reporter.emit('paper_done', file=paper_filename, link=paper['link'], pages=stats['pages'],
+                          seconds=seconds, retries=stats['retries'])
+            count('done')
+
+    if mode == MODE_PIPELINE:
+        pipeline_download(todo, workers=workers, resume=resume, paper_workers=paper_workers,
+                          on_page=on_page, on_merged=on_finished, image_preset=image_preset)
+    elif mode == MODE_ASYNC and not resume:
+        def on_async_page(paper, done, total):
+            # 协程引擎中论文排队等待，收到第一页时才算开始
+            if id(paper) not in started:
+                reporter.emit('paper_start', file=make_paper_filename(paper), link=paper['link'])
+            on_page(paper, done, total)
+
+        async_paper_download(todo, workers=workers, paper_workers=paper_workers, on_page=on_async_page,
+                             on_done=on_finished, image_preset=image_preset)
+    else:
+        def download_one(paper):
+            started[id(paper)] = time.time()
+            reporter.emit('paper_start', file=make_paper_filename(paper), link=paper['link'])
+            try:
+                stats = download_paper(paper, workers=workers, mode=mode, resume=resume,
+                                       on_page=lambda done, total: on_page(paper, done, total),
+                                       image_preset=image_preset)
+            except Exception as e:
+                on_finished(paper, None, e)
+            else:
+                on_finished(paper, stats, None)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(paper_workers, MAX_PAPER_WORKERS))) as pool:
+            list(pool.map(download_one, todo))
+    return counts['done'], counts['skipped'], counts['failed']
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="SJTU学位论文批量下载（无交互）",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    search = parser.add_argument_group('检索参数')
+    search.add_argument('-c', '--content', help='检索词，与--choose-key一起使用')
+    search.add_argument('--choose-key', default='topic', help='检索方式: topic/title/keyword/author/department/subject/teacher/year 或中文名称')
+    for option, choose_key in FIELD_OPTIONS:
+        search.add_argument('--' + option, metavar='检索词', help='按{}检索'.format(choose_key))
+    search.add_argument('--degree', '--xuewei', dest='xuewei', default='0', help='学位类型: 0/all/硕士及博士，1/phd/博士，2/master/硕士')
+    search.add_argument('--sort', '--px', dest='px', default='1', help='排序方式: 1/title/按题名字顺序排序，2/year/按学位年度倒排序')
+    search.add_argument('-p', '--pages', default='1', help="页码范围，例如 1、1-3、1-3,5，all为全部页面（每页20篇）")
+    search.add_argument('--max-pages', type=int, help='--pages all 时最多抓取的页数')
+    search.add_argument('--jobs', metavar='FILE', help='JSON或CSV任务文件，每行一个检索，未填写的字段使用以上参数')
+
+    run = parser.add_argument_group('下载参数')
+    run.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='单篇论文同时请求的页数（最多{}）'.format(MAX_WORKERS))
+    run.add_argument('--paper-workers', type=int, default=DEFAULT_PAPER_WORKERS,
+                     help='同时下载的论文篇数（最多{}，async模式最多{}）'.format(MAX_PAPER_WORKERS, MAX_ASYNC_PAPER_WORKERS))
+    run.add_argument('--search-workers', type=int, default=DEFAULT_SEARCH_WORKERS, help='同时抓取的检索结果页数')
+    run.add_argument('--mode', choices=(MODE_STREAM, MODE_PIPELINE, MODE_DISK, MODE_ASYNC), default=MODE_STREAM,
+                     help='stream直接写入PDF，pipeline下载与合并并行，disk经过临时文件夹，async使用协程引擎（需要aiohttp）')
+    run.add_argument('--resume', action='store_true', help='断点续传')
+    run.add_argument('--image-preset', choices=tuple(PRESETS), default=PRESET_ORIGINAL,
+                     help='图片写入PDF前的压缩方式：original保持原图，high、balanced、small体积依次减小')
+    run.add_argument('--list-only', action='store_true', help='只检索并输出论文信息，不下载')
+    run.add_argument('--progress', choices=('text', 'json'), default='text',
+                     help='进度输出格式，json时每行一个JSON对象，其余日志输出到stderr')
+    run.add_argument('--metrics-dir', default=metrics.METRICS_DIR,
+                     help='每篇论文的分阶段统计(JSON行)和Prometheus快照的输出文件夹')
+    run.add_argument('--no-metrics', action='store_true', help='不写入统计文件，只在结束时打印汇总表')
+    return parser
+
+
+def jobs_from_args(args, parser):
+    """根据命令行参数生成任务列表"""
+    fields = [(option, choose_key) for option, choose_key in FIELD_OPTIONS if getattr(args, option)]
+    if len(fields) > 1 or (fields and args.content):
+        parser.error("网站每次只能按一个字段检索，请只使用一个检索参数")
+    defaults = {'choose_key': args.choose_key, 'xuewei': args.xuewei, 'px': args.px, 'pages': args.pages}
+    try:
+        if args.jobs:
+            if fields or args.content:
+                parser.error("--jobs 不能与检索词同时使用")
+            jobs = load_jobs(args.jobs, defaults)
+            if not jobs:
+                parser.error("任务文件{}中没有任务".format(args.jobs))
+            return jobs
+        if fields:
+            option, defaults['choose_key'] = fields[0]
+            return [Job(getattr(args, option), **defaults)]
+        if args.content:
+            return [Job(args.content, **defaults)]
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    parser.error("请指定检索词（例如 --major 计算机）或任务文件（--jobs）")
+
+
+def batch_main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    jobs = jobs_from_args(args, parser)
+    workers = max(1, min(args.workers, MAX_WORKERS))
+    paper_workers = max(1, min(args.paper_workers, MAX_PAPER_WORKERS))
+    if args.mode == MODE_ASYNC:
+        if not AIOHTTP_AVAILABLE:
+            parser.error("--mode async 需要aiohttp，请运行: pip install aiohttp")
+        paper_workers = max(1, min(args.paper_workers, MAX_ASYNC_PAPER_WORKERS))
+    metrics.configure(directory=args.metrics_dir, enabled=not args.no_metrics)
+
+    progress_stream = sys.stdout
+    if args.progress == 'json':
+        # stdout只输出进度：复制一份stdout给进度输出，再把文件描述符1指向stderr，合并子进程的日志也不会混入
+        sys.stdout.flush()
+        progress_stream = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    reporter = ProgressReporter(args.progress, progress_stream)
+    start = time.time()
+
+    papers, seen = [], set()
+    failed_jobs = 0
+    for job in jobs:
+        try:
+            job_papers = search_job(job, reporter, search_workers=args.search_workers, max_pages=args.max_pages)
+        except Exception as e:
+            reporter.emit('job_error', error=str(e), **job.describe())
+            failed_jobs += 1
+            continue
+        # 多个任务检索到同一篇论文时只下载一次
+        for paper in job_papers:
+            if paper['link'] not in seen:
+                seen.add(paper['link'])
+                papers.append(paper)
+
+    if args.list_only:
+        for paper in papers:
+            reporter.emit('paper', **paper)
+        return EXIT_FAILED if failed_jobs else EXIT_OK
+
+    done, skipped, failed = download_all(papers, reporter, workers=workers, mode=args.mode, resume=args.resume,
+                                         paper_workers=paper_workers,
+                                         image_preset=args.image_preset)
+    print_run_summary()
+    reporter.emit('summary', papers=len(papers), done=done, skipped=skipped, failed=failed, failed_jobs=failed_jobs,
+                  seconds=round(time.time() - start, 1), stages=metrics.get_registry().snapshot())
+    return EXIT_FAILED if failed or failed_jobs else EXIT_OK
+
+
+if __name__ == '__main__':
+    # 流水线模式在子进程中合并PDF，打包后需要
+    multiprocessing.freeze_support()
+    sys.exit(batch_main())
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   bench_download.py
+@Description    :   离线吞吐量基准：在本地模拟网站上测量检索、下载图片、合并PDF和直接写入PDF的速度，
+                    以及各图片压缩方式的PDF大小和每页CPU时间，结果写入JSON便于比较版本
+
+运行方式：
+    python benchmarks/bench_download.py --papers 3 --pages 30 --latency 0.02 --output before.json
+    python benchmarks/bench_download.py --short-rate 0.05 --not-found-rate 0.02 --compare before.json
+    python benchmarks/bench_download.py --image-presets balanced,small
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import downloader
+import metrics
+import results_parser
+from downloader import build_info_url, download_main_info, download_jpg, merge_pdf, download_paper, MODE_STREAM
+from http_client import get_session
+from image_processing import PRESETS, PRESET_ORIGINAL
+from ratelimit import configure_limiter, HOST_DEFAULTS
+from retry import RetryBudget
+from mock_server import MockThesisSite, MockServer, make_jpeg
+
+# 比较两次结果时关注的指标，True表示越大越好
+METRICS = (
+    ('search', 'pages_per_sec', True),
+    ('search', 'parse_ms_per_page', False),
+    ('download_jpg', 'pages_per_sec', True),
+    ('download_jpg', 'papers_per_hour', True),
+    ('merge_pdf', 'ms_per_page', False),
+    ('stream', 'pages_per_sec', True),
+    ('stream', 'papers_per_hour', True),
+) + tuple(metric for preset in PRESETS if preset != PRESET_ORIGINAL
+          for metric in (('image_' + preset, 'bytes_per_page', False), ('image_' + preset, 'cpu_ms_per_page', False)))
+
+
+def point_at(server, limiter):
+    """让下载器访问模拟网站，并按网站的限速参数或不限速配置两个主机"""
+    downloader.READ_URL = server.read_url
+    downloader.SEARCH_URL = server.base_url + 'sub.asp'
+    results_parser.BASE_URL = server.base_url
+    site = server.site
+    if limiter == 'site':
+        configure_limiter(site.search_host, **HOST_DEFAULTS['thesis.lib.sjtu.edu.cn'])
+        configure_limiter(site.read_host, **HOST_DEFAULTS['thesis.lib.sjtu.edu.cn:8443'])
+    else:
+        for host in (site.search_host, site.read_host):
+            configure_limiter(host, rate=1000, burst=1000, concurrency=16, max_concurrency=16)
+
+
+def rates(pages, papers, seconds):
+    return {'papers': papers, 'pages': pages, 'seconds': round(seconds, 3),
+            'pages_per_sec': round(pages / seconds, 2) if seconds else None,
+            'papers_per_hour': round(papers * 3600 / seconds, 1) if seconds else None}
+
+
+def bench_search(pages, repeat):
+    info_url = build_info_url('基准测试')
+    start = time.perf_counter()
+    papers, total_count, _ = download_main_info(info_url, list(range(1, pages + 1)))
+    seconds = time.perf_counter() - start
+
+    # 单独测量解析时间，不含网络
+    content = get_session().get(info_url + '1').content
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        results_parser.parse_results(content)
+        best = min(best, time.perf_counter() - t)
+    return {'pages': pages, 'papers': len(papers), 'total_count': total_count, 'seconds': round(seconds, 3),
+            'pages_per_sec': round(pages / seconds, 2), 'parse_ms_per_page': round(best * 1000, 3)}
+
+
+def paper_link(server, k):
+    return server.base_url + 'fulltext.asp?id={}&type=1'.format(k)
+
+
+def bench_download_jpg(server, papers, workers):
+    """download_jpg：下载到临时文件夹，返回统计和文件夹列表（留给merge_pdf）"""
+    budget = RetryBudget(max_failures=None)
+    jpg_dirs = []
+    pages = 0
+    start = time.perf_counter()
+    for k in range(1, papers + 1):
+        jpg_dir = os.path.relpath(tempfile.mkdtemp(prefix='bench_', dir='.'))
+        pages += download_jpg(paper_link(server, k), jpg_dir, workers=workers, budget=budget)
+        jpg_dirs.append(jpg_dir)
+    result = rates(pages, papers, time.perf_counter() - start)
+    result['retries'] = budget.snapshot()
+    return result, jpg_dirs
+
+
+def bench_merge(jpg_dirs, image_preset=None, name='bench_merge'):
+    """merge_pdf合并文件夹中的图片（合并后文件夹被删除）
+        指定image_preset时同时统计图片压缩在进程池中的CPU时间
+    """
+    pages = sum(len(os.listdir(d)) for d in jpg_dirs)
+    pdf_bytes = 0
+    image_before = metrics.get_registry().snapshot().get(metrics.STAGE_IMAGE, {'seconds': 0})
+    start = time.perf_counter()
+    for n, jpg_dir in enumerate(jpg_dirs):
+        assembler = merge_pdf('{}_{}.pdf'.format(name, n), jpg_dir, image_preset=image_preset)
+        pdf_bytes += os.path.getsize(assembler.filename)
+    seconds = time.perf_counter() - start
+    result = {'papers': len(jpg_dirs), 'pages': pages, 'seconds': round(seconds, 3),
+              'ms_per_page': round(seconds * 1000 / pages, 3) if pages else None, 'pdf_bytes': pdf_bytes,
+              'bytes_per_page': pdf_bytes // pages if pages else None}
+    if image_preset is not None:
+        image_after = metrics.get_registry().snapshot().get(metrics.STAGE_IMAGE, {'seconds': 0})
+        cpu_seconds = image_after['seconds'] - image_before['seconds']
+        result['cpu_ms_per_page'] = round(cpu_seconds * 1000 / pages, 3) if pages else None
+    return result
+
+
+def bench_images(pages, presets):
+    """每种压缩方式各合并一份相同的图片，比较PDF大小和每页CPU时间
+    模拟网站每页的图片相同，PDF中只保存一份，所以另外生成各不相同的页面，一半按彩色扫描
+    """
+    source = os.path.relpath(tempfile.mkdtemp(prefix='bench_pages_', dir='.'))
+    for i in range(1, pages + 1):
+        with open(os.path.join(source, '{:05d}.jpg'.format(i)), 'wb') as f:
+            f.write(make_jpeg(seed=i, color=i % 2 == 0))
+    results = {}
+    for preset in [PRESET_ORIGINAL] + presets:
+        jpg_dir = shutil.copytree(source, '{}_{}'.format(source, preset))
+        results['image_' + preset] = bench_merge([jpg_dir], image_preset=preset, name='bench_' + preset)
+    return results
+
+
+def bench_stream(server, papers, workers, first_id):
+    """download_paper 直接写入PDF，包括重定向、探测页数、下载和写PDF"""
+    pages = 0
+    retries = defaultdict(int)
+    start = time.perf_counter()
+    for k in range(first_id, first_id + papers):
+        paper = {'filename': '基准{}'.format(k), 'author': 'a', 'mentor': 'm', 'year': '2020',
+                 'link': paper_link(server, k)}
+        stats = download_paper(paper, workers=workers, mode=MODE_STREAM)
+        pages += stats['pages']
+        for kind, n in stats['retries'].items():
+            retries[kind] += n
+    result = rates(pages, papers, time.perf_counter() - start)
+    result['retries'] = dict(retries)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(old, new):
+    print("{:<28}{:>12}{:>12}{:>10}".format('指标', '对照', '本次', '变化'))
+    for section, metric, higher_is_better in METRICS:
+        a = old.get(section, {}).get(metric)
+        b = new.get(section, {}).get(metric)
+        if not a or b is None:
+            continue
+        change = (b - a) / a * 100
+        better = change >= 0 if higher_is_better else change <= 0
+        print("{:<28}{:>12}{:>12}{:>+9.1f}%{}".format(section + '.' + metric, a, b, change, '' if better else ' ↓'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--papers', type=int, default=3, help='每项下载测试的论文篇数')
+    parser.add_argument('--pages', type=int, default=30, help='每篇论文的页数')
+    parser.add_argument('--search-pages', type=int, default=5, help='检索测试抓取的结果页数')
+    parser.add_argument('--workers', type=int, default=downloader.DEFAULT_WORKERS, help='单篇论文同时请求的页数')
+    parser.add_argument('--latency', type=float, default=0.02, help='模拟网站每个请求的延迟（秒）')
+    parser.add_argument('--throttle', type=float, default=0, help='模拟网站每秒最多处理的请求数，0为不限速')
+    parser.add_argument('--short-rate', type=float, default=0.0, help='图片被截断的概率')
+    parser.add_argument('--not-found-rate', type=float, default=0.0, help='存在的页面偶发404的概率')
+    parser.add_argument('--head-not-found', action='store_true', help='探测页数的HEAD请求也偶发404（默认只对GET）')
+    parser.add_argument('--limiter', choices=('site', 'off'), default='site',
+                        help='site使用与真实网站相同的客户端限速参数，off不限速以测量代码本身')
+    parser.add_argument('--repeat', type=int, default=50, help='解析测试重复次数')
+    parser.add_argument('--image-presets', default=','.join(p for p in PRESETS if p != PRESET_ORIGINAL),
+                        help='测试的图片压缩方式，逗号分隔，留空不测试')
+    parser.add_argument('--image-pages', type=int, default=6, help='图片压缩测试生成的页数（生成每页约1秒）')
+    parser.add_argument('--output', default='bench_download.json', help='结果JSON文件')
+    parser.add_argument('--compare', metavar='FILE', help='与之前的结果JSON比较')
+    args = parser.parse_args()
+    presets = [p for p in args.image_presets.split(',') if p and p != PRESET_ORIGINAL]
+    for preset in presets:
+        if preset not in PRESETS:
+            parser.error("未知的图片压缩方式: {}".format(preset))
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    site = MockThesisSite(total_papers=max(args.search_pages * 20, args.papers * 2), pages_per_paper=args.pages,
+                          latency=args.latency, throttle=args.throttle, short_rate=args.short_rate,
+                          not_found_rate=args.not_found_rate, head_not_found=args.head_not_found)
+    server = MockServer(site).start()
+    point_at(server, args.limiter)
+
+    # 在临时目录中运行，papers、tmpjpgs、本地目录和缓存都不影响当前目录
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='bench_download_')
+    os.chdir(workdir)
+    try:
+        results = {'commit': git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': platform.python_version(), 'config': vars(args)}
+        results['search'] = bench_search(args.search_pages, args.repeat)
+        results['download_jpg'], jpg_dirs = bench_download_jpg(server, args.papers, args.workers)
+        results['merge_pdf'] = bench_merge(jpg_dirs)
+        if presets:
+            results.update(bench_images(args.image_pages, presets))
+        results['stream'] = bench_stream(server, args.papers, args.workers, first_id=args.papers + 1)
+        results['server_requests'] = dict(site.counts)
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    print()
+    print("{:<14}{:>8}{:>8}{:>10}{:>12}{:>14}".format('测试', '篇数', '页数', '用时(s)', '页/秒', '篇/小时'))
+    for name in ('search', 'download_jpg', 'stream'):
+        r = results[name]
+        print("{:<14}{:>8}{:>8}{:>10}{:>12}{:>14}".format(name, r.get('papers', ''), r['pages'], r['seconds'],
+                                                          r['pages_per_sec'], r.get('papers_per_hour') or ''))
+    print("解析检索结果页 {} ms/页，合并PDF {} ms/页".format(results['search']['parse_ms_per_page'],
+                                                         results['merge_pdf']['ms_per_page']))
+    if presets:
+        print()
+        print("{:<14}{:>14}{:>10}{:>14}{:>14}".format('图片压缩', 'PDF(KB/页)', '比原图', 'CPU(ms/页)', '合并(ms/页)'))
+        original = results['image_' + PRESET_ORIGINAL]['bytes_per_page']
+        for preset in [PRESET_ORIGINAL] + presets:
+            r = results['image_' + preset]
+            print("{:<14}{:>14.1f}{:>10}{:>14}{:>14}".format(preset, r['bytes_per_page'] / 1024,
+                                                           '{:.0%}'.format(r['bytes_per_page'] / original),
+                                                           r.get('cpu_ms_per_page', 0), r['ms_per_page']))
+    print("结果已写入", output)
+    if baseline is not None:
+        print()
+        compare(baseline, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   bench_paper_index.py
+@Description    :   已下载论文查询的微基准：对比原来每次查询都os.listdir和paper_index的内存索引
+
+运行方式：python benchmarks/bench_paper_index.py [--files 20000] [--lookups 1000]
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from paper_index import PaperIndex
+
+
+def legacy_verify_name(directory, paper_filename):
+    """原 verify_name 的查询方式，用作对照"""
+    return paper_filename in os.listdir(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=20000, help='papers文件夹中的论文数')
+    parser.add_argument('--lookups', type=int, default=1000, help='查询次数，一半已下载一半未下载')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_papers_')
+    try:
+        for i in range(args.files):
+            open(os.path.join(directory, '2020_论文{}_作者_导师.pdf'.format(i)), 'wb').close()
+        names = ['2020_论文{}_作者_导师.pdf'.format(i * 2) for i in range(args.lookups)]
+
+        start = time.perf_counter()
+        old = [legacy_verify_name(directory, name) for name in names]
+        old_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = PaperIndex(directory)
+        new = [index.contains(name) for name in names]
+        new_time = time.perf_counter() - start
+
+        assert old == new
+        print("{:<10}{:>10}{:>14}{:>14}{:>10}".format('论文数', '查询数', 'listdir(ms)', '索引(ms)', '加速'))
+        print("{:<10}{:>10}{:>14.1f}{:>14.1f}{:>9.0f}x".format(
+            args.files, args.lookups, old_time * 1000, new_time * 1000, old_time / new_time))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
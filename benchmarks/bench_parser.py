@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   bench_parser.py
+@Description    :   检索结果解析的微基准：对比原来的逐行绝对XPath解析和results_parser的单次遍历
+
+运行方式：python benchmarks/bench_parser.py [--repeat 200]
+'''
+import argparse
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+from lxml import etree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from results_parser import parse_results
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+FIELDS = ('filename', 'author', 'mentor', 'year', 'link')
+
+
+def legacy_parse(content):
+    """原 download_main_info 中的解析方式，用作对照"""
+    papers = []
+    total_count = 0
+    html = etree.HTML(content, etree.HTMLParser())
+    page_text = ''.join(html.xpath('//text()'))
+    match = re.search(r'，共\s*(\d+)\s*条记录', page_text)
+    if match:
+        total_count = int(match.group(1))
+    for i in range(2, 22):
+        info_dict = defaultdict(str)
+        try:
+            filename = html.xpath('/html/body/section/div/div[3]/div[2]/table/tr[{}]//td[2]/text()'.format(i))[0]
+            author = html.xpath('/html/body/section/div/div[3]/div[2]/table/tr[{}]/td[3]/div/text()'.format(i))[0]
+            mentor = html.xpath('/html/body/section/div/div[3]/div[2]/table/tr[{}]/td[6]/div/text()'.format(i))[0]
+            year = html.xpath('/html/body/section/div/div[3]/div[2]/table/tr[{}]/td[8]/div/text()'.format(i))[0]
+            link = "http://thesis.lib.sjtu.edu.cn/" + html.xpath('/html/body/section/div/div[3]/div[2]/table/tr[{}]/td[9]/div/a[2]/@href'.format(i))[0]
+            info_dict['filename'] = filename
+            info_dict['author'] = author
+            info_dict['mentor'] = mentor
+            info_dict['year'] = year
+            info_dict['link'] = link
+            papers.append(info_dict)
+        except Exception:
+            pass
+    return papers, total_count
+
+
+def timeit(func, content, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(content)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=200, help='每个样本重复次数，取最快一次')
+    args = parser.parse_args()
+
+    print("{:<24}{:>8}{:>14}{:>14}{:>10}".format('样本', '篇数', '原解析(ms)', '新解析(ms)', '加速'))
+    for name in sorted(os.listdir(FIXTURE_DIR)):
+        if not name.endswith('.html'):
+            continue
+        with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+            content = f.read()
+        old_papers, old_total = legacy_parse(content)
+        new_papers, new_total = parse_results(content)
+        # 两种解析的结果必须一致
+        assert old_total == new_total, (name, old_total, new_total)
+        assert [[p[k] for k in FIELDS] for p in old_papers] == [[p[k] for k in FIELDS] for p in new_papers], name
+        old_time = timeit(legacy_parse, content, args.repeat)
+        new_time = timeit(parse_results, content, args.repeat)
+        print("{:<24}{:>8}{:>14.3f}{:>14.3f}{:>9.1f}x".format(
+            name, len(new_papers), old_time * 1000, new_time * 1000, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   mock_server.py
+@Description    :   本地模拟的学位论文网站，用于离线基准测试
+
+模拟的接口：
+    检索主机  /sub.asp?content=..&page=N          检索结果页，结构与网站相同，每页20条
+              /fulltext.asp?id=K                   阅读全文链接，三次重定向中的第一次
+              /redirect2?id=K、/redirect3?id=K     第二、三次重定向，最后跳到阅读主机
+    阅读主机  /read/jumpServlet?page=1&id=K&..     返回图片地址的JSON
+              /read/img/K/doc_NNNNN.jpg            第N页图片，超出页数时返回网站的404页面
+
+可以注入延迟、限速（令牌桶，超出时排队等待）、截断的图片和偶发的404。
+
+单独运行：python benchmarks/mock_server.py --port 8000 --read-port 8443
+'''
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import defaultdict
+from html import escape
+from urllib.parse import urlsplit, parse_qs
+
+import pymupdf
+
+PAGE_SIZE = 20
+NOT_FOUND_PAGE = '<html><body><h1>HTTP状态 404 - 未找到</h1></body></html>'.encode('utf-8')
+SUBJECTS = ('计算机科学与技术', '控制科学与工程', '材料科学与工程', '船舶与海洋工程', '电子科学与技术')
+DEPARTMENTS = ('电子信息与电气工程学院', '机械与动力工程学院', '材料科学与工程学院', '船舶海洋与建筑工程学院')
+_IMG_RE = re.compile(r'^/read/img/(\d+)/doc_(\d{5})\.jpg$')
+
+
+def make_jpeg(width=1240, height=1754, quality=75, seed=0, color=False):
+    """生成一页扫描件大小的JPEG，加入噪点使大小接近真实页面
+        :param color: 按彩色扫描，纸张略微偏黄，内容仍是黑白文字
+    """
+    rng = random.Random(seed)
+    if color:
+        pix = pymupdf.Pixmap(pymupdf.csRGB, pymupdf.IRect(0, 0, width, height), False)
+        pix.set_rect(pix.irect, (240, 236, 226))
+    else:
+        pix = pymupdf.Pixmap(pymupdf.csGRAY, pymupdf.IRect(0, 0, width, height), False)
+        pix.clear_with(235)
+    # 模拟文字行
+    for y in range(120, height - 120, 36):
+        x = 100
+        while x < width - 100:
+            w = rng.randint(10, 28)
+            v = rng.randint(20, 90)
+            pix.set_rect(pymupdf.IRect(x, y, x + w, y + 18), (v, v, v + 6) if color else (v,))
+            x += w + rng.randint(4, 10)
+    return pix.tobytes('jpeg', jpg_quality=quality)
+
+
+class TokenBucket:
+    """服务器端限速，超出速率的请求排队等待，模拟网站过载时变慢"""
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + 1.0 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class MockThesisSite:
+    """模拟网站的数据和故障注入参数
+        :param total_papers: 检索结果的总篇数
+        :param pages_per_paper: 每篇论文的页数
+        :param latency: 每个请求的固定延迟（秒）
+        :param throttle: 每秒最多处理的请求数，0为不限速
+        :param short_rate: 图片被截断的概率
+        :param not_found_rate: 存在的页面偶发返回404的概率（默认只对GET）
+        :param head_not_found: HEAD也按not_found_rate偶发404，模拟探测页数时遇到的404
+    """
+    def __init__(self, total_papers=200, pages_per_paper=30, latency=0.0, throttle=0, short_rate=0.0,
+                 not_found_rate=0.0, seed=0, jpeg=None, head_not_found=False):
+        self.total_papers = total_papers
+        self.pages_per_paper = pages_per_paper
+        self.latency = latency
+        self.bucket = TokenBucket(throttle) if throttle else None
+        self.short_rate = short_rate
+        self.not_found_rate = not_found_rate
+        self.head_not_found = head_not_found
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.jpeg = jpeg if jpeg is not None else make_jpeg(seed=seed)
+        self.counts = defaultdict(int)
+        self.counts_lock = threading.Lock()
+        self.search_host = None
+        self.read_host = None
+
+    def count(self, kind):
+        with self.counts_lock:
+            self.counts[kind] += 1
+
+    def chance(self, rate):
+        if rate <= 0:
+            return False
+        with self.rng_lock:
+            return self.rng.random() < rate
+
+    def paper(self, k):
+        return {'filename': '模拟论文{:05d}基于深度学习的系统设计与实现'.format(k), 'author': '作者{}'.format(k),
+                'department': DEPARTMENTS[k % len(DEPARTMENTS)], 'subject': SUBJECTS[k % len(SUBJECTS)],
+                'mentor': '导师{}'.format(k % 50), 'degree': '博士' if k % 3 == 0 else '硕士',
+                'year': str(2005 + k % 20)}
+
+    def result_page(self, content, page):
+        """与网站结构相同的检索结果页：表格位于 /html/body/section/div/div[3]/div[2]/table"""
+        total_pages = (self.total_papers + PAGE_SIZE - 1) // PAGE_SIZE
+        first = (page - 1) * PAGE_SIZE + 1
+        rows = []
+        for k in range(first, min(first + PAGE_SIZE, self.total_papers + 1)):
+            p = self.paper(k)
+            rows.append('<tr><td><div>{k}</div></td><td>{filename}</td><td><div>{author}</div></td>'
+                        '<td><div>{department}</div></td><td><div>{subject}</div></td><td><div>{mentor}</div></td>'
+                        '<td><div>{degree}</div></td><td><div>{year}</div></td>'
+                        '<td><div><a href="detail.asp?id={k}">详细信息</a> <a href="fulltext.asp?id={k}&amp;type=1">阅读全文</a></div></td></tr>'
+                        .format(k=k, **{key: escape(value) for key, value in p.items()}))
+        return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>上海交通大学学位论文检索</title></head><body>'
+                '<header><div class="logo">上海交通大学学位论文</div></header>'
+                '<section><div class="container">'
+                '<div class="search"><form action="sub.asp"><input name="content" value="{content}"/></form></div>'
+                '<div class="tips"><p>提示：检索结果按相关度排序</p></div>'
+                '<div class="result"><div class="info">检索条件：{content}</div><div class="list"><table>'
+                '<tr class="head"><td><div>序号</div></td><td><div>题名</div></td><td><div>作者</div></td><td><div>院系</div></td>'
+                '<td><div>专业</div></td><td><div>导师</div></td><td><div>学位</div></td><td><div>年度</div></td><td><div>操作</div></td></tr>'
+                '{rows}</table></div>'
+                '<div class="pager">当前第{page}页，共 {total} 条记录，共{total_pages}页</div></div>'
+                '</div></section></body></html>').format(content=escape(content), rows=''.join(rows), page=page,
+                                                         total=self.total_papers, total_pages=total_pages).encode('utf-8')
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    site = None  # MockThesisSite，由MockServer设置
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, content_type, body, head=False, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def redirect(self, location, head=False):
+        self.send(302, 'text/html', b'', head, {'Location': location})
+
+    def route(self, head=False):
+        site = self.site
+        if site.bucket is not None:
+            site.bucket.wait()
+        if site.latency:
+            time.sleep(site.latency)
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        paper_id = query.get('id', ['0'])[0]
+
+        match = _IMG_RE.match(parts.path)
+        if match:
+            site.count('image_head' if head else 'image')
+            i = int(match.group(2))
+            # 偶发404默认只注入到GET，探测页数的HEAD保持准确，使各次测试的页数一致；head_not_found时HEAD也注入
+            if i > site.pages_per_paper or ((not head or site.head_not_found) and site.chance(site.not_found_rate)):
+                return self.send(404, 'text/html;charset=utf-8', NOT_FOUND_PAGE, head)
+            if not head and site.chance(site.short_rate):
+                site.count('short')
+                return self.send(200, 'image/jpeg', site.jpeg[:512], head)
+            return self.send(200, 'image/jpeg', site.jpeg, head)
+        if parts.path == '/sub.asp':
+            site.count('search')
+            page = int(query.get('page', ['1'])[0] or 1)
+            return self.send(200, 'text/html;charset=utf-8', site.result_page(query.get('content', [''])[0], page), head)
+        if parts.path == '/fulltext.asp':
+            site.count('redirect')
+            return self.redirect('http://{}/redirect2?id={}'.format(site.search_host, paper_id), head)
+        if parts.path == '/redirect2':
+            site.count('redirect')
+            return self.redirect('http://{}/redirect3?id={}'.format(site.search_host, paper_id), head)
+        if parts.path == '/redirect3':
+            site.count('redirect')
+            return self.redirect('http://{}/read/index.jsp?id={}&token=mock{}'.format(site.read_host, paper_id, paper_id), head)
+        if parts.path == '/read/jumpServlet':
+            site.count('jump')
+            body = json.dumps({'list': [{'src': 'img/{}/doc_00001.jpg'.format(paper_id)}]}).encode('utf-8')
+            return self.send(200, 'application/json', body, head)
+        self.send(404, 'text/html;charset=utf-8', NOT_FOUND_PAGE, head)
+
+    def do_GET(self):
+        self.route()
+
+    def do_HEAD(self):
+        self.route(head=True)
+
+
+class MockServer:
+    """同时运行检索主机和阅读主机（对应网站的80和8443端口）"""
+    def __init__(self, site, port=0, read_port=0, host='127.0.0.1'):
+        self.site = site
+        handler = type('MockHandler', (Handler,), {'site': site})
+        self.search_server = ThreadingHTTPServer((host, port), handler)
+        self.read_server = ThreadingHTTPServer((host, read_port), handler)
+        self.search_server.daemon_threads = self.read_server.daemon_threads = True
+        site.search_host = '{}:{}'.format(host, self.search_server.server_address[1])
+        site.read_host = '{}:{}'.format(host, self.read_server.server_address[1])
+        self.threads = []
+
+    @property
+    def base_url(self):
+        return 'http://{}/'.format(self.site.search_host)
+
+    @property
+    def read_url(self):
+        return 'http://{}/read/'.format(self.site.read_host)
+
+    def start(self):
+        for server in (self.search_server, self.read_server):
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in (self.search_server, self.read_server):
+            server.shutdown()
+            server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟的学位论文网站')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--read-port', type=int, default=8443)
+    parser.add_argument('--papers', type=int, default=200, help='检索结果总篇数')
+    parser.add_argument('--pages', type=int, default=30, help='每篇论文的页数')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的延迟（秒）')
+    parser.add_argument('--throttle', type=float, default=0, help='每秒最多处理的请求数，0为不限速')
+    parser.add_argument('--short-rate', type=float, default=0.0, help='图片被截断的概率')
+    parser.add_argument('--not-found-rate', type=float, default=0.0, help='存在的页面偶发404的概率')
+    parser.add_argument('--head-not-found', action='store_true', help='HEAD请求也偶发404（默认只对GET）')
+    args = parser.parse_args()
+    site = MockThesisSite(args.papers, args.pages, args.latency, args.throttle, args.short_rate, args.not_found_rate,
+                          head_not_found=args.head_not_found)
+    server = MockServer(site, args.port, args.read_port).start()
+    print('检索主机 {}sub.asp?content=test&page=1'.format(server.base_url))
+    print('阅读主机 {}'.format(server.read_url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   catalog.py
+@Description    :   本地论文元数据目录（SQLite）：完整抓取过的检索按网站返回的结果和顺序离线回答，
+                    另外支持按字段的离线检索和已下载论文的记录
+'''
+import json
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit, parse_qs
+
+CATALOG_PATH = "catalog.sqlite3"
+# 同一检索在这段时间内完整抓取过，就直接用本地目录回答
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+# trigram分词至少需要3个字符，更短的检索词用LIKE
+FTS_MIN_LENGTH = 3
+
+# 检索方式对应的字段
+CHOOSE_KEY_COLUMNS = {
+    'topic': 'filename', 'title': 'filename', 'keyword': 'filename', 'author': 'author',
+    'department': 'department', 'subject': 'subject', 'teacher': 'mentor', 'year': 'year',
+}
+DEGREE_FILTERS = {'1': '博士', '2': '硕士'}
+PAPER_FIELDS = ('filename', 'author', 'mentor', 'year', 'link', 'degree', 'department', 'subject')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS papers (
+    id INTEGER PRIMARY KEY,
+    link TEXT NOT NULL UNIQUE,
+    filename TEXT NOT NULL,
+    author TEXT NOT NULL DEFAULT '',
+    mentor TEXT NOT NULL DEFAULT '',
+    year TEXT NOT NULL DEFAULT '',
+    degree TEXT NOT NULL DEFAULT '',
+    department TEXT NOT NULL DEFAULT '',
+    subject TEXT NOT NULL DEFAULT '',
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_papers_author ON papers(author);
+CREATE INDEX IF NOT EXISTS idx_papers_mentor ON papers(mentor);
+CREATE INDEX IF NOT EXISTS idx_papers_year ON papers(year);
+CREATE INDEX IF NOT EXISTS idx_papers_department ON papers(department);
+CREATE INDEX IF NOT EXISTS idx_papers_filename ON papers(filename);
+
+CREATE TABLE IF NOT EXISTS queries (
+    query_key TEXT PRIMARY KEY,
+    total_count INTEGER NOT NULL,
+    fetched_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS query_results (
+    query_key TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    link TEXT NOT NULL,
+    PRIMARY KEY (query_key, rank)
+);
+
+-- 已下载的论文由paper_index按papers文件夹判断，旧版本记录下载的表不再使用
+DROP TABLE IF EXISTS downloads;
+'''
+
+FTS_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(
+    filename, author, mentor, department, subject,
+    content='papers', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS papers_ai AFTER INSERT ON papers BEGIN
+    INSERT INTO papers_fts(rowid, filename, author, mentor, department, subject)
+    VALUES (new.id, new.filename, new.author, new.mentor, new.department, new.subject);
+END;
+CREATE TRIGGER IF NOT EXISTS papers_ad AFTER DELETE ON papers BEGIN
+    INSERT INTO papers_fts(papers_fts, rowid, filename, author, mentor, department, subject)
+    VALUES ('delete', old.id, old.filename, old.author, old.mentor, old.department, old.subject);
+END;
+CREATE TRIGGER IF NOT EXISTS papers_au AFTER UPDATE ON papers BEGIN
+    INSERT INTO papers_fts(papers_fts, rowid, filename, author, mentor, department, subject)
+    VALUES ('delete', old.id, old.filename, old.author, old.mentor, old.department, old.subject);
+    INSERT INTO papers_fts(rowid, filename, author, mentor, department, subject)
+    VALUES (new.id, new.filename, new.author, new.mentor, new.department, new.subject);
+END;
+'''
+
+
+def query_params(info_url):
+    """从检索地址中取出 content、choose_key、xuewei、px"""
+    params = parse_qs(urlsplit(info_url).query, keep_blank_values=True)
+    return {key: params.get(key, [''])[0] for key in ('content', 'choose_key', 'xuewei', 'px')}
+
+
+def query_key(params):
+    """检索的唯一标识，不同排序方式的结果顺序不同，分别保存"""
+    return json.dumps([params['content'].strip(), params['choose_key'], params['xuewei'], params['px']],
+                      ensure_ascii=False)
+
+
+class Catalog:
+    """本地论文目录，所有线程共享一个连接，通过锁串行访问"""
+    def __init__(self, path=CATALOG_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+        try:
+            with self.conn:
+                self.conn.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite版本过旧，不支持fts5或trigram分词，退回LIKE检索
+            self.fts = False
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def upsert_papers(self, papers):
+        """保存检索得到的论文元数据，已存在的记录按链接更新"""
+        now = time.time()
+        rows = [tuple(paper.get(field, '') or '' for field in PAPER_FIELDS) + (now, now)
+                for paper in papers if paper.get('link')]
+        if not rows:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany('''
+                INSERT INTO papers (filename, author, mentor, year, link, degree, department, subject, first_seen, last_seen)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(link) DO UPDATE SET
+                    filename=excluded.filename, author=excluded.author, mentor=excluded.mentor,
+                    year=excluded.year,
+                    degree=CASE WHEN excluded.degree != '' THEN excluded.degree ELSE papers.degree END,
+                    department=CASE WHEN excluded.department != '' THEN excluded.department ELSE papers.department END,
+                    subject=CASE WHEN excluded.subject != '' THEN excluded.subject ELSE papers.subject END,
+                    last_seen=excluded.last_seen
+            ''', rows)
+
+    def record_query(self, info_url, total_count, links, fetched_at=None):
+        """记录一次完整抓取的检索：网站返回的论文链接及其顺序，之后可以原样离线回答
+            :param links: 按页码和页内顺序排列的论文链接
+            :param fetched_at: 最早的一页从网站抓取的时间，部分页面来自检索结果缓存时不能用当前时间，默认为当前时间
+        """
+        key = query_key(query_params(info_url))
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO queries (query_key, total_count, fetched_at) VALUES (?, ?, ?)',
+                              (key, total_count, time.time() if fetched_at is None else fetched_at))
+            self.conn.execute('DELETE FROM query_results WHERE query_key = ?', (key,))
+            self.conn.executemany('INSERT INTO query_results (query_key, rank, link) VALUES (?, ?, ?)',
+                                  [(key, rank, link) for rank, link in enumerate(links) if link])
+
+    def query_is_fresh(self, info_url, max_age=DEFAULT_MAX_AGE):
+        with self.lock:
+            row = self.conn.execute('SELECT fetched_at FROM queries WHERE query_key = ?',
+                                    (query_key(query_params(info_url)),)).fetchone()
+        return row is not None and time.time() - row[0] <= max_age
+
+    def search(self, content, choose_key='topic', xuewei='0', px='1', limit=None, offset=0):
+        """离线检索：在本地目录中按字段匹配，参数与sub.asp相同
+            只按题名、作者等字段匹配，主题和关键词检索的结果可能比网站少，不能代替search_url
+            :return: 论文列表，格式与download_main_info相同
+        """
+        column = CHOOSE_KEY_COLUMNS.get(choose_key, 'filename')
+        content = content.strip()
+        where, args = [], []
+        if column == 'year':
+            where.append('year = ?')
+            args.append(content)
+        elif self.fts and len(content) >= FTS_MIN_LENGTH:
+            where.append('id IN (SELECT rowid FROM papers_fts WHERE papers_fts MATCH ?)')
+            args.append('{} : "{}"'.format(column, content.replace('"', '""')))
+        else:
+            where.append('{} LIKE ?'.format(column))
+            args.append('%{}%'.format(content))
+        if xuewei in DEGREE_FILTERS:
+            where.append('degree LIKE ?')
+            args.append('%{}%'.format(DEGREE_FILTERS[xuewei]))
+        order = 'year DESC, filename' if px == '2' else 'filename'
+        sql = 'SELECT {} FROM papers WHERE {} ORDER BY {}'.format(', '.join(PAPER_FIELDS), ' AND '.join(where), order)
+        if limit is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            args += [limit, offset]
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+        return papers_from_rows(rows)
+
+    def search_url(self, info_url, max_age=DEFAULT_MAX_AGE):
+        """检索地址对应的本地结果：完整抓取时网站返回的论文，顺序不变；本地结果不够新时返回None"""
+        if not self.query_is_fresh(info_url, max_age):
+            return None
+        sql = 'SELECT {} FROM query_results JOIN papers USING (link) WHERE query_key = ? ORDER BY rank'.format(
+            ', '.join('papers.' + field for field in PAPER_FIELDS))
+        with self.lock:
+            rows = self.conn.execute(sql, (query_key(query_params(info_url)),)).fetchall()
+        return papers_from_rows(rows)
+
+
+def papers_from_rows(rows):
+    """查询结果转为论文列表，字段顺序为PAPER_FIELDS"""
+    papers = []
+    for row in rows:
+        paper = defaultdict(str)
+        paper.update(zip(PAPER_FIELDS, row))
+        papers.append(paper)
+    return papers
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog(path=None):
+    """进程内共享的本地目录，第一次调用时打开"""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = Catalog(path or CATALOG_PATH)
+        return _catalog
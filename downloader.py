@@ -15,16 +15,34 @@
 # here put the import lib
 from __future__ import print_function, unicode_literals
 import os
+import re
 import sys
 import time
 import random
 import json
 import shutil
-from collections import defaultdict
+import multiprocessing
+import sqlite3
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import wait as futures_wait
+from concurrent.futures.process import BrokenProcessPool
 from urllib.parse import quote
 import requests
-from lxml import etree
 import pymupdf
+import metrics
+from results_parser import parse_results, total_pages_for, PAGE_SIZE
+from catalog import get_catalog
+from result_cache import get_result_cache
+from resolver_cache import get_resolver_cache, format_resolver_stats
+from paper_index import get_paper_index, PAPERS_DIR
+from image_processing import get_preset, get_image_pool, process_image
+from http_client import HEADERS, get_session, format_pool_stats
+from ratelimit import get_limiter, OUTCOME_OK, OUTCOME_SHORT, OUTCOME_ERROR, OUTCOME_NEUTRAL
+from retry import RetryBudget, RetryState, call_with_retry, RETRY_SHORT, RETRY_NOT_FOUND, RETRY_CONNECTION
 
 # PyInquirer is only needed for CLI mode, make it optional for GUI packaging
 try:
@@ -34,15 +52,92 @@ except ImportError:
     PYINQUIRER_AVAILABLE = False
     style_from_dict = Token = prompt = None
 
+# psutil is only used to report memory usage, fall back to /proc or resource
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+    psutil = None
+
+READ_URL = "http://thesis.lib.sjtu.edu.cn:8443/read/"
+SEARCH_URL = "http://thesis.lib.sjtu.edu.cn/sub.asp"
+# 检索参数的中文名称与网站参数值的对应关系
+CHOOSE_KEY_CODES = {'主题':'topic', '题名':'title', '关键词':'keyword', '作者':'author', '院系':'department',
+                    '专业':'subject', '导师':'teacher', '年份':'year'}
+XUEWEI_CODES = {'硕士及博士':'0', '博士':'1', '硕士':'2'}
+PX_CODES = {'按题名字顺序排序':'1', '按学位年度倒排序':'2'}
+NOT_FOUND_TEXT = 'HTTP状态 404 - 未找到'
+NOT_FOUND_BYTES = NOT_FOUND_TEXT.encode('utf-8')
+JPG_MAGIC = b'\xff\xd8'
+MIN_JPG_SIZE = 2000
+
+# 单页图片请求的分类结果
+PAGE_OK = 'ok'
+PAGE_NOT_FOUND = 'not_found'
+PAGE_SHORT = 'short'
+# 需要退避重试的网络错误
+CONNECTION_ERRORS = (requests.ConnectionError, requests.Timeout)
+# 分类结果对应的限速器反馈，论文末尾的404是正常现象，不参与并发调整
+PAGE_OUTCOMES = {PAGE_OK: OUTCOME_OK, PAGE_SHORT: OUTCOME_SHORT, PAGE_NOT_FOUND: OUTCOME_NEUTRAL}
+
+# 单篇论文同时请求的页数，网站很慢，过高的并发曾导致网站崩溃
+DEFAULT_WORKERS = 4
+MAX_WORKERS = 8
+# 同时下载的论文篇数，总并发为 paper_workers * workers
+DEFAULT_PAPER_WORKERS = 1
+MAX_PAPER_WORKERS = 4
+# 并发抓取检索结果页的线程数
+DEFAULT_SEARCH_WORKERS = 4
+DEFAULT_PREFETCH_DEPTH = 1   # 预取当前页前后各几页检索结果
+# 论文保存方式：图片直接写入PDF，或经过tmpjpgs文件夹（便于调试）
+MODE_STREAM = 'stream'
+MODE_DISK = 'disk'
+# 批量下载时，下载和合并分两级流水线并行，合并在独立进程中进行
+MODE_PIPELINE = 'pipeline'
+# 协程下载引擎（async_engine.py，需要aiohttp），图片直接写入PDF，多篇论文在一个线程中同时下载
+MODE_ASYNC = 'async'
+# 流水线中合并进程数，以及已下载待合并的论文篇数上限
+DEFAULT_MERGE_WORKERS = 1
+DEFAULT_MERGE_QUEUE = 2
+
+# PyMuPDF不是线程安全的，多篇论文同时写PDF时需要加锁
+PDF_LOCK = threading.RLock()
+
+# MODE_DISK 下每篇论文的工作目录都建在此文件夹下
+TMP_DIR = "tmpjpgs"
+# 断点续传时保存图片和清单的文件夹
+RESUME_DIR = "tmpjpgs_resume"
+
+# 写PDF时内存中最多保留的图片字节数，超过后增量保存到文件并释放
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+# 图片压缩时最多暂存的页数，超过后等待最早的一页处理完成
+IMAGE_WINDOW = 32
+
+# 探测总页数的上限
+MAX_PROBE_PAGES = 1 << 14
+
 def main():
     """
     下载学位论文入口程序：
 
     调用方式：python downloader.py --pages '1-2' --major '计算机'
+    不带参数时进入交互模式，带参数时进入无交互的批量模式（见batch_cli.py）
     """
+    if len(sys.argv) > 1:
+        from batch_cli import batch_main
+        sys.exit(batch_main(sys.argv[1:]))
     answers = search_arguments()
     info_url, pages = arguments_extract(answers)
-    papers, total_count, total_pages = download_main_info(info_url, pages)
+    local_papers = get_catalog().search_url(info_url)
+    if local_papers is not None:
+        # 最近完整抓取过该检索，直接使用本地目录
+        print("使用本地目录中的检索结果")
+        total_count = len(local_papers)
+        total_pages = total_pages_for(total_count)
+        papers = [paper for page in pages for paper in local_papers[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]]
+    else:
+        papers, total_count, total_pages = download_main_info(info_url, pages)
     if total_count > 0:
         print(f"共找到 {total_count} 条记录，共 {total_pages} 页")
     will_download = confirmation(papers)['confirmation']
@@ -51,22 +146,245 @@ def main():
     else:
         print('Bye!')
 
-def paper_download(papers):
-    jpg_dir = "tmpjpgs"
+def paper_download(papers, workers=DEFAULT_WORKERS, mode=MODE_STREAM, resume=False, paper_workers=DEFAULT_PAPER_WORKERS,
+                   image_preset=None):
+    """批量下载论文
+        :param workers: 单篇论文同时请求的页数
+        :param mode: MODE_STREAM / MODE_DISK / MODE_PIPELINE（下载与合并流水线并行）/ MODE_ASYNC（协程引擎）
+        :param paper_workers: 同时下载的论文篇数，每篇论文使用独立的工作目录
+        :param image_preset: 图片压缩方式，见image_processing.PRESETS，None为保持原图
+    """
+    todo = []
     for paper in papers:
-        print(100*'@')
-        paper_filename = paper['year'] + '_' + paper['filename'] + '_' + paper['author'] + '_' + paper['mentor'] + '.pdf'
+        paper_filename = make_paper_filename(paper)
         if verify_name(paper_filename):
             print("论文{}已经存在".format(paper_filename))
             continue
+        if any(make_paper_filename(p) == paper_filename for p in todo):
+            continue
+        todo.append(paper)
+
+    if mode == MODE_PIPELINE:
+        def on_merged(paper, stats, error):
+            if error is not None:
+                print(error)
+            else:
+                print("论文{}合并完成，共{}页".format(paper['filename'], stats['pages']))
+        pipeline_download(todo, workers=workers, resume=resume, paper_workers=paper_workers, on_merged=on_merged,
+                          image_preset=image_preset)
+        print_run_summary()
+        return
+    if mode == MODE_ASYNC and not resume:
+        from async_engine import paper_download as async_paper_download
+        async_paper_download(todo, workers=workers, paper_workers=paper_workers, image_preset=image_preset)
+        print_run_summary()
+        return
+
+    def download_one(paper):
+        print(100*'@')
         print("正在下载论文：", paper['filename'])
-        init(jpg_dir=jpg_dir)
         try:
-            download_jpg(paper['link'], jpg_dir=jpg_dir)
-            merge_pdf(paper_filename, jpg_dir=jpg_dir)
+            download_paper(paper, workers=workers, mode=mode, resume=resume, image_preset=image_preset)
         except Exception as e:
             print(e)
 
+    with ThreadPoolExecutor(max_workers=max(1, min(paper_workers, MAX_PAPER_WORKERS))) as pool:
+        list(pool.map(download_one, todo))
+    print_run_summary()
+
+def print_run_summary():
+    """运行结束时打印连接池、解析缓存和各阶段的统计，并写入Prometheus快照"""
+    pool_text = format_pool_stats()
+    if pool_text:
+        print("连接池: " + pool_text)
+    print("解析缓存: " + format_resolver_stats(get_resolver_cache().stats()))
+    print("各阶段统计:")
+    print(metrics.summary())
+    metrics.write_snapshot()
+
+def pipeline_download(papers, workers=DEFAULT_WORKERS, resume=False, paper_workers=DEFAULT_PAPER_WORKERS,
+                      merge_workers=DEFAULT_MERGE_WORKERS, max_queued=DEFAULT_MERGE_QUEUE,
+                      memory_limit=DEFAULT_MEMORY_LIMIT, on_page=None, on_merged=None, image_preset=None):
+    """下载与合并两级流水线：下载线程把图片保存到独立目录后交给进程池合并，随即开始下载下一篇
+        已下载但尚未合并完的论文最多max_queued篇，以限制占用的磁盘
+        :param on_page: 下载时回调 on_page(论文, 已完成页数, 总页数)
+        :param on_merged: 每篇论文结束后回调 on_merged(论文, 统计信息, 异常)，成功时异常为None
+    合并进程用spawn启动：fork时其他下载线程可能正持有统计或输出的锁，子进程中会死锁
+    合并进程异常退出后重新创建进程池，同一进程池中排队的论文重新合并一次，其余论文不受影响
+    """
+    slots = threading.BoundedSemaphore(max(1, max_queued))
+    def new_merge_pool():
+        return ProcessPoolExecutor(max_workers=max(1, merge_workers), mp_context=multiprocessing.get_context('spawn'))
+
+    merge_pools = [new_merge_pool()]
+    merge_pools_lock = threading.Lock()
+
+    def submit_merge(paper, jpg_dir):
+        """提交合并任务，进程池已损坏时换一个新的再提交一次"""
+        with merge_pools_lock:
+            merge_pool = merge_pools[-1]
+        try:
+            return merge_pool.submit(merge_job, make_paper_filename(paper), jpg_dir, memory_limit, resume, image_preset)
+        except BrokenProcessPool:
+            with merge_pools_lock:
+                if merge_pools[-1] is merge_pool:
+                    print("合并进程异常退出，重新创建合并进程池")
+                    merge_pools.append(new_merge_pool())
+                merge_pool = merge_pools[-1]
+            return merge_pool.submit(merge_job, make_paper_filename(paper), jpg_dir, memory_limit, resume, image_preset)
+
+    def fail(paper, jpg_dir, paper_metrics, error):
+        slots.release()
+        if jpg_dir is not None and not resume:
+            # 合并进程异常退出时来不及删除图片目录
+            shutil.rmtree(jpg_dir, ignore_errors=True)
+        metrics.finish_paper(paper_metrics, error)
+        if on_merged is not None:
+            on_merged(paper, None, error)
+
+    def merge(paper, jpg_dir, budget, paper_metrics, retried=False):
+        try:
+            future = submit_merge(paper, jpg_dir)
+        except Exception as e:
+            return fail(paper, jpg_dir, paper_metrics, e)
+        future.add_done_callback(lambda f: finish(paper, jpg_dir, budget, paper_metrics, f, retried))
+
+    def finish(paper, jpg_dir, budget, paper_metrics, future, retried):
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool) and not retried:
+            # 无法区分是这篇论文还是同一进程池中的其他论文导致进程退出，各重新合并一次
+            return merge(paper, jpg_dir, budget, paper_metrics, retried=True)
+        if error is not None:
+            return fail(paper, jpg_dir, paper_metrics, error)
+        slots.release()
+        # 合并在子进程中完成，在这里更新已下载索引、本地目录和统计
+        stats = future.result()
+        stats['retries'] = budget.snapshot()
+        get_paper_index().add(make_paper_filename(paper))
+        metrics.record_stages(stats.pop('stages'), paper_metrics)
+        paper_metrics.pages = stats['pages']
+        metrics.finish_paper(paper_metrics, None)
+        if on_merged is not None:
+            on_merged(paper, stats, None)
+
+    def download_one(paper):
+        slots.acquire()
+        print(100*'@')
+        print("正在下载论文：", paper['filename'])
+        budget = RetryBudget()
+        paper_metrics = metrics.start_paper(make_paper_filename(paper))
+        try:
+            page_callback = None if on_page is None else (lambda done, total: on_page(paper, done, total))
+            with metrics.active(paper_metrics):
+                jpg_dir = download_to_dir(paper, workers=workers, on_page=page_callback, resume=resume, budget=budget)
+        except Exception as e:
+            return fail(paper, None, paper_metrics, e)
+        merge(paper, jpg_dir, budget, paper_metrics)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(paper_workers, MAX_PAPER_WORKERS))) as pool:
+            list(pool.map(download_one, papers))
+    finally:
+        for merge_pool in merge_pools:
+            merge_pool.shutdown(wait=True)
+
+def merge_job(paper_filename, jpg_dir, memory_limit=DEFAULT_MEMORY_LIMIT, keep_on_error=False, image_preset=None):
+    """在合并进程中运行：合并图片为PDF并返回统计信息
+        子进程中的计时无法直接计入主进程，通过返回值中的stages带回
+        :param keep_on_error: 失败时保留图片目录（断点续传）
+    """
+    paper_metrics = metrics.start_paper(paper_filename)
+    try:
+        with metrics.active(paper_metrics):
+            assembler = merge_pdf(paper_filename, jpg_dir=jpg_dir, memory_limit=memory_limit, image_preset=image_preset)
+    finally:
+        if not keep_on_error:
+            shutil.rmtree(jpg_dir, ignore_errors=True)
+    return {'pages': assembler.next_index - 1, 'rss_mb': memory_usage(), 'peak_rss_mb': assembler.peak_rss,
+            'stages': paper_metrics.to_dict()['stages']}
+
+def download_to_dir(paper, workers=DEFAULT_WORKERS, on_page=None, resume=False, budget=None):
+    """把论文的所有页面下载到独立的目录中
+        :return: 图片目录，由调用方合并后删除
+    """
+    if resume:
+        return resume_jpg(paper['link'], on_page=on_page, workers=workers, budget=budget)
+    # 每篇论文使用独立的工作目录，多篇论文可以同时下载
+    os.makedirs(TMP_DIR, exist_ok=True)
+    jpg_dir = tempfile.mkdtemp(prefix='job_', dir=TMP_DIR)
+    try:
+        download_jpg(paper['link'], jpg_dir=jpg_dir, on_page=on_page, workers=workers, budget=budget)
+    except BaseException:
+        shutil.rmtree(jpg_dir, ignore_errors=True)
+        raise
+    return jpg_dir
+
+def make_paper_filename(paper):
+    """论文的保存文件名：年份_题名_作者_导师.pdf"""
+    return paper['year'] + '_' + paper['filename'] + '_' + paper['author'] + '_' + paper['mentor'] + '.pdf'
+
+def download_paper(paper, workers=DEFAULT_WORKERS, mode=MODE_STREAM, on_page=None, memory_limit=DEFAULT_MEMORY_LIMIT, resume=False,
+                   image_preset=None):
+    """下载单篇论文并保存到papers文件夹
+        :param mode: MODE_STREAM 图片下载后直接写入PDF；MODE_DISK 先保存到TMP_DIR下的独立目录再合并，便于调试
+        :param resume: 断点续传，图片保存在RESUME_DIR中，失败后再次下载时只获取缺失的页面
+        :param on_page: 每下载完一页后回调 on_page(已完成页数, 总页数)
+        :param memory_limit: 写PDF时内存中最多保留的图片字节数，None表示不限制
+        :param image_preset: 图片写入PDF前的压缩方式，见image_processing.PRESETS，None为保持原图
+        :return: 统计信息 {'pages', 'rss_mb', 'peak_rss_mb', 'retries'}
+    """
+    if mode == MODE_ASYNC and not resume:
+        from async_engine import download_paper as async_download_paper
+        return async_download_paper(paper, workers=workers, on_page=on_page, memory_limit=memory_limit,
+                                    image_preset=image_preset)
+    paper_filename = make_paper_filename(paper)
+    with metrics.paper_scope(paper_filename) as paper_metrics:
+        stats = _download_paper(paper, paper_filename, workers, mode, on_page, memory_limit, resume, image_preset)
+        paper_metrics.pages = stats['pages']
+    return stats
+
+def _download_paper(paper, paper_filename, workers, mode, on_page, memory_limit, resume, image_preset):
+    budget = RetryBudget()
+    if resume:
+        jpg_dir = download_to_dir(paper, workers=workers, on_page=on_page, resume=True, budget=budget)
+        assembler = merge_pdf(paper_filename, jpg_dir=jpg_dir, memory_limit=memory_limit, image_preset=image_preset)
+    elif mode in (MODE_DISK, MODE_PIPELINE):
+        jpg_dir = download_to_dir(paper, workers=workers, on_page=on_page, budget=budget)
+        try:
+            assembler = merge_pdf(paper_filename, jpg_dir=jpg_dir, memory_limit=memory_limit, image_preset=image_preset)
+        finally:
+            shutil.rmtree(jpg_dir, ignore_errors=True)
+    else:
+        result, image_base, page_count = locate_pages(paper['link'])
+        assembler = PdfAssembler(paper_filename, memory_limit=memory_limit, image_preset=image_preset)
+        try:
+            download_pages(result, image_base, assembler.add_page, workers=workers, on_page=on_page, page_count=page_count, budget=budget)
+            assembler.save()
+        finally:
+            assembler.close()
+    stats = {'pages': assembler.next_index - 1, 'rss_mb': memory_usage(), 'peak_rss_mb': assembler.peak_rss,
+             'retries': budget.snapshot()}
+    if budget.total:
+        print("重试次数: {}".format(format_retries(stats['retries'])))
+    if stats['rss_mb'] is not None:
+        print("内存占用: {:.1f} MB，写入期间峰值: {:.1f} MB".format(stats['rss_mb'], stats['peak_rss_mb'] or stats['rss_mb']))
+    return stats
+
+def format_retries(retries):
+    """把各类错误的重试次数格式化为一行文字"""
+    names = {RETRY_SHORT: '截断', RETRY_NOT_FOUND: '404', RETRY_CONNECTION: '连接错误'}
+    return '，'.join('{} {}次'.format(names.get(kind, kind), count) for kind, count in retries.items())
+
+def memory_usage():
+    """当前进程的内存占用(RSS)，单位MB，无法获取时返回None"""
+    if PSUTIL_AVAILABLE:
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
 def search_arguments():
     if not PYINQUIRER_AVAILABLE:
         raise ImportError("PyInquirer is required for CLI mode. Install it with: pip install PyInquirer")
@@ -133,18 +451,36 @@ def search_arguments():
     return answers
 
 def arguments_extract(answers):
-    choose_key = {'主题':'topic', '题名':'title', '关键词':'keyword', '作者':'author', '院系':'department', '专业':'subject', '导师':'teacher', '年份':'year'}
-    xuewei = {'硕士及博士':'0', '博士':'1', '硕士':'2'}
-    px = {'按题名字顺序排序':'1', '按学位年度倒排序':'2'}
-    info_url = "http://thesis.lib.sjtu.edu.cn/sub.asp?content={}&choose_key={}&xuewei={}&px={}&page=".format(quote(answers['content']), \
-        choose_key[answers['choose_key']], \
-        xuewei[answers['xuewei']], \
-        px[answers['px']])
+    info_url = build_info_url(answers['content'], CHOOSE_KEY_CODES[answers['choose_key']],
+                              XUEWEI_CODES[answers['xuewei']], PX_CODES[answers['px']])
     print(info_url)
-    pages = answers['page'].split('-')
-    pages = [int(pages[0])]
+    pages = parse_pages(answers['page'])
     return info_url, pages
 
+def build_info_url(content, choose_key='topic', xuewei='0', px='1'):
+    """检索地址，末尾的page参数由调用方补上页码"""
+    return "{}?content={}&choose_key={}&xuewei={}&px={}&page=".format(SEARCH_URL, quote(content), choose_key, xuewei, px)
+
+def parse_pages(text):
+    """解析页码范围，例如 '3'、'1-3'、'1-3,5'，空字符串为第1页
+        :return: 按顺序排列、去重后的页码列表
+    """
+    pages = set()
+    for part in (text or '1').replace('，', ',').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        try:
+            start = int(start)
+            end = int(end) if end.strip() else start
+        except ValueError:
+            raise ValueError("页码范围格式错误: {}".format(text))
+        if start < 1 or end < start:
+            raise ValueError("页码范围格式错误: {}".format(text))
+        pages.update(range(start, end + 1))
+    return sorted(pages) or [1]
+
 def confirmation(papers):
     if not PYINQUIRER_AVAILABLE:
         raise ImportError("PyInquirer is required for CLI mode. Install it with: pip install PyInquirer")
@@ -165,25 +501,8 @@ def confirmation(papers):
     return answers
 
 def verify_name(paper_filename):
-    if not os.path.exists('./papers'):
-        os.mkdir('./papers')
-    if paper_filename in os.listdir('./papers'):
-        return True
-    return False
-
-def init(jpg_dir):
-    """初始化文件夹路径
-    """
-    try:
-        shutil.rmtree('./{}/'.format(jpg_dir))
-        print("删除本地{}文件夹".format(jpg_dir))
-    except Exception as e:
-        print(e)
-    try:
-        os.mkdir('./{}/'.format(jpg_dir))
-        print("新建本地{}文件夹".format(jpg_dir))
-    except Exception as e:
-        print(e)
+    """论文是否已经下载，查询内存中的已下载论文索引，不扫描papers文件夹"""
+    return get_paper_index().contains(paper_filename)
 
 
 def open_pdf_document(*args, **kwargs):
@@ -206,66 +525,32 @@ def open_pdf_document(*args, **kwargs):
     return document_func(*args, **kwargs)
 
 def download_main_info(info_url: str, pages: list):
+    results = []
+    for page in pages:
+        print("正在抓取第{}页的info".format(page))
+        results.append(fetch_result_page(info_url, page))
+    return collect_results(pages, results)
+
+def collect_results(pages: list, results: list):
+    """合并各页的检索结果
+        :param results: 与pages对应的 (论文列表, 总记录数)
+        :return: (论文列表, 总记录数, 总页数)
+    """
     papers = []
     total_count = 0
     total_pages = 0
-    info_url = info_url
-    headers = {
-        'User-Agent':'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.190 Safari/537.36'
-    }
-    result = requests.Session()
-    for page in range(pages[0], pages[0]+1):
-        print("正在抓取第{}页的info".format(page))
-        info_url_construction = info_url + str(page)
-        response = result.get(info_url_construction, headers=headers, allow_redirects=False)
-        html = etree.HTML(response.content, etree.HTMLParser())
-        
-        # 获取总记录数和总页数
-        try:
-            import re
-            # 从页面文本中查找 "共 XXX 条记录" 模式
-            page_text = ''.join(html.xpath('//text()'))
-            
-            # 查找 "，共" 和 "条记录" 之间的数字
-            match = re.search(r'，共\s*(\d+)\s*条记录', page_text)
-            if match:
-                total_count = int(match.group(1))
-                total_pages = (total_count + 19) // 20  # 每页20条，向上取整
-                print(f"检索到总记录数: {total_count}, 总页数: {total_pages}")
-            else:
-                # 尝试其他模式
-                match = re.search(r'共\s*(\d+)\s*条', page_text)
-                if match:
-                    total_count = int(match.group(1))
-                    total_pages = (total_count + 19) // 20
-                    print(f"检索到总记录数: {total_count}, 总页数: {total_pages}")
-        except Exception as e:
-            print(f"提取总记录数时出错: {e}")
-        
-        for i in range(2, 22):
-            # 有些是论文保密，所以link需要错误处理
-            info_dict = defaultdict(str)
-            try:
-                filename = html.xpath('/html/body/section/div/div[3]/div[2]/table/tr[{}]//td[2]/text()'.format(i))[0]
-                author = html.xpath('/html/body/section/div/div[3]/div[2]/table/tr[{}]/td[3]/div/text()'.format(i))[0]
-                mentor = html.xpath('/html/body/section/div/div[3]/div[2]/table/tr[{}]/td[6]/div/text()'.format(i))[0]
-                year = html.xpath('/html/body/section/div/div[3]/div[2]/table/tr[{}]/td[8]/div/text()'.format(i))[0]
-                link = "http://thesis.lib.sjtu.edu.cn/" + html.xpath('/html/body/section/div/div[3]/div[2]/table/tr[{}]/td[9]/div/a[2]/@href'.format(i))[0]
-                info_dict['filename'] = filename
-                info_dict['author'] = author
-                info_dict['mentor'] = mentor
-                info_dict['year'] = year
-                info_dict['link'] = link
-                papers.append(info_dict)
-            except Exception as e:
-                #print(e)
-                pass
+    for page_papers, page_total in results:
+        if page_total:
+            total_count = page_total
+            total_pages = total_pages_for(total_count)
+            print(f"检索到总记录数: {total_count}, 总页数: {total_pages}")
+        papers.extend(page_papers)
     
     # 如果没有从页面提取到总数，根据实际抓取的数据估算
     if total_count == 0 and len(papers) > 0:
         # 如果当前页有数据，至少说明有这一页
         total_count = len(papers)
-        total_pages = pages[0]
+        total_pages = max(pages)
         print(f"未能从页面提取总数，根据当前数据估算: 至少 {total_count} 条记录")
     
     print("总共抓取到{}个元数据信息".format(len(papers)))
@@ -273,92 +558,791 @@ def download_main_info(info_url: str, pages: list):
     # 返回论文列表、总记录数和总页数
     return papers, total_count, total_pages
 
-def download_jpg(url: str, jpg_dir: str):
-    """下载论文链接为jpg
-        :param url: 阅读全文链接
+def fetch_result_page(info_url: str, page: int):
+    """抓取并解析一页检索结果，缓存中有未过期的结果时不访问网站
+        :return: (论文列表, 总记录数)
     """
-    url = url
-    headers = {
-        'User-Agent':'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.190 Safari/537.36'
-    }
-    result = requests.Session()
-    print("开始获取图片地址")
-    response = result.get(url, headers=headers, allow_redirects=False)
-    
+    cache = get_result_cache()
+    cached = cache.get(info_url, page)
+    if cached is not None:
+        return cached
+    response = limited_get(get_session(), info_url + str(page), stage=metrics.STAGE_SEARCH, allow_redirects=False)
+    return store_result_page(info_url, page, response.content)
+
+def store_result_page(info_url: str, page: int, content: bytes):
+    """解析一页检索结果，保存到本地目录和检索结果缓存
+        :return: (论文列表, 总记录数)
+    """
+    cache = get_result_cache()
+    with metrics.timed(metrics.STAGE_SEARCH_PARSE) as sample:
+        sample['bytes'] = len(content)
+        papers, total_count = parse_results(content)
+    try:
+        get_catalog().upsert_papers(papers)
+        # 空页面可能是网站出错，不缓存
+        if papers:
+            cache.put(info_url, page, papers, total_count)
+    except sqlite3.Error as e:
+        print(f"保存到本地目录失败: {e}")
+    return papers, total_count
+
+def harvest_results(info_url: str, workers=DEFAULT_SEARCH_WORKERS, first=None, max_pages=None):
+    """并发抓取一个检索的全部结果页，每完成一页就产出一页，适合上千条记录的检索
+        同时在途的页面不超过workers个，实际请求速度还受检索服务器的限速器约束
+        全部页面抓取完成后在本地目录中记录该检索，之后可以离线回答
+        :param first: 已经抓取的第1页 (论文列表, 总记录数)，避免重复请求
+        :param max_pages: 最多抓取的页数
+        :yield: (页码, 论文列表, 总页数)，页码不保证按顺序
+    """
+    if first is None:
+        first = fetch_result_page(info_url, 1)
+    papers, total_count = first
+    total_pages = total_pages_for(total_count) or (1 if papers else 0)
+    if max_pages is not None:
+        total_pages = min(total_pages, max_pages)
+    pages = {1: papers}
+    yield 1, papers, total_pages
+
+    todo = deque(range(2, total_pages + 1))
+    pending = {}
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        while todo or pending:
+            while todo and len(pending) < workers:
+                page = todo.popleft()
+                pending[pool.submit(fetch_result_page, info_url, page)] = page
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                page = pending.pop(future)
+                pages[page] = future.result()[0]
+                yield page, pages[page], total_pages
+        if max_pages is None:
+            # 部分页面可能来自检索结果缓存，按最早抓取的一页记录时间，避免旧结果显得新鲜
+            cache = get_result_cache()
+            fetched_at = min(cache.fetched_at(info_url, page) or time.time() for page in pages)
+            get_catalog().record_query(info_url, total_count,
+                                       [paper['link'] for page in sorted(pages) for paper in pages[page]],
+                                       fetched_at=fetched_at)
+    finally:
+        # 调用方提前停止迭代时，取消尚未开始的请求
+        pool.shutdown(wait=False, cancel_futures=True)
+
+class ResultPrefetcher:
+    """在后台预取当前页前后的检索结果页，结果写入检索结果缓存，翻页时直接从缓存读取
+        检索条件变化时取消尚未开始的预取
+    """
+    def __init__(self, workers=2):
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.lock = threading.Lock()
+        self.info_url = None
+        self.futures = {}  # 页码 -> Future
+
+    def reset(self, info_url=None):
+        """切换到新的检索，取消旧检索尚未开始的预取"""
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures = {}
+            self.info_url = info_url
+
+    def prefetch(self, info_url, page, total_pages, depth=DEFAULT_PREFETCH_DEPTH):
+        """预取 page±1 … page±depth，离当前页近的先取"""
+        if info_url != self.info_url:
+            self.reset(info_url)
+        wanted = []
+        for distance in range(1, depth + 1):
+            for p in (page + distance, page - distance):
+                if 1 <= p <= total_pages:
+                    wanted.append(p)
+        cache = get_result_cache()
+        with self.lock:
+            # 用户跳到别处后，窗口外尚未开始的预取不再需要
+            for p, future in list(self.futures.items()):
+                if future.done() or (p not in wanted and future.cancel()):
+                    del self.futures[p]
+            for p in wanted:
+                if p not in self.futures and not cache.contains(info_url, p):
+                    self.futures[p] = self.pool.submit(fetch_result_page, info_url, p)
+
+    def pending(self, info_url, page):
+        """正在预取的页面，翻页时等待它完成而不是重复请求"""
+        with self.lock:
+            if info_url != self.info_url:
+                return None
+            future = self.futures.get(page)
+        if future is None or future.cancelled():
+            return None
+        return future
+
+    def shutdown(self):
+        self.reset()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+def classify_page(status_code: int, content_type: str, content: bytes, content_length=None):
+    """根据状态码、content-type和内容一次性判断单页图片的类型
+        :return: PAGE_OK / PAGE_NOT_FOUND / PAGE_SHORT
+    """
+    if status_code == 404:
+        return PAGE_NOT_FOUND
+    if not content_type.startswith('image/') and not content.startswith(JPG_MAGIC):
+        # 服务器的404页面有时以200状态码返回，只能从内容判断
+        if NOT_FOUND_BYTES in content:
+            return PAGE_NOT_FOUND
+        return PAGE_SHORT
+    if len(content) < MIN_JPG_SIZE:
+        return PAGE_SHORT
+    if content_length is not None and len(content) != content_length:
+        # 连接提前断开导致的截断
+        return PAGE_SHORT
+    return PAGE_OK
+
+def fetch_page(result, fig_url: str, headers=HEADERS):
+    """请求一次图片地址并分类，每次调用只发出一个请求
+        :param result: requests.Session
+        :return: (状态, 图片内容)
+    """
+    with limited_request(fig_url, metrics.STAGE_PAGE) as (slot, sample):
+        response = result.get(fig_url, headers=headers)
+        sample['bytes'] = len(response.content)
+        state = fetch_state(response)
+        slot.outcome = PAGE_OUTCOMES[state]
+    return state, response.content
+
+@contextmanager
+def limited_request(url: str, stage: str):
+    """占用该主机限速器的一个名额发出一个请求，分别记录等待限速器和请求本身的用时
+        :yield: (限速器名额, 计时样本)，可以设置 sample['bytes']
+    """
+    start = time.perf_counter()
+    with get_limiter(url).request() as slot:
+        metrics.record(metrics.STAGE_LIMITER, time.perf_counter() - start)
+        with metrics.timed(stage) as sample:
+            yield slot, sample
+
+def limited_get(result, url: str, headers=HEADERS, stage=metrics.STAGE_HTTP, **kwargs):
+    """经过该主机共享的限速器发出GET请求，5xx响应会降低并发，连接错误退避重试
+        :param stage: 计入的统计阶段
+    """
+    def get():
+        with limited_request(url, stage) as (slot, sample):
+            response = result.get(url, headers=headers, **kwargs)
+            sample['bytes'] = len(response.content)
+            if response.status_code >= 500:
+                slot.outcome = OUTCOME_ERROR
+        return response
+    return call_with_retry(get, CONNECTION_ERRORS)
+
+def fetch_state(response):
+    """对已完成的响应分类"""
+    content_length = response.headers.get('Content-Length')
+    try:
+        content_length = int(content_length) if content_length is not None else None
+    except ValueError:
+        content_length = None
+    return classify_page(response.status_code, response.headers.get('Content-Type', ''), response.content, content_length)
+
+def fetch_page_with_retry(result, fig_url: str, headers=HEADERS, budget=None, end=None, i=None):
+    """下载单页图片，404页面、截断的内容和连接错误按retry.POLICIES中各自的策略退避重试
+        :param budget: 论文的失败预算RetryBudget，用尽时抛出RetryError
+        :param end: 论文的PageEnd，第i页在已确认的结尾之后时不再请求或重试，按不存在处理；
+            之前有页面正在重试404时先等它的结果
+        :return: (PAGE_OK, 图片内容) 或 (PAGE_NOT_FOUND, None)
+    """
+    retry = RetryState(budget)
+    try:
+        while True:
+            if end is not None and end.after_end(i):
+                return PAGE_NOT_FOUND, None
+            if end is not None and end.held(i):
+                # 不请求也不计入重试，结尾确定时被唤醒
+                end.wait_retry(i, retry.policies[RETRY_NOT_FOUND].base_delay)
+                continue
+            try:
+                state, content = fetch_page(result, fig_url, headers)
+            except CONNECTION_ERRORS:
+                kind = RETRY_CONNECTION
+            else:
+                if state == PAGE_OK:
+                    return state, content
+                kind = page_retry_kind(retry, state)
+                if kind is None:
+                    return PAGE_NOT_FOUND, None
+                if kind == RETRY_NOT_FOUND and end is not None:
+                    end.miss(i)
+                    if end.after_end(i) or end.held(i):
+                        continue
+            if end is None:
+                retry.backoff(kind)
+            else:
+                end.wait_retry(i, retry.next_delay(kind))
+    finally:
+        if end is not None:
+            end.resolve(i)
+
+def page_retry_kind(retry, state):
+    """下载失败的页面按哪种策略重试，两个下载引擎共用
+        :param retry: 该页的RetryState
+        :return: RETRY_NOT_FOUND / RETRY_SHORT，404的重试次数用完时返回None（页面确实不存在）
+    """
+    kind = RETRY_NOT_FOUND if state == PAGE_NOT_FOUND else RETRY_SHORT
+    if kind == RETRY_NOT_FOUND and not retry.can_retry(kind):
+        return None
+    return kind
+
+def head_exists(status_code, content_type):
+    """根据HEAD响应判断页面是否存在，服务器不支持HEAD（405）时返回None，由调用方退回GET"""
+    if status_code == 405:
+        return None
+    if status_code == 404:
+        return False
+    return content_type.startswith('image/')
+
+class PageProbe:
+    """探测论文总页数：先指数增长再二分查找，用O(log n)个请求，两个下载引擎共用
+        probe = PageProbe()
+        while not probe.done:
+            probe.report(page_exists(probe.page))
+        probe.page_count
+    """
+    def __init__(self):
+        self.page = 1   # 下一个要检查的页码
+        self.lo = 0     # 已知存在的最大页码
+        self.hi = None  # 已知不存在的最小页码，None表示还在指数增长
+        self.done = False
+        self.page_count = 0
+
+    def report(self, exists):
+        """self.page是否存在"""
+        if exists:
+            self.lo = self.page
+        else:
+            self.hi = self.page
+        if self.lo == 0 and self.hi is not None:
+            # 第1页就不存在
+            self.finish(0)
+        elif self.hi is None:
+            if self.lo * 2 > MAX_PROBE_PAGES:
+                self.finish(self.lo)
+            else:
+                self.page = self.lo * 2
+        elif self.hi - self.lo > 1:
+            self.page = (self.lo + self.hi) // 2
+        else:
+            self.finish(self.lo)
+
+    def finish(self, page_count):
+        self.done = True
+        self.page_count = page_count
+
+class PageEnd:
+    """download_pages中判断论文在哪里结束，两个下载引擎共用
+        已知总页数时，范围内的页面重试后仍然404说明下载不完整，抛出异常；只有第page_count+1页决定论文在哪里结束
+        超出已知范围逐页下载时，第一个404的页面为结尾，之后的内容会被丢弃
+        结尾确定后，结尾之后的页面不再重试，404即为最终结果；
+        超出已知范围时只有最靠前的404页面重试，之后的页面等它的结果，不重复消耗重试次数
+    """
+    def __init__(self, image_base, page_count, found=None):
+        """:param found: 结尾确定时置位的事件，唤醒正在等待重试的页面，协程引擎传入asyncio.Event"""
+        self.image_base = image_base
+        self.page_count = page_count
+        self.end = None  # 第一个404的页码
+        self.found = found if found is not None else threading.Event()
+        self.missing = set()  # 超出已知范围、正在重试404的页码
+        self.lock = threading.Lock()
+
+    def after_end(self, i):
+        """第i页在已确认的结尾之后，不需要下载、重试或保存"""
+        return self.end is not None and i >= self.end
+
+    def miss(self, i):
+        """第i页返回404，接下来要重试"""
+        if self.page_count is None or i > self.page_count:
+            with self.lock:
+                self.missing.add(i)
+
+    def resolve(self, i):
+        """第i页不再重试（下载成功、确认不存在或出错）"""
+        with self.lock:
+            self.missing.discard(i)
+
+    def held(self, i):
+        """第i页之前有页面正在重试404：那一页如果确实不存在，第i页就在结尾之后，先等它的结果"""
+        with self.lock:
+            return any(j < i for j in self.missing)
+
+    def set_end(self, i):
+        self.end = i
+        self.found.set()
+
+    def wait_retry(self, i, delay):
+        """在线程中等待delay秒后重试第i页，等待期间确定的结尾在第i页之前时提前返回"""
+        deadline = time.monotonic() + delay
+        self.found.wait(delay)
+        if not self.after_end(i):
+            time.sleep(max(0, deadline - time.monotonic()))
+
+    def accept(self, i, state):
+        """第i页下载完成（已经过重试）
+            :return: 是否保存该页
+        """
+        if state == PAGE_NOT_FOUND and self.page_count is not None and i <= self.page_count:
+            raise Exception(missing_page_text(i, self.page_count))
+        if state == PAGE_NOT_FOUND:
+            if self.end is None or i < self.end:
+                print(f"{page_url(self.image_base, i)}: {NOT_FOUND_TEXT}")
+                self.set_end(i)
+            return False
+        return not self.after_end(i)
+
+    def confirm(self, i, state):
+        """已知范围下载完毕后，对下一页只请求一次，不再等待重试
+            :return: 第i页不存在，论文在此结束；否则需要继续逐页下载
+        """
+        if state == PAGE_NOT_FOUND:
+            self.set_end(i)
+            return True
+        print("探测的总页数偏少，继续逐页下载")
+        return False
+
+def missing_page_text(i, page_count):
+    """探测范围内的页面重试后仍然404时的错误信息"""
+    return "第{}页重试后仍然不存在（论文共{}页），下载不完整，请稍后重试".format(i, page_count)
+
+def page_url(image_base: str, i: int):
+    """第i页图片的地址"""
+    return READ_URL + image_base + "_{0:05d}".format(i) + ".jpg"
+
+def resolve_viewer(result, url: str, headers=HEADERS):
+    """完整的解析过程：三次重定向得到阅读器的查询参数，再由jumpServlet得到图片地址前缀
+        :return: (图片地址前缀, 查询参数)
+    """
+    response = limited_get(result, url, headers=headers, stage=metrics.STAGE_REDIRECT, allow_redirects=False)
     if 'Location' not in response.headers:
-        print("错误：无法获取重定向地址，可能是论文未公开或链接失效")
-        return
-    
+        raise Exception("无法获取重定向地址，可能是论文未公开或链接失效")
+
     url = response.headers['Location']
-    response = result.get(url, headers=headers, allow_redirects=False)
-    
+    response = limited_get(result, url, headers=headers, stage=metrics.STAGE_REDIRECT, allow_redirects=False)
     if 'Location' not in response.headers:
-        print("错误：第二次重定向失败")
-        return
-    
+        raise Exception("第二次重定向失败")
+
     url = response.headers['Location']
-    response = result.get(url, headers=headers, allow_redirects=False)
-    
+    response = limited_get(result, url, headers=headers, stage=metrics.STAGE_REDIRECT, allow_redirects=False)
     if 'Location' not in response.headers:
-        print("错误：第三次重定向失败")
-        return
-    
+        raise Exception("第三次重定向失败")
+
     url_bix = response.headers['Location'].split('?')[1]
-    url = "http://thesis.lib.sjtu.edu.cn:8443/read/jumpServlet?page=1&" + url_bix
-    response = result.get(url, headers=headers, allow_redirects=False)
+    url = READ_URL + "jumpServlet?page=1&" + url_bix
+    response = limited_get(result, url, headers=headers, stage=metrics.STAGE_JUMP, allow_redirects=False)
     urls = json.loads(response.content.decode())
+    return urls['list'][0]['src'].split('_')[0], url_bix
+
+def page_exists(result, image_base: str, i: int, headers=HEADERS):
+    """只根据响应头判断第i页是否存在，用于探测总页数"""
+    fig_url = page_url(image_base, i)
+    def head():
+        with limited_request(fig_url, metrics.STAGE_PROBE) as (slot, sample):
+            response = result.head(fig_url, headers=headers)
+            if response.status_code >= 500:
+                slot.outcome = OUTCOME_ERROR
+        return response
+    response = call_with_retry(head, CONNECTION_ERRORS)
+    exists = head_exists(response.status_code, response.headers.get('Content-Type', ''))
+    if exists is None:
+        # 不支持HEAD时退回GET
+        return fetch_page(result, fig_url, headers)[0] != PAGE_NOT_FOUND
+    return exists
+
+def probe_page_count(result, image_base: str, headers=HEADERS):
+    """用PageProbe探测论文总页数"""
+    probe = PageProbe()
+    while not probe.done:
+        probe.report(page_exists(result, image_base, probe.page, headers))
+    return probe.page_count
+
+def download_pages(result, image_base: str, save_page, workers=DEFAULT_WORKERS, on_page=None, page_count=None, pages=None, budget=None, headers=HEADERS):
+    """并发下载论文的所有页面，同时在途的请求不超过workers个
+        页面按完成顺序交给save_page(页码, 内容)，论文在哪里结束见PageEnd
+        :param on_page: 每完成一页后回调 on_page(已完成页数, 总页数)，总页数未知时为0
+        :param page_count: 预先探测的总页数，为None时逐页下载直到404
+        :param pages: 只下载这些页码（断点续传），默认下载1到page_count页
+        :param budget: 论文的失败预算RetryBudget，同时记录重试次数
+        :return: 总页数
+    """
+    workers = max(1, min(workers, MAX_WORKERS))
+    if page_count is None:
+        todo = deque()
+        next_page = 1
+    else:
+        todo = deque(pages if pages is not None else range(1, page_count + 1))
+        next_page = page_count + 1
+    discovering = page_count is None
+    end = PageEnd(image_base, page_count)
+    done = (page_count or 0) - len(todo)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            while end.end is None and len(pending) < workers:
+                if todo:
+                    i = todo.popleft()
+                elif discovering:
+                    i = next_page
+                    next_page += 1
+                else:
+                    break
+                # 线程池中的请求和重试同样计入当前论文的统计
+                future = pool.submit(metrics.propagate(fetch_page_with_retry), result, page_url(image_base, i), headers, budget,
+                                     end, i)
+                pending[future] = i
+            if not pending:
+                if end.end is not None:
+                    break
+                # 只请求一次，不等待404重试，连接错误仍按策略重试
+                state, _ = call_with_retry(lambda: fetch_page(result, page_url(image_base, next_page), headers),
+                                           CONNECTION_ERRORS, budget=budget)
+                if end.confirm(next_page, state):
+                    break
+                discovering = True
+                continue
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = pending.pop(future)
+                state, content = future.result()
+                try:
+                    keep = end.accept(i, state)
+                except Exception:
+                    for other in pending:
+                        other.cancel()
+                    raise
+                if not keep:
+                    continue
+                save_page(i, content)
+                done += 1
+                if on_page is not None:
+                    on_page(done, 0 if discovering else page_count)
+    return end.end - 1
+
+def resolve_cached(result, url: str, validate=True):
+    """先查解析缓存，缓存未命中或校验失败时才走完整的重定向链，并更新缓存
+        :param validate: 用一个HEAD请求确认缓存的第1页仍然存在；为False时由调用方校验
+        :return: (图片地址前缀, 是否来自缓存)
+    """
+    cache = get_resolver_cache()
+    cached = cache.get(url)
+    if cached is not None:
+        image_base = cached[0]
+        if not validate or page_exists(result, image_base, 1):
+            print("使用缓存的图片地址")
+            return image_base, True
+        cache.invalidate(url)
+    print("开始获取图片地址")
+    image_base, token = resolve_viewer(result, url)
+    cache.put(url, image_base, token)
     print("已经获取到图片地址")
-    i = 1
-    while(True):
-        fig_url = "http://thesis.lib.sjtu.edu.cn:8443/read/" + urls['list'][0]['src'].split('_')[0] + "_{0:05d}".format(i) + ".jpg"
-        response = result.get(fig_url, headers=headers).content
-        rtext = result.get(fig_url, headers=headers).text
-        # print(fig_url)
-        if ('HTTP状态 404 - 未找到' in result.get(fig_url, headers=headers).text):
-            for t in range(10):
-                time.sleep(2)
-                rtext = result.get(fig_url, headers=headers).text
-                if ('HTTP状态 404 - 未找到' in rtext): pass
-                else: break
-            if ('HTTP状态 404 - 未找到' in rtext):
-                print(f"{fig_url}: HTTP状态 404 - 未找到")
-                break
-        while len(response) < 2000:
-            response = result.get(fig_url, headers=headers).content
-        # if len(response) == 746:
-        #     #print(response)
-        #     #print("资源无法访问了，网站挂了")
-        #     break
-        with open('./{}/{}.jpg'.format(jpg_dir, i), 'wb') as f:
-            f.write(response)
-            # print(len(response))
-        print("正在采集第{}页".format(i))
-        i = i + 1
-
-def merge_pdf(paper_filename, jpg_dir):
+    return image_base, False
+
+def resolve_paper(url: str):
+    """解析阅读全文链接，获取图片地址前缀
+        :return: (requests.Session, 图片地址前缀)
+    """
+    result = get_session()
+    image_base, _ = resolve_cached(result, url)
+    return result, image_base
+
+def locate_pages(url: str):
+    """解析阅读全文链接，获取图片地址前缀并探测总页数
+        :return: (requests.Session, 图片地址前缀, 总页数)
+    """
+    result = get_session()
+    # 探测页数的第一个请求就是第1页，顺便校验缓存的地址，不需要额外的请求
+    image_base, cached = resolve_cached(result, url, validate=False)
+    page_count = probe_page_count(result, image_base)
+    if page_count == 0 and cached:
+        get_resolver_cache().invalidate(url)
+        image_base, _ = resolve_cached(result, url)
+        page_count = probe_page_count(result, image_base)
+    if page_count == 0:
+        raise Exception("论文没有可下载的页面")
+    print("论文共{}页".format(page_count))
+    return result, image_base, page_count
+
+class PageManifest:
+    """断点续传清单，记录一篇论文已下载并校验过的页面
+    以图片地址前缀区分论文，页面保存在 RESUME_DIR/<前缀>/ 下
+    """
+    def __init__(self, image_base):
+        self.image_base = image_base
+        self.jpg_dir = os.path.join(RESUME_DIR, re.sub(r'[^0-9A-Za-z]+', '_', image_base).strip('_'))
+        self.path = os.path.join(self.jpg_dir, 'manifest.json')
+        self.page_count = None
+        self.pages = {}
+        os.makedirs(self.jpg_dir, exist_ok=True)
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('image_base') == image_base:
+                self.page_count = data.get('page_count')
+                self.pages = {int(k): v for k, v in data.get('pages', {}).items()}
+        except (OSError, ValueError):
+            pass
+
+    def page_path(self, i):
+        return os.path.join(self.jpg_dir, '{}.jpg'.format(i))
+
+    def verified(self, i):
+        """清单中有记录，且文件存在、大小一致、是jpg"""
+        size = self.pages.get(i)
+        path = self.page_path(i)
+        if size is None or not os.path.exists(path) or os.path.getsize(path) != size:
+            return False
+        with open(path, 'rb') as f:
+            return f.read(2) == JPG_MAGIC
+
+    def missing_pages(self):
+        return [i for i in range(1, self.page_count + 1) if not self.verified(i)]
+
+    def record(self, i, content):
+        """保存一页图片并更新清单"""
+        with metrics.timed(metrics.STAGE_JPG_WRITE) as sample:
+            with open(self.page_path(i), 'wb') as f:
+                f.write(content)
+            self.pages[i] = len(content)
+            self.save()
+            sample['bytes'] = len(content)
+
+    def truncate(self, page_count):
+        """下载时确认了实际页数（第page_count+1页不存在），删除之后多余的页面
+        实际页数不会少于探测的页数：范围内的页面缺失时download_pages抛出异常，不会走到这里
+        """
+        if page_count < self.page_count:
+            raise Exception("实际页数{}少于探测的{}页，保留已下载的页面".format(page_count, self.page_count))
+        self.page_count = page_count
+        for i in [i for i in self.pages if i > page_count]:
+            del self.pages[i]
+            if os.path.exists(self.page_path(i)):
+                os.remove(self.page_path(i))
+        self.save()
+
+    def save(self):
+        data = {'image_base': self.image_base, 'page_count': self.page_count, 'pages': self.pages}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+def resume_jpg(url: str, on_page=None, workers=DEFAULT_WORKERS, budget=None):
+    """断点续传：只下载清单中缺失的页面
+        :return: 保存图片的文件夹
+    """
+    result, image_base = resolve_paper(url)
+    manifest = PageManifest(image_base)
+    if manifest.page_count is None:
+        manifest.page_count = probe_page_count(result, image_base)
+        if manifest.page_count == 0:
+            raise Exception("论文没有可下载的页面")
+        manifest.save()
+    missing = manifest.missing_pages()
+    print("论文共{}页，已下载{}页".format(manifest.page_count, manifest.page_count - len(missing)))
+    if missing:
+        try:
+            page_count = download_pages(result, image_base, manifest.record, workers=workers, on_page=on_page,
+                                        page_count=manifest.page_count, pages=missing, budget=budget)
+        except Exception:
+            # 清单和已校验的页面都保留，下次只下载仍然缺失的页面
+            print("已下载的页面保存在{}，再次下载时继续".format(manifest.jpg_dir))
+            raise
+        manifest.truncate(page_count)
+    return manifest.jpg_dir
+
+def download_jpg(url: str, jpg_dir: str, on_page=None, workers=DEFAULT_WORKERS, budget=None):
+    """下载论文链接为jpg
+        :param url: 阅读全文链接
+        :param on_page: 每下载完一页后回调 on_page(已完成页数, 总页数)
+        :param workers: 同时请求的页数
+        :param budget: 失败预算RetryBudget，调用方可从中读取各类错误的重试次数
+    """
+    result, image_base, page_count = locate_pages(url)
+    page_count = download_pages(result, image_base, jpg_writer(jpg_dir, page_count), workers=workers, on_page=on_page,
+                                page_count=page_count, budget=budget)
+    remove_pages_after(jpg_dir, page_count)
+    return page_count
+
+def jpg_writer(jpg_dir: str, page_count: int):
+    """download_pages的save_page：把每一页保存为jpg_dir下的<页码>.jpg"""
+    def save_page(i, content):
+        with metrics.timed(metrics.STAGE_JPG_WRITE) as sample, open('./{}/{}.jpg'.format(jpg_dir, i), 'wb') as f:
+            f.write(content)
+            sample['bytes'] = len(content)
+        print("正在采集第{}/{}页".format(i, page_count))
+    return save_page
+
+def remove_pages_after(jpg_dir: str, page_count: int):
+    """乱序完成时，404之后偶尔会有页面先写入，这里清理掉"""
+    for img in os.listdir('./{}/'.format(jpg_dir)):
+        if int(img[:-4]) > page_count:
+            os.remove('./{}/{}'.format(jpg_dir, img))
+
+def insert_jpg_page(doc, content: bytes, size=None):
+    """把一页图片直接插入PDF，页面大小与图片一致
+        :param size: 页面大小(宽, 高)，图片经过压缩处理时为原图的大小，为None时从jpg图片读取
+    """
+    if size is None:
+        img = open_pdf_document(stream=content, filetype='jpg')
+        rect = img[0].rect
+        img.close()
+    else:
+        rect = pymupdf.Rect(0, 0, *size)
+    page = doc.new_page(width=rect.width, height=rect.height)
+    page.insert_image(rect, stream=content)
+
+class PdfAssembler:
+    """把下载到的图片直接写入PDF，不经过tmpjpgs文件夹
+    页面可能乱序到达，先在内存中暂存，按页码顺序插入
+    已插入的图片超过memory_limit字节时增量保存到文件，并重新打开文档释放内存
+    PyMuPDF不支持多线程，同时下载多篇论文时所有文档操作都通过PDF_LOCK串行
+    指定image_preset时，图片先交给进程池压缩，处理完成后再按顺序插入
+    """
+    def __init__(self, paper_filename, memory_limit=DEFAULT_MEMORY_LIMIT, image_preset=None):
+        os.makedirs(PAPERS_DIR, exist_ok=True)
+        self.filename = os.path.join(PAPERS_DIR, paper_filename)
+        # 先写入临时文件，避免中断时留下不完整的pdf被当作已下载
+        self.part_filename = self.filename + '.part'
+        self.memory_limit = memory_limit
+        with PDF_LOCK:
+            self.doc = open_pdf_document()
+        self.next_index = 1
+        self.buffer = {}
+        self.unsaved_bytes = 0
+        self.flushed = False
+        self.peak_rss = None
+        self.preset = get_preset(image_preset)
+        self.pool = get_image_pool() if self.preset is not None else None
+
+    def add_page(self, i, content):
+        self.submit(i, content)
+        self.insert_ready()
+
+    def submit(self, i, content):
+        """暂存一页，需要压缩时交给进程池"""
+        if self.pool is not None:
+            content = self.pool.submit(process_image, content, self.preset)
+        self.buffer[i] = content
+
+    def next_image(self, wait=False):
+        """下一页还在压缩、且需要等待时返回其Future，否则返回None
+            暂存的页面超过IMAGE_WINDOW页（或wait为True）时才等待，否则先不插入
+        """
+        content = self.buffer.get(self.next_index)
+        if isinstance(content, Future) and not content.done() and (wait or len(self.buffer) > IMAGE_WINDOW):
+            return content
+        return None
+
+    def has_ready_page(self):
+        """下一页已经就绪，可以插入"""
+        content = self.buffer.get(self.next_index)
+        return content is not None and not (isinstance(content, Future) and not content.done())
+
+    def insert_ready(self, wait=False):
+        """按页码顺序插入已就绪的页面，需要时等待压缩中的页面
+            协程中先await next_image()返回的Future，再在线程池中调用insert_done，不阻塞事件循环
+        """
+        while True:
+            self.insert_done()
+            image = self.next_image(wait)
+            if image is None:
+                return
+            futures_wait([image])
+
+    def insert_done(self):
+        """按页码顺序插入已就绪的页面，遇到压缩未完成的页面时停止，不会等待"""
+        while self.has_ready_page():
+            content, size = self.buffer[self.next_index], None
+            if isinstance(content, Future):
+                content, size, cpu_seconds = content.result()
+                metrics.record(metrics.STAGE_IMAGE, cpu_seconds, len(content))
+            del self.buffer[self.next_index]
+            with PDF_LOCK:
+                with metrics.timed(metrics.STAGE_PDF_INSERT) as sample:
+                    insert_jpg_page(self.doc, content, size)
+                    sample['bytes'] = len(content)
+                self.unsaved_bytes += len(content)
+                self.next_index += 1
+                if self.memory_limit is not None and self.unsaved_bytes >= self.memory_limit:
+                    self.flush()
+
+    def flush(self):
+        """把内存中的页面写入文件，然后从文件重新打开文档"""
+        self.sample_memory()
+        with PDF_LOCK:
+            self.write()
+            self.doc.close()
+            self.doc = open_pdf_document(self.part_filename)
+        self.unsaved_bytes = 0
+
+    def write(self):
+        # 二值化的页面被MuPDF存为未压缩的1位图，压缩图片时保存前需要deflate
+        deflate = self.preset is not None
+        with metrics.timed(metrics.STAGE_PDF_SAVE):
+            if self.flushed:
+                self.doc.save(self.part_filename, incremental=True, encryption=pymupdf.PDF_ENCRYPT_KEEP, deflate=deflate)
+            else:
+                self.doc.save(self.part_filename, deflate=deflate)
+                self.flushed = True
+
+    def sample_memory(self):
+        rss = memory_usage()
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
+
+    def save(self):
+        self.insert_ready(wait=True)
+        if self.buffer:
+            raise Exception("缺少第{}页，无法保存".format(self.next_index))
+        print("保存pdf文件")
+        self.sample_memory()
+        with PDF_LOCK:
+            self.write()
+            self.doc.close()
+        os.replace(self.part_filename, self.filename)
+        get_paper_index().add(os.path.basename(self.filename))
+
+    def close(self):
+        for content in self.buffer.values():
+            if isinstance(content, Future):
+                content.cancel()
+        self.buffer.clear()
+        with PDF_LOCK:
+            if not self.doc.is_closed:
+                self.doc.close()
+        if os.path.exists(self.part_filename):
+            os.remove(self.part_filename)
+
+def merge_pdf(paper_filename, jpg_dir, memory_limit=DEFAULT_MEMORY_LIMIT, image_preset=None):
+    with metrics.timed(metrics.STAGE_MERGE):
+        return _merge_pdf(paper_filename, jpg_dir, memory_limit, image_preset)
+
+def _merge_pdf(paper_filename, jpg_dir, memory_limit=DEFAULT_MEMORY_LIMIT, image_preset=None):
     print("合并pdf文件")
-    doc = open_pdf_document()
     imgs = []
-    filename = f'./papers/{paper_filename}'
     img_path = './{}/'.format(jpg_dir)
     # if len(os.listdir('./{}/'.format(jpg_dir)))<100:
     #     print("文章{}下载错误，跳过".format(paper_filename))
     #     shutil.rmtree('./{}'.format(jpg_dir))
     #     return
     for img in os.listdir('./{}/'.format(jpg_dir)):
-        imgs.append(img)
+        if img.endswith('.jpg'):
+            imgs.append(img)
     imgs.sort(key=lambda x:int(x[:-4]))
-    for img in imgs:
-        img = open_pdf_document(img_path + img)
-        rect = img[0].rect
-        pdf_bytes = img.convert_to_pdf()
-        img.close()
-        pdf_img = open_pdf_document('pdf', pdf_bytes)
-        doc.insert_pdf(pdf_img)
-        pdf_img.close()
-    doc.save(filename)
-    doc.close()
+    assembler = PdfAssembler(paper_filename, memory_limit=memory_limit, image_preset=image_preset)
+    try:
+        for i, img in enumerate(imgs, 1):
+            with open(img_path + img, 'rb') as f:
+                assembler.add_page(i, f.read())
+        assembler.save()
+    finally:
+        assembler.close()
     shutil.rmtree('./{}'.format(jpg_dir))
+    return assembler
 
 if __name__=='__main__':
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
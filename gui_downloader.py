@@ -8,111 +8,324 @@
 
 import sys
 import os
+import asyncio
+import multiprocessing
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QLabel, QComboBox, QLineEdit, QPushButton, QTableWidget, QTableWidgetItem,
-    QProgressBar, QTextEdit, QMessageBox, QCheckBox, QHeaderView
+    QLabel, QComboBox, QLineEdit, QPushButton, QTableView, QAbstractItemView,
+    QProgressBar, QTextEdit, QMessageBox, QCheckBox, QHeaderView, QSpinBox
 )
-from PySide6.QtCore import Qt, QThread, Signal, Slot
-from PySide6.QtGui import QFont
+from PySide6.QtCore import Qt, QThread, Signal, Slot, QAbstractTableModel, QModelIndex, QSortFilterProxyModel
+from PySide6.QtGui import QFont, QColor
 
 # 导入原有的下载函数
 from downloader import (
-    download_main_info, paper_download, init, download_jpg, 
-    merge_pdf, verify_name
+    download_main_info, harvest_results, download_paper, ResultPrefetcher, DEFAULT_PREFETCH_DEPTH, pipeline_download, make_paper_filename, verify_name, format_retries,
+    DEFAULT_WORKERS, MAX_WORKERS, MODE_STREAM, MODE_DISK, MODE_PIPELINE, MODE_ASYNC, DEFAULT_MEMORY_LIMIT,
+    DEFAULT_PAPER_WORKERS, MAX_PAPER_WORKERS
 )
+from async_engine import AsyncEngine, AIOHTTP_AVAILABLE, MAX_ASYNC_PAPER_WORKERS
+from catalog import get_catalog
+from http_client import format_pool_stats
+from image_processing import PRESET_ORIGINAL
+import metrics
+from result_cache import get_result_cache, format_cache_stats
+from resolver_cache import get_resolver_cache, format_resolver_stats
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
 from collections import defaultdict
 
+# 总页数不超过该值时，在后台抓取全部页面并在本地分页；更多时按需加载
+HARVEST_MAX_PAGES = 10
+# 表格由模型按需渲染，每页可以显示较多篇数
+MAX_PAGE_SIZE = 1000
+
 
 class DownloadThread(QThread):
     """下载线程，避免阻塞UI"""
     progress_signal = Signal(str)  # 发送进度消息
-    page_progress_signal = Signal(int, int, int)  # 发送页码进度 (论文序号, 总论文数, 当前页码)
+    log_signal = Signal(str)  # 只写入日志、不推进进度条的消息
+    page_progress_signal = Signal(int, int, int, int)  # 发送页码进度 (论文序号, 总论文数, 已完成页数, 总页数)
     finished_signal = Signal()  # 完成信号
     error_signal = Signal(str)  # 错误信号
     
-    def __init__(self, papers):
+    def __init__(self, papers, workers=DEFAULT_WORKERS, mode=MODE_STREAM, memory_limit=DEFAULT_MEMORY_LIMIT, resume=False,
+                 paper_workers=DEFAULT_PAPER_WORKERS, image_preset=None):
         super().__init__()
         self.papers = papers
+        self.workers = workers  # 单篇论文同时请求的页数
+        self.mode = mode  # MODE_STREAM 或 MODE_DISK
+        self.memory_limit = memory_limit  # 写PDF时内存中最多保留的图片字节数
+        self.resume = resume  # 断点续传
+        self.paper_workers = paper_workers  # 同时下载的论文篇数
+        self.image_preset = image_preset  # 图片压缩方式，None为保持原图
+        self.engine = None  # MODE_ASYNC 时的AsyncEngine
     
-    def download_jpg_with_progress(self, url: str, jpg_dir: str, paper_idx: int, total_papers: int):
-        """带进度报告的下载函数"""
-        import requests
-        import json
-        import time
-        
-        headers = {
-            'User-Agent':'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.190 Safari/537.36'
-        }
-        result = requests.Session()
-        
-        response = result.get(url, headers=headers, allow_redirects=False)
-        if 'Location' not in response.headers:
-            raise Exception("无法获取重定向地址")
-        
-        url = response.headers['Location']
-        response = result.get(url, headers=headers, allow_redirects=False)
-        if 'Location' not in response.headers:
-            raise Exception("第二次重定向失败")
-        
-        url = response.headers['Location']
-        response = result.get(url, headers=headers, allow_redirects=False)
-        if 'Location' not in response.headers:
-            raise Exception("第三次重定向失败")
-        
-        url_bix = response.headers['Location'].split('?')[1]
-        url = "http://thesis.lib.sjtu.edu.cn:8443/read/jumpServlet?page=1&" + url_bix
-        response = result.get(url, headers=headers, allow_redirects=False)
-        urls = json.loads(response.content.decode())
-        
-        i = 1
-        while True:
-            fig_url = "http://thesis.lib.sjtu.edu.cn:8443/read/" + urls['list'][0]['src'].split('_')[0] + "_{0:05d}".format(i) + ".jpg"
-            response = result.get(fig_url, headers=headers).content
-            rtext = result.get(fig_url, headers=headers).text
-            
-            if 'HTTP状态 404 - 未找到' in result.get(fig_url, headers=headers).text:
-                for t in range(10):
-                    time.sleep(2)
-                    rtext = result.get(fig_url, headers=headers).text
-                    if 'HTTP状态 404 - 未找到' in rtext:
-                        pass
-                    else:
-                        break
-                if 'HTTP状态 404 - 未找到' in rtext:
-                    break
-            
-            while len(response) < 2000:
-                response = result.get(fig_url, headers=headers).content
+    def run(self):
+        if self.mode == MODE_PIPELINE:
+            self.run_pipeline()
+        elif self.mode == MODE_ASYNC and not self.resume:
+            self.run_async()
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.paper_workers, MAX_PAPER_WORKERS))) as pool:
+                list(pool.map(self.download_one, range(1, len(self.papers) + 1), self.papers))
+        
+        self.log_signal.emit("连接池: " + format_pool_stats())
+        self.log_signal.emit("解析缓存: " + format_resolver_stats(get_resolver_cache().stats()))
+        self.log_signal.emit("各阶段统计:\n" + metrics.summary())
+        metrics.write_snapshot()
+        self.finished_signal.emit()
+    
+    def cancel(self):
+        """取消协程引擎中的下载，其他方式不支持取消"""
+        if self.engine is not None:
+            self.engine.cancel()
+    
+    def paper_callbacks(self):
+        """跳过已存在的论文，返回 (待下载论文, on_page(论文, 已完成页数, 总页数), on_finished(论文, 统计信息, 异常))"""
+        total = len(self.papers)
+        index = {id(paper): idx for idx, paper in enumerate(self.papers, 1)}
+        todo = []
+        for idx, paper in enumerate(self.papers, 1):
+            if verify_name(make_paper_filename(paper)):
+                self.progress_signal.emit(f"[{idx}/{total}] 论文已存在: {paper['filename']}")
+            else:
+                todo.append(paper)
+        
+        def on_page(paper, done, pages):
+            self.page_progress_signal.emit(index[id(paper)], total, done, pages)
+        
+        def on_finished(paper, stats, error):
+            idx = index[id(paper)]
+            if error is not None:
+                self.error_signal.emit(f"[{idx}/{total}] ✗ 错误: {paper['filename']} - {str(error)}")
+            else:
+                retry_text = f"，重试 {format_retries(stats['retries'])}" if stats['retries'] else ""
+                self.progress_signal.emit(f"[{idx}/{total}] ✓ 完成: {paper['filename']}（{stats['pages']} 页{retry_text}）")
+        
+        return todo, on_page, on_finished
+    
+    def run_pipeline(self):
+        """下载与合并流水线：合并在独立进程中进行，同时继续下载下一篇"""
+        todo, on_page, on_merged = self.paper_callbacks()
+        pipeline_download(todo, workers=self.workers, resume=self.resume, paper_workers=self.paper_workers,
+                          memory_limit=self.memory_limit, on_page=on_page, on_merged=on_merged,
+                          image_preset=self.image_preset)
+    
+    def run_async(self):
+        """协程引擎：在本线程中运行事件循环，所有论文的页面请求都在这一个线程中并发"""
+        todo, on_page, on_finished = self.paper_callbacks()
+        self.engine = AsyncEngine(workers=self.workers)
+        try:
+            self.engine.run(self.engine.download_papers, todo, paper_workers=self.paper_workers, on_page=on_page,
+                            on_done=on_finished, memory_limit=self.memory_limit, image_preset=self.image_preset)
+        except asyncio.CancelledError:
+            self.progress_signal.emit("下载已取消")
+    
+    def download_one(self, idx, paper):
+        """下载单篇论文，在线程池中运行"""
+        try:
+            paper_filename = make_paper_filename(paper)
             
-            with open(f'./{jpg_dir}/{i}.jpg', 'wb') as f:
-                f.write(response)
+            if verify_name(paper_filename):
+                self.progress_signal.emit(f"[{idx}/{len(self.papers)}] 论文已存在: {paper['filename']}")
+                return
             
+            self.progress_signal.emit(f"[{idx}/{len(self.papers)}] 正在下载: {paper['filename']}")
             # 发送页码进度信号
-            self.page_progress_signal.emit(paper_idx, total_papers, i)
-            i = i + 1
-        
+            stats = download_paper(paper, workers=self.workers, mode=self.mode, memory_limit=self.memory_limit, resume=self.resume,
+                                   image_preset=self.image_preset,
+                                   on_page=lambda done, total: self.page_progress_signal.emit(idx, len(self.papers), done, total))
+            memory_text = f"，内存 {stats['rss_mb']:.0f} MB" if stats['rss_mb'] is not None else ""
+            retry_text = f"，重试 {format_retries(stats['retries'])}" if stats['retries'] else ""
+            self.progress_signal.emit(f"[{idx}/{len(self.papers)}] ✓ 完成: {paper['filename']}（{stats['pages']} 页{memory_text}{retry_text}）")
+            
+        except Exception as e:
+            self.error_signal.emit(f"[{idx}/{len(self.papers)}] ✗ 错误: {paper['filename']} - {str(e)}")
+
+
+class PaperTableModel(QAbstractTableModel):
+    """检索结果表格的数据模型：勾选状态保存在模型中，只为可见的行生成显示内容
+        “状态”列在第一次显示时才检查文件是否存在，并缓存结果
+    """
+    selection_changed = Signal(int)  # 选中的篇数
+    
+    COLUMNS = (('选择', None), ('题名', 'filename'), ('作者', 'author'), ('导师', 'mentor'), ('年份', 'year'), ('状态', None))
+    CHECK_COLUMN = 0
+    STATUS_COLUMN = 5
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.papers = []
+        self.checked = []
+        self.checked_count = 0
+        self.status = {}  # 行号 -> 是否已下载
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.papers)
+    
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+    
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section][0]
+        return super().headerData(section, orientation, role)
+    
+    def flags(self, index):
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() == self.CHECK_COLUMN:
+            flags |= Qt.ItemIsUserCheckable
+        return flags
+    
+    def is_downloaded(self, row):
+        if row not in self.status:
+            self.status[row] = verify_name(make_paper_filename(self.papers[row]))
+        return self.status[row]
+    
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, column = index.row(), index.column()
+        field = self.COLUMNS[column][1]
+        if column == self.CHECK_COLUMN:
+            if role == Qt.CheckStateRole:
+                return Qt.Checked if self.checked[row] else Qt.Unchecked
+            return None
+        if column == self.STATUS_COLUMN:
+            if role == Qt.DisplayRole:
+                return "已存在" if self.is_downloaded(row) else "未下载"
+            if role == Qt.ForegroundRole and self.is_downloaded(row):
+                return QColor(Qt.green)
+            return None
+        if role in (Qt.DisplayRole, Qt.ToolTipRole):
+            return self.papers[row][field]
+        return None
+    
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or index.column() != self.CHECK_COLUMN:
+            return False
+        self.set_checked([index.row()], Qt.CheckState(value) == Qt.Checked)
+        return True
+    
+    def set_papers(self, papers):
+        """替换全部数据，清空勾选"""
+        self.beginResetModel()
+        self.papers = list(papers)
+        self.checked = [False] * len(self.papers)
+        self.checked_count = 0
+        self.status = {}
+        self.endResetModel()
+        self.selection_changed.emit(0)
+    
+    def append_papers(self, papers):
+        """在末尾追加论文，已有的勾选不变"""
+        if not papers:
+            return
+        first = len(self.papers)
+        self.beginInsertRows(QModelIndex(), first, first + len(papers) - 1)
+        self.papers.extend(papers)
+        self.checked.extend([False] * len(papers))
+        self.endInsertRows()
+    
+    def set_checked(self, rows, checked):
+        """勾选或取消勾选若干行"""
+        changed = [row for row in rows if self.checked[row] != checked]
+        if not changed:
+            return
+        for row in changed:
+            self.checked[row] = checked
+        self.checked_count += len(changed) if checked else -len(changed)
+        self.dataChanged.emit(self.index(min(changed), self.CHECK_COLUMN), self.index(max(changed), self.CHECK_COLUMN),
+                              [Qt.CheckStateRole])
+        self.selection_changed.emit(self.checked_count)
+    
+    def set_all_checked(self, checked):
+        self.set_checked(range(len(self.papers)), checked)
+    
+    def checked_papers(self):
+        return [paper for paper, checked in zip(self.papers, self.checked) if checked]
+    
+    def refresh_status(self):
+        """下载完成后重新检查“状态”列"""
+        self.status = {}
+        if self.papers:
+            self.dataChanged.emit(self.index(0, self.STATUS_COLUMN), self.index(len(self.papers) - 1, self.STATUS_COLUMN))
+
+
+class SearchThread(QThread):
+    """在后台执行检索：先查本地目录，再抓取第1页，结果不多时继续并发抓取其余页面
+        新的检索开始时调用cancel()，尚未开始的页面请求会被取消
+    """
+    first_page_signal = Signal(int, object, int, int)  # (检索序号, 第1页论文, 总记录数, 总页数)
+    page_signal = Signal(int, int, object, int, int)  # (检索序号, 页码, 该页论文, 已完成页数, 总页数)
+    finished_signal = Signal(int, object, bool)  # (检索序号, 全部论文或None, 是否来自本地目录)
+    error_signal = Signal(int, str)  # (检索序号, 错误信息)
+    
+    def __init__(self, generation, info_url, harvest_max_pages=HARVEST_MAX_PAGES):
+        super().__init__()
+        self.generation = generation
+        self.info_url = info_url
+        self.harvest_max_pages = harvest_max_pages  # 总页数不超过该值时抓取全部页面
+        self.cancelled = False
+    
+    def cancel(self):
+        self.cancelled = True
+    
     def run(self):
-        jpg_dir = "tmpjpgs"
-        for idx, paper in enumerate(self.papers, 1):
+        try:
+            local_papers = get_catalog().search_url(self.info_url)
+            if local_papers is not None:
+                # 最近完整抓取过该检索，直接使用本地目录，不访问网站
+                self.finished_signal.emit(self.generation, local_papers, True)
+                return
+            
+            papers, total_count, total_pages = download_main_info(self.info_url, [1])
+            if self.cancelled:
+                return
+            self.first_page_signal.emit(self.generation, papers, total_count, total_pages)
+            if total_count == 0 or total_pages > self.harvest_max_pages:
+                self.finished_signal.emit(self.generation, None, False)
+                return
+            
+            # 并发抓取其余页面，第1页直接复用
+            pages = {}
+            harvest = harvest_results(self.info_url, first=(papers, total_count))
             try:
-                paper_filename = f"{paper['year']}_{paper['filename']}_{paper['author']}_{paper['mentor']}.pdf"
-                
-                if verify_name(paper_filename):
-                    self.progress_signal.emit(f"[{idx}/{len(self.papers)}] 论文已存在: {paper['filename']}")
-                    continue
-                
-                self.progress_signal.emit(f"[{idx}/{len(self.papers)}] 正在下载: {paper['filename']}")
-                init(jpg_dir=jpg_dir)
-                self.download_jpg_with_progress(paper['link'], jpg_dir, idx, len(self.papers))
-                merge_pdf(paper_filename, jpg_dir=jpg_dir)
-                self.progress_signal.emit(f"[{idx}/{len(self.papers)}] ✓ 完成: {paper['filename']}")
-                
-            except Exception as e:
-                self.error_signal.emit(f"[{idx}/{len(self.papers)}] ✗ 错误: {paper['filename']} - {str(e)}")
-        
-        self.finished_signal.emit()
+                for page, page_papers, _ in harvest:
+                    if self.cancelled:
+                        return
+                    pages[page] = page_papers
+                    self.page_signal.emit(self.generation, page, page_papers, len(pages), total_pages)
+            finally:
+                harvest.close()
+            self.finished_signal.emit(self.generation, [paper for p in sorted(pages) for paper in pages[p]], False)
+        except Exception as e:
+            if not self.cancelled:
+                self.error_signal.emit(self.generation, str(e))
+
+
+class PageLoadThread(QThread):
+    """在后台加载一页检索结果，避免翻页时阻塞UI"""
+    loaded_signal = Signal(int, int, object)  # (检索序号, 页码, 论文列表)
+    error_signal = Signal(int, int, str)  # (检索序号, 页码, 错误信息)
+    
+    def __init__(self, generation, info_url, page, pending=None):
+        super().__init__()
+        self.generation = generation  # 发起时的检索序号，检索条件变化后结果作废
+        self.info_url = info_url
+        self.page = page
+        self.pending = pending  # 正在预取该页的Future
+    
+    def run(self):
+        try:
+            if self.pending is not None:
+                papers = self.pending.result()[0]
+            else:
+                papers, _, _ = download_main_info(self.info_url, [self.page])
+            self.loaded_signal.emit(self.generation, self.page, papers)
+        except Exception as e:
+            self.error_signal.emit(self.generation, self.page, str(e))
 
 
 class MainWindow(QMainWindow):
@@ -120,12 +333,19 @@ class MainWindow(QMainWindow):
         super().__init__()
         self.papers = []  # 当前页显示的论文
         self.all_papers_cache = []  # 缓存所有论文数据
+        self.harvested_pages = {}  # 后台抓取中已到达的服务器页 页码 -> 论文列表
         self.selected_papers = []
         self.current_page = 1
         self.total_pages = 0
         self.total_count = 0
         self.current_search_url = ""
         self.page_size = 20  # 每页显示篇数
+        self.search_generation = 0  # 每次检索加1，用于丢弃旧检索的加载结果
+        self.load_threads = []  # 正在运行的翻页线程
+        self.search_thread = None  # 当前的检索线程
+        self.search_threads = []  # 正在运行的检索线程（包括已取消的）
+        self.download_thread = None  # 当前的下载线程
+        self.prefetcher = ResultPrefetcher()
         self.init_ui()
         
     def init_ui(self):
@@ -164,6 +384,13 @@ class MainWindow(QMainWindow):
         self.sort_combo.currentIndexChanged.connect(self.on_sort_changed)  # 连接排序变化信号
         result_header_layout.addWidget(self.sort_combo)
         
+        # 在当前结果中筛选（题名、作者、导师、年份）
+        self.filter_input = QLineEdit()
+        self.filter_input.setPlaceholderText("筛选当前结果")
+        self.filter_input.setMaximumWidth(150)
+        self.filter_input.textChanged.connect(self.proxy_model.setFilterFixedString)
+        result_header_layout.addWidget(self.filter_input)
+        
         # 添加弹性空间，让右侧内容靠右
         result_header_layout.addStretch()
         
@@ -177,6 +404,14 @@ class MainWindow(QMainWindow):
         result_header_layout.addWidget(self.page_size_input)
         result_header_layout.addWidget(QLabel("篇"))
         
+        # 预取前后页数
+        result_header_layout.addWidget(QLabel("预取:"))
+        self.prefetch_spin = QSpinBox()
+        self.prefetch_spin.setRange(0, 5)
+        self.prefetch_spin.setValue(DEFAULT_PREFETCH_DEPTH)
+        self.prefetch_spin.setToolTip("在后台预先加载当前页前后的页数，翻页时无需等待；0为不预取")
+        result_header_layout.addWidget(self.prefetch_spin)
+        
         # 页码导航（靠右）
         self.prev_page_btn = QPushButton("◀")
         self.prev_page_btn.setMaximumWidth(30)
@@ -219,9 +454,52 @@ class MainWindow(QMainWindow):
         self.download_btn.clicked.connect(self.download_papers)
         self.download_btn.setEnabled(False)
         
+        # 并发页数
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, MAX_WORKERS)
+        self.workers_spin.setValue(DEFAULT_WORKERS)
+        self.workers_spin.setToolTip("单篇论文同时下载的页数，过高可能被网站限制")
+        
         download_layout.addWidget(self.select_all_btn)
         download_layout.addWidget(self.selected_count_label)
         download_layout.addStretch()
+        # 断点续传
+        self.resume_checkbox = QCheckBox("断点续传")
+        self.resume_checkbox.setToolTip("下载中断后再次下载时，只获取缺失的页面")
+        
+        # 同时下载的论文篇数
+        self.paper_workers_spin = QSpinBox()
+        self.paper_workers_spin.setRange(1, MAX_PAPER_WORKERS)
+        self.paper_workers_spin.setValue(DEFAULT_PAPER_WORKERS)
+        self.paper_workers_spin.setToolTip("同时下载的论文篇数")
+        
+        # 写入方式
+        self.mode_combo = QComboBox()
+        self.mode_combo.addItem("直接写入PDF", MODE_STREAM)
+        self.mode_combo.addItem("下载与合并并行", MODE_PIPELINE)
+        self.mode_combo.addItem("临时文件夹（调试）", MODE_DISK)
+        if AIOHTTP_AVAILABLE:
+            self.mode_combo.addItem("协程引擎", MODE_ASYNC)
+        self.mode_combo.setToolTip("\"下载与合并并行\"在下载下一篇的同时，在独立进程中合并上一篇；"
+                                   "\"协程引擎\"在一个线程中同时下载多篇论文（需要aiohttp）")
+        self.mode_combo.currentIndexChanged.connect(self.on_mode_changed)
+        
+        # 图片压缩
+        self.image_preset_combo = QComboBox()
+        self.image_preset_combo.addItem("原图", PRESET_ORIGINAL)
+        self.image_preset_combo.addItem("高质量压缩", 'high')
+        self.image_preset_combo.addItem("均衡压缩", 'balanced')
+        self.image_preset_combo.addItem("最小体积", 'small')
+        self.image_preset_combo.setToolTip("写入PDF前缩小图片分辨率，黑白页面转为灰度或二值图，"
+                                           "在多个进程中处理，会占用较多CPU")
+        
+        download_layout.addWidget(self.mode_combo)
+        download_layout.addWidget(self.image_preset_combo)
+        download_layout.addWidget(self.resume_checkbox)
+        download_layout.addWidget(QLabel("并发:"))
+        download_layout.addWidget(self.workers_spin)
+        download_layout.addWidget(QLabel("同时下载:"))
+        download_layout.addWidget(self.paper_workers_spin)
         download_layout.addWidget(self.download_btn)
         main_layout.addLayout(download_layout)
         
@@ -235,6 +513,13 @@ class MainWindow(QMainWindow):
         self.progress_bar.setTextVisible(True)  # 显示文本
         main_layout.addWidget(self.progress_bar)
         
+        # 当前论文的页码进度条
+        self.page_progress_bar = QProgressBar()
+        self.page_progress_bar.setTextVisible(True)
+        self.page_progress_bar.setFormat("%v/%m 页")
+        self.page_progress_bar.setValue(0)
+        main_layout.addWidget(self.page_progress_bar)
+        
         # 日志输出区域（可折叠）
         log_header_layout = QHBoxLayout()
         self.log_toggle_btn = QPushButton("▼ 下载日志")
@@ -288,10 +573,21 @@ class MainWindow(QMainWindow):
         return group
         
     def create_result_table(self):
-        """创建结果表格"""
-        self.result_table = QTableWidget()
-        self.result_table.setColumnCount(6)
-        self.result_table.setHorizontalHeaderLabels(['选择', '题名', '作者', '导师', '年份', '状态'])
+        """创建结果表格：数据和勾选状态在模型中，表头点击排序，通过代理模型筛选"""
+        self.paper_model = PaperTableModel(self)
+        self.paper_model.selection_changed.connect(self.update_selected_count)
+        self.proxy_model = QSortFilterProxyModel(self)
+        self.proxy_model.setSourceModel(self.paper_model)
+        self.proxy_model.setFilterKeyColumn(-1)  # 在所有列中筛选
+        self.proxy_model.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        
+        self.result_table = QTableView()
+        self.result_table.setModel(self.proxy_model)
+        # 默认不排序，保持网站的顺序
+        self.result_table.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.result_table.setSortingEnabled(True)
+        self.result_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.result_table.verticalHeader().setDefaultSectionSize(24)
         
         # 设置列宽
         header = self.result_table.horizontalHeader()
@@ -303,7 +599,7 @@ class MainWindow(QMainWindow):
         header.setSectionResizeMode(5, QHeaderView.ResizeToContents)
         
     def search_papers(self):
-        """搜索论文"""
+        """搜索论文：在后台线程中检索，第1页到达后立即显示，其余页面陆续缓存"""
         keyword = self.keyword_input.text().strip()
         if not keyword:
             QMessageBox.warning(self, "警告", "请输入检索词")
@@ -333,120 +629,137 @@ class MainWindow(QMainWindow):
         
         self.current_search_url = f"http://thesis.lib.sjtu.edu.cn/sub.asp?content={quote(keyword)}&choose_key={choose_key}&xuewei={degree}&px={sort}&page="
         self.current_page = page
+        # 检索条件变化，取消旧检索和它的预取，正在进行的翻页结果作废
+        self.search_generation += 1
+        self.prefetcher.reset(self.current_search_url)
+        if self.search_thread is not None:
+            self.search_thread.cancel()
+        self.all_papers_cache = []
+        self.harvested_pages = {}
+        self.prev_page_btn.setEnabled(False)
+        self.next_page_btn.setEnabled(False)
         
         self.log_text.append(f"搜索URL: {self.current_search_url}{page}")
         
-        try:
-            # 首次搜索，获取第一页数据以获取总页数
-            first_page_papers, self.total_count, self.total_pages = download_main_info(self.current_search_url, [1])
-            
-            # 更新页码显示
-            if self.total_pages == 0:
-                self.total_pages = 1
-            self.page_label.setText(f"/ {self.total_pages}")
-            
-            if self.total_count > 0:
-                self.log_text.append(f"✓ 搜索完成，共找到 {self.total_count} 条记录，共 {self.total_pages} 页")
-                
-                # 如果总页数较少（比如小于等于10页），一次性获取所有数据
-                if self.total_pages <= 10:
-                    self.log_text.append(f"正在缓存所有 {self.total_pages} 页数据...")
-                    self.all_papers_cache = []
-                    for p in range(1, self.total_pages + 1):
-                        page_papers, _, _ = download_main_info(self.current_search_url, [p])
-                        self.all_papers_cache.extend(page_papers)
-                        self.log_text.append(f"已缓存第 {p}/{self.total_pages} 页")
-                    self.log_text.append(f"✓ 缓存完成，共 {len(self.all_papers_cache)} 篇论文")
-                    
-                    # 重新计算基于自定义每页篇数的总页数
-                    self.total_pages = (len(self.all_papers_cache) + self.page_size - 1) // self.page_size
-                    self.page_label.setText(f"/ {self.total_pages}")
-                else:
-                    # 总页数较多，不缓存，每次请求
-                    self.log_text.append("ℹ 由于总页数较多，将按需加载")
-                    self.all_papers_cache = []  # 清空缓存
-            else:
-                self.log_text.append(f"✓ 搜索完成，找到 {len(first_page_papers)} 篇论文")
-                self.all_papers_cache = []  # 清空缓存
-            
-            # 显示当前页
-            if page == 1 or not self.all_papers_cache:
-                self.papers = first_page_papers
+        thread = SearchThread(self.search_generation, self.current_search_url)
+        thread.first_page_signal.connect(self.on_search_first_page)
+        thread.page_signal.connect(self.on_search_page)
+        thread.finished_signal.connect(self.on_search_finished)
+        thread.error_signal.connect(self.on_search_error)
+        self.search_thread = thread
+        # 保留线程对象直到运行结束
+        self.search_threads = [t for t in self.search_threads if not t.isFinished()]
+        self.search_threads.append(thread)
+        thread.start()
+    
+    @Slot(int, object, int, int)
+    def on_search_first_page(self, generation, first_page_papers, total_count, total_pages):
+        """第1页到达：更新总数和页码，立即显示"""
+        if generation != self.search_generation:
+            return
+        self.total_count = total_count
+        self.total_pages = max(1, total_pages)
+        self.current_page = min(self.current_page, self.total_pages)
+        self.page_label.setText(f"/ {self.total_pages}")
+        self.page_input.setText(str(self.current_page))
+        
+        if total_count > 0:
+            self.log_text.append(f"✓ 搜索完成，共找到 {total_count} 条记录，共 {self.total_pages} 页")
+            if total_pages <= HARVEST_MAX_PAGES:
+                self.log_text.append(f"正在后台缓存所有 {total_pages} 页数据...")
             else:
-                # 从缓存中获取
-                start_idx = (page - 1) * self.page_size
-                end_idx = min(start_idx + self.page_size, len(self.all_papers_cache))
-                self.papers = self.all_papers_cache[start_idx:end_idx]
-            
-            self.page_input.setText(str(self.current_page))
+                # 总页数较多，不缓存，每次请求
+                self.log_text.append("ℹ 由于总页数较多，将按需加载")
+        else:
+            self.log_text.append(f"✓ 搜索完成，找到 {len(first_page_papers)} 篇论文")
+        
+        if self.current_page == 1:
+            self.show_page(first_page_papers)
+            self.prefetch_adjacent()
+        else:
+            self.load_page()
+    
+    @Slot(int, int, object, int, int)
+    def on_search_page(self, generation, page, page_papers, done, total_pages):
+        if generation != self.search_generation:
+            return
+        self.harvested_pages[page] = page_papers
+        self.log_text.append(f"已缓存第 {page}/{total_pages} 页（{done}/{total_pages}）")
+        self.extend_current_page()
+    
+    def extend_current_page(self):
+        """边抓取边显示：当前页还没有填满时，把已经按顺序到达的论文追加到表格，不影响已有的勾选"""
+        rows = []
+        page = 1
+        while page in self.harvested_pages:
+            rows.extend(self.harvested_pages[page])
+            page += 1
+        start = (self.current_page - 1) * self.page_size
+        shown = len(self.papers)
+        # 表格显示的是其他来源（例如按需加载的服务器页）时不追加
+        if [p['link'] for p in self.papers] != [p['link'] for p in rows[start:start + shown]]:
+            return
+        new_papers = rows[start + shown:start + self.page_size]
+        if not new_papers:
+            return
+        self.papers = self.papers + new_papers
+        self.paper_model.append_papers(new_papers)
+        # 追加的行没有勾选，按钮重新显示“全选”，点击时把新行一起勾选
+        self.select_all_btn.setText("全选")
+        self.download_btn.setEnabled(True)
+    
+    @Slot(int, object, bool)
+    def on_search_finished(self, generation, all_papers, from_catalog):
+        """全部页面缓存完成（或来自本地目录）后改为在本地分页"""
+        if generation != self.search_generation or all_papers is None:
+            return
+        self.all_papers_cache = all_papers
+        if from_catalog:
+            self.total_count = len(all_papers)
+            self.log_text.append(f"✓ 本地目录中找到 {self.total_count} 条记录")
+        else:
+            self.log_text.append(f"✓ 缓存完成，共 {len(all_papers)} 篇论文")
+        
+        # 重新计算基于自定义每页篇数的总页数
+        self.total_pages = max(1, (len(all_papers) + self.page_size - 1) // self.page_size)
+        self.current_page = min(self.current_page, self.total_pages)
+        self.page_label.setText(f"/ {self.total_pages}")
+        self.page_input.setText(str(self.current_page))
+        start = (self.current_page - 1) * self.page_size
+        shown = [p['link'] for p in self.papers]
+        if from_catalog or shown != [p['link'] for p in all_papers[start:start + self.page_size]]:
+            # 本地目录的结果还没有显示过；当前页没有在抓取过程中填满时按本地分页重新显示
+            self.load_page()
+        else:
             self.prev_page_btn.setEnabled(self.current_page > 1)
             self.next_page_btn.setEnabled(self.current_page < self.total_pages)
-            
-            self.display_papers()
-            
-            if self.papers:
-                self.download_btn.setEnabled(True)
-        except Exception as e:
-            self.log_text.append(f"✗ 搜索失败: {str(e)}")
-            QMessageBox.critical(self, "错误", f"搜索失败: {str(e)}")
-            
+    
+    @Slot(int, str)
+    def on_search_error(self, generation, message):
+        if generation != self.search_generation:
+            return
+        self.log_text.append(f"✗ 搜索失败: {message}")
+        QMessageBox.critical(self, "错误", f"搜索失败: {message}")
+        
     def display_papers(self):
         """显示搜索结果"""
-        self.result_table.setRowCount(len(self.papers))
-        
-        for row, paper in enumerate(self.papers):
-            # 复选框
-            checkbox = QCheckBox()
-            checkbox.setChecked(False)  # 默认不选中
-            checkbox.stateChanged.connect(self.update_selected_count)  # 连接信号
-            checkbox_widget = QWidget()
-            checkbox_layout = QHBoxLayout(checkbox_widget)
-            checkbox_layout.addWidget(checkbox)
-            checkbox_layout.setAlignment(Qt.AlignCenter)
-            checkbox_layout.setContentsMargins(0, 0, 0, 0)
-            self.result_table.setCellWidget(row, 0, checkbox_widget)
-            
-            # 其他信息
-            self.result_table.setItem(row, 1, QTableWidgetItem(paper['filename']))
-            self.result_table.setItem(row, 2, QTableWidgetItem(paper['author']))
-            self.result_table.setItem(row, 3, QTableWidgetItem(paper['mentor']))
-            self.result_table.setItem(row, 4, QTableWidgetItem(paper['year']))
-            
-            # 检查文件是否已存在
-            paper_filename = f"{paper['year']}_{paper['filename']}_{paper['author']}_{paper['mentor']}.pdf"
-            status = "已存在" if verify_name(paper_filename) else "未下载"
-            status_item = QTableWidgetItem(status)
-            if status == "已存在":
-                status_item.setForeground(Qt.green)
-            self.result_table.setItem(row, 5, status_item)
-        
-        # 更新选中计数
-        self.update_selected_count()
+        self.paper_model.set_papers(self.papers)
+        self.select_all_btn.setText("全选")
             
     def select_all(self):
-        """全选/取消全选"""
+        """全选/取消全选，全选只勾选筛选后可见的行"""
         if self.select_all_btn.text() == "全选":
-            for row in range(self.result_table.rowCount()):
-                checkbox_widget = self.result_table.cellWidget(row, 0)
-                checkbox = checkbox_widget.findChild(QCheckBox)
-                checkbox.setChecked(True)
+            rows = [self.proxy_model.mapToSource(self.proxy_model.index(row, 0)).row()
+                    for row in range(self.proxy_model.rowCount())]
+            self.paper_model.set_checked(rows, True)
             self.select_all_btn.setText("取消全选")
         else:
-            for row in range(self.result_table.rowCount()):
-                checkbox_widget = self.result_table.cellWidget(row, 0)
-                checkbox = checkbox_widget.findChild(QCheckBox)
-                checkbox.setChecked(False)
+            self.paper_model.set_all_checked(False)
             self.select_all_btn.setText("全选")
-        self.update_selected_count()
             
     def download_papers(self):
         """下载选中的论文"""
-        selected_papers = []
-        for row in range(self.result_table.rowCount()):
-            checkbox_widget = self.result_table.cellWidget(row, 0)
-            checkbox = checkbox_widget.findChild(QCheckBox)
-            if checkbox.isChecked():
-                selected_papers.append(self.papers[row])
+        selected_papers = self.paper_model.checked_papers()
         
         if not selected_papers:
             QMessageBox.warning(self, "警告", "请至少选择一篇论文")
@@ -467,8 +780,13 @@ class MainWindow(QMainWindow):
         self.download_status_label.setStyleSheet("QLabel { color: #2196F3; padding: 5px; }")
         
         # 创建并启动下载线程
-        self.download_thread = DownloadThread(selected_papers)
+        self.download_thread = DownloadThread(selected_papers, workers=self.workers_spin.value(),
+                                              mode=self.mode_combo.currentData(),
+                                              resume=self.resume_checkbox.isChecked(),
+                                              paper_workers=self.paper_workers_spin.value(),
+                                              image_preset=self.image_preset_combo.currentData())
         self.download_thread.progress_signal.connect(self.update_progress)
+        self.download_thread.log_signal.connect(self.log_text.append)
         self.download_thread.page_progress_signal.connect(self.update_page_progress)
         self.download_thread.error_signal.connect(self.update_error)
         self.download_thread.finished_signal.connect(self.download_finished)
@@ -527,8 +845,8 @@ class MainWindow(QMainWindow):
                 QMessageBox.warning(self, "警告", "每页篇数必须大于0")
                 self.page_size_input.setText(str(self.page_size))
                 return
-            if new_page_size > 100:
-                QMessageBox.warning(self, "警告", "每页篇数不能超过100")
+            if new_page_size > MAX_PAGE_SIZE:
+                QMessageBox.warning(self, "警告", f"每页篇数不能超过{MAX_PAGE_SIZE}")
                 self.page_size_input.setText(str(self.page_size))
                 return
             
@@ -567,41 +885,81 @@ class MainWindow(QMainWindow):
     
     def load_page(self):
         """加载指定页的内容"""
-        try:
-            # 如果有缓存，从缓存中读取
-            if self.all_papers_cache:
-                self.log_text.append(f"从缓存加载第 {self.current_page} 页...")
-                start_idx = (self.current_page - 1) * self.page_size
-                end_idx = min(start_idx + self.page_size, len(self.all_papers_cache))
-                self.papers = self.all_papers_cache[start_idx:end_idx]
-            else:
-                # 没有缓存，从服务器请求（网站固定每页20条）
-                self.log_text.append(f"正在加载第 {self.current_page} 页...")
-                self.papers, _, _ = download_main_info(self.current_search_url, [self.current_page])
-            
-            # 更新页码按钮状态
-            self.prev_page_btn.setEnabled(self.current_page > 1)
-            self.next_page_btn.setEnabled(self.current_page < self.total_pages)
-            
-            self.display_papers()
-            self.log_text.append(f"✓ 第 {self.current_page} 页加载完成，显示 {len(self.papers)} 篇论文")
-            
-            if self.papers:
-                self.download_btn.setEnabled(True)
-        except Exception as e:
-            self.log_text.append(f"✗ 加载失败: {str(e)}")
-            QMessageBox.critical(self, "错误", f"加载页面失败: {str(e)}")
+        # 如果有缓存，从缓存中读取
+        if self.all_papers_cache:
+            self.log_text.append(f"从缓存加载第 {self.current_page} 页...")
+            start_idx = (self.current_page - 1) * self.page_size
+            end_idx = min(start_idx + self.page_size, len(self.all_papers_cache))
+            self.show_page(self.all_papers_cache[start_idx:end_idx])
+            return
+        
+        # 没有缓存，在后台线程中从服务器请求（网站固定每页20条），已预取的页面直接从检索结果缓存读取
+        self.log_text.append(f"正在加载第 {self.current_page} 页...")
+        thread = PageLoadThread(self.search_generation, self.current_search_url, self.current_page,
+                                pending=self.prefetcher.pending(self.current_search_url, self.current_page))
+        thread.loaded_signal.connect(self.on_page_loaded)
+        thread.error_signal.connect(self.on_page_load_error)
+        # 保留线程对象直到运行结束
+        self.load_threads = [t for t in self.load_threads if not t.isFinished()]
+        self.load_threads.append(thread)
+        thread.start()
     
-    def update_selected_count(self):
+    @Slot(int, int, object)
+    def on_page_loaded(self, generation, page, papers):
+        """后台加载完成，只显示当前检索的当前页，用户已翻到别处时丢弃"""
+        if generation != self.search_generation or page != self.current_page:
+            return
+        self.show_page(papers)
+        self.prefetch_adjacent()
+    
+    @Slot(int, int, str)
+    def on_page_load_error(self, generation, page, message):
+        if generation != self.search_generation or page != self.current_page:
+            return
+        self.log_text.append(f"✗ 加载失败: {message}")
+        QMessageBox.critical(self, "错误", f"加载页面失败: {message}")
+    
+    def show_page(self, papers):
+        """显示一页论文并更新页码按钮"""
+        self.papers = papers
+        
+        # 更新页码按钮状态
+        self.prev_page_btn.setEnabled(self.current_page > 1)
+        self.next_page_btn.setEnabled(self.current_page < self.total_pages)
+        
+        self.display_papers()
+        self.log_text.append(f"✓ 第 {self.current_page} 页加载完成，显示 {len(self.papers)} 篇论文")
+        self.log_text.append("检索结果缓存: " + format_cache_stats(get_result_cache().stats()))
+        
+        if self.papers:
+            self.download_btn.setEnabled(True)
+    
+    def prefetch_adjacent(self):
+        """按需加载（结果较多）时，在后台预取当前页前后的服务器页；结果不多时由检索线程抓取全部页面"""
+        depth = self.prefetch_spin.value()
+        if self.all_papers_cache or not self.current_search_url or depth == 0 or self.total_pages <= HARVEST_MAX_PAGES:
+            return
+        self.prefetcher.prefetch(self.current_search_url, self.current_page, self.total_pages, depth)
+    
+    def on_mode_changed(self):
+        """协程引擎可以同时下载更多篇论文"""
+        async_mode = self.mode_combo.currentData() == MODE_ASYNC
+        self.paper_workers_spin.setMaximum(MAX_ASYNC_PAPER_WORKERS if async_mode else MAX_PAPER_WORKERS)
+    
+    def closeEvent(self, event):
+        if self.search_thread is not None:
+            self.search_thread.cancel()
+        if self.download_thread is not None:
+            self.download_thread.cancel()
+        self.prefetcher.shutdown()
+        super().closeEvent(event)
+    
+    @Slot(int)
+    def update_selected_count(self, count):
         """更新选中的论文数量"""
-        count = 0
-        for row in range(self.result_table.rowCount()):
-            checkbox_widget = self.result_table.cellWidget(row, 0)
-            if checkbox_widget:
-                checkbox = checkbox_widget.findChild(QCheckBox)
-                if checkbox and checkbox.isChecked():
-                    count += 1
         self.selected_count_label.setText(f"已选中: {count} 篇")
+        if count == 0:
+            self.select_all_btn.setText("全选")
     
     def toggle_log(self):
         """切换日志显示/隐藏"""
@@ -628,10 +986,15 @@ class MainWindow(QMainWindow):
             # 更新进度条文本
             self.progress_bar.setFormat(f"{current + 1}/{self.progress_bar.maximum()} - {int((current + 1) / self.progress_bar.maximum() * 100)}%")
     
-    @Slot(int, int, int)
-    def update_page_progress(self, paper_idx, total_papers, page_num):
+    @Slot(int, int, int, int)
+    def update_page_progress(self, paper_idx, total_papers, page_num, total_pages):
         """更新页码进度"""
-        status_text = f"[第{paper_idx}篇/共{total_papers}篇] 正在下载第 {page_num} 页"
+        if total_pages > 0:
+            status_text = f"[第{paper_idx}篇/共{total_papers}篇] 已下载 {page_num}/{total_pages} 页"
+            self.page_progress_bar.setMaximum(max(total_pages, page_num))
+            self.page_progress_bar.setValue(page_num)
+        else:
+            status_text = f"[第{paper_idx}篇/共{total_papers}篇] 正在下载第 {page_num} 页"
         self.download_status_label.setText(status_text)
         self.download_status_label.setStyleSheet("QLabel { color: #2196F3; padding: 5px; }")
     
@@ -659,10 +1022,12 @@ class MainWindow(QMainWindow):
         self.download_btn.setEnabled(True)
         QMessageBox.information(self, "完成", "所有论文下载完成！")
         # 刷新状态
-        self.display_papers()
+        self.paper_model.refresh_status()
 
 
 def main():
+    # 流水线模式在子进程中合并PDF，打包后需要
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     
     # 使用Fusion样式确保跨平台一致性
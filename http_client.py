@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   http_client.py
+@Description    :   所有入口共享的长连接HTTP客户端，复用到 thesis.lib.sjtu.edu.cn 和 :8443 的TCP连接
+'''
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+HEADERS = {
+    'User-Agent':'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.190 Safari/537.36'
+}
+
+# 连接池参数：每个主机最多保留的连接数，与限速器的最大并发一致
+POOL_CONNECTIONS = 4   # 缓存的主机数
+POOL_MAXSIZE = 16      # 每个主机的连接数上限
+# (连接超时, 读取超时)，网站很慢，读取超时放宽
+DEFAULT_TIMEOUT = (10, 60)
+
+
+class PooledAdapter(HTTPAdapter):
+    """为没有指定超时的请求加上默认超时，连接池满时等待而不是新建连接"""
+    def __init__(self, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, timeout=DEFAULT_TIMEOUT):
+    """新建一个配置好连接池的Session，重试由retry.py负责，这里不重试"""
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    session.headers['Connection'] = 'keep-alive'
+    adapter = PooledAdapter(timeout=timeout, pool_connections=pool_connections,
+                            pool_maxsize=pool_maxsize, pool_block=True, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """进程内共享的Session，第一次调用时创建"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def reset_session():
+    """关闭共享的Session，下次get_session时重新创建"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def pool_stats(session=None):
+    """各主机连接池的复用情况
+        :return: {主机: {'requests': 请求数, 'connections': 新建连接数, 'reused': 复用连接的请求数}}
+    """
+    session = session or _session
+    stats = {}
+    if session is None:
+        return stats
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = '{}:{}'.format(pool.host, pool.port) if pool.port else pool.host
+            entry = stats.setdefault(host, {'requests': 0, 'connections': 0, 'reused': 0})
+            entry['requests'] += pool.num_requests
+            entry['connections'] += pool.num_connections
+            entry['reused'] += max(0, pool.num_requests - pool.num_connections)
+    return stats
+
+
+def format_pool_stats(stats=None):
+    """把连接池统计格式化为一行文字"""
+    stats = pool_stats() if stats is None else stats
+    return '；'.join('{} 请求{}次，新建连接{}个，复用{}次'.format(host, s['requests'], s['connections'], s['reused'])
+                    for host, s in stats.items())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   image_processing.py
+@Description    :   写入PDF前的图片压缩：缩小分辨率，接近灰度的彩色页转为灰度，接近纯黑白的页转为二值图，
+                    再重新编码，在进程池中并行处理
+'''
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import util
+
+import pymupdf
+
+# 进程池大小，默认与CPU核数相同
+DEFAULT_IMAGE_WORKERS = os.cpu_count() or 2
+# 采样多少个像素判断页面类型
+SAMPLE_PIXELS = 20000
+
+
+class ImagePreset:
+    """图片压缩参数
+        :param max_side: 图片长边的最大像素数，超过时等比例缩小，None表示不缩小
+        :param quality: 重新编码JPEG的质量
+        :param grayscale: 彩色像素不超过color_ratio的页面转为灰度
+        :param bilevel: 接近纯黑或纯白的像素不少于bilevel_ratio的页面转为二值图，以threshold为界
+    """
+    def __init__(self, name, max_side, quality, grayscale=True, bilevel=False, color_tolerance=24, color_ratio=0.01,
+                 bilevel_ratio=0.9, threshold=160):
+        self.name = name
+        self.max_side = max_side
+        self.quality = quality
+        self.grayscale = grayscale
+        self.bilevel = bilevel
+        self.color_tolerance = color_tolerance
+        self.color_ratio = color_ratio
+        self.bilevel_ratio = bilevel_ratio
+        self.threshold = threshold
+
+
+PRESET_ORIGINAL = 'original'
+# original 保持网站的原图；high 基本看不出差别；balanced 适合存档；small 体积最小，只适合阅读文字
+PRESETS = {
+    PRESET_ORIGINAL: None,
+    'high': ImagePreset('high', max_side=2400, quality=85),
+    'balanced': ImagePreset('balanced', max_side=1800, quality=70, bilevel=True),
+    'small': ImagePreset('small', max_side=1400, quality=50, bilevel=True, bilevel_ratio=0.8),
+}
+
+
+def get_preset(name):
+    """按名称取压缩参数，original或None返回None（不处理）"""
+    if name is None or isinstance(name, ImagePreset):
+        return name
+    if name not in PRESETS:
+        raise Exception("未知的图片压缩方式: {}，可选 {}".format(name, '/'.join(PRESETS)))
+    return PRESETS[name]
+
+
+def _sample_offsets(pix):
+    """均匀采样的像素起始偏移"""
+    pixels = pix.width * pix.height
+    step = max(1, pixels // SAMPLE_PIXELS)
+    return range(0, pixels * pix.n, step * pix.n)
+
+
+def is_grayscale(pix, preset):
+    """彩色像素（三个通道相差超过color_tolerance）的比例不超过color_ratio"""
+    samples = pix.samples
+    offsets = _sample_offsets(pix)
+    colored = 0
+    for k in offsets:
+        r, g, b = samples[k], samples[k + 1], samples[k + 2]
+        if max(r, g, b) - min(r, g, b) > preset.color_tolerance:
+            colored += 1
+    return colored <= len(offsets) * preset.color_ratio
+
+
+def is_bilevel(pix, preset):
+    """灰度图中接近纯黑（<64）或纯白（>192）的像素不少于bilevel_ratio"""
+    samples = pix.samples
+    offsets = _sample_offsets(pix)
+    extreme = sum(1 for k in offsets if samples[k] < 64 or samples[k] > 192)
+    return extreme >= len(offsets) * preset.bilevel_ratio
+
+
+def binarize(pix, threshold):
+    """灰度图按阈值转为只有0和255两种值的图，插入PDF时MuPDF按1位图保存"""
+    table = bytes(0 if v < threshold else 255 for v in range(256))
+    return pymupdf.Pixmap(pymupdf.csGRAY, pix.width, pix.height, pix.samples.translate(table), False)
+
+
+def process_image(content, preset):
+    """在进程池中运行：压缩一页图片
+        :param content: 原图（jpg）
+        :return: (图片字节, 页面大小(宽, 高), CPU秒数)，页面大小与原图相同，处理后更大时返回原图
+    """
+    start = time.process_time()
+    preset = get_preset(preset)
+    img = pymupdf.open(stream=content, filetype='jpg')
+    rect = img[0].rect
+    img.close()
+    size = (rect.width, rect.height)
+    if preset is None:
+        return content, size, time.process_time() - start
+
+    pix = pymupdf.Pixmap(content)
+    if pix.alpha:
+        pix = pymupdf.Pixmap(pix, 0)
+    if pix.n not in (1, 3):
+        pix = pymupdf.Pixmap(pymupdf.csRGB, pix)
+    if preset.max_side and max(pix.width, pix.height) > preset.max_side:
+        scale = preset.max_side / max(pix.width, pix.height)
+        pix = pymupdf.Pixmap(pix, max(1, int(pix.width * scale)), max(1, int(pix.height * scale)), None)
+    if pix.n == 3 and preset.grayscale and is_grayscale(pix, preset):
+        pix = pymupdf.Pixmap(pymupdf.csGRAY, pix)
+    if pix.n == 1 and preset.bilevel and is_bilevel(pix, preset):
+        output = binarize(pix, preset.threshold).tobytes('png')
+    else:
+        output = pix.tobytes('jpeg', jpg_quality=preset.quality)
+    if len(output) >= len(content):
+        output = content
+    return output, size, time.process_time() - start
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_image_pool(workers=None):
+    """进程内共享的图片处理进程池，第一次调用时创建
+    fork出的子进程不能使用父进程的进程池，会重新创建
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=workers or DEFAULT_IMAGE_WORKERS)
+            _pool_pid = os.getpid()
+            # 合并进程退出时会等待所有子进程，需要在此之前（也在任务队列关闭之前）关闭进程池，否则空闲的图片进程一直等待任务
+            util.Finalize(_pool, _pool.shutdown, exitpriority=100)
+        return _pool
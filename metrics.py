@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   metrics.py
+@Description    :   分阶段计时和统计：每篇论文各阶段的耗时、字节数、请求数和重试次数，
+                    输出为JSON行、Prometheus文本快照，运行结束时打印汇总表
+'''
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+METRICS_DIR = "metrics"
+PAPERS_FILE = "papers.jsonl"     # 每篇论文结束时追加一行
+SNAPSHOT_FILE = "metrics.prom"   # Prometheus文本格式的累计值
+PROM_PREFIX = "sjtu_thesis"
+
+# 阶段名称
+STAGE_HTTP = 'http'                  # 未指定阶段的请求
+STAGE_SEARCH = 'search'              # 请求检索结果页
+STAGE_SEARCH_PARSE = 'search_parse'  # 解析检索结果页
+STAGE_REDIRECT = 'redirect'          # 阅读全文链接的三次重定向
+STAGE_JUMP = 'jump_servlet'          # jumpServlet获取图片地址
+STAGE_PROBE = 'probe'                # HEAD探测总页数
+STAGE_LIMITER = 'limiter_wait'       # 等待限速器放行
+STAGE_PAGE = 'page_fetch'            # 下载单页图片
+STAGE_BACKOFF = 'backoff'            # 重试前的退避等待
+STAGE_JPG_WRITE = 'jpg_write'        # 图片写入临时文件夹
+STAGE_IMAGE = 'image_process'        # 图片压缩处理（进程池中的CPU时间）
+STAGE_PDF_INSERT = 'pdf_insert'      # 图片插入PDF
+STAGE_PDF_SAVE = 'pdf_save'          # 保存PDF（包括增量保存）
+STAGE_MERGE = 'merge_pdf'            # 从图片文件夹合并PDF，包含读取图片、插入和保存
+STAGES = (STAGE_HTTP, STAGE_SEARCH, STAGE_SEARCH_PARSE, STAGE_REDIRECT, STAGE_JUMP, STAGE_PROBE, STAGE_LIMITER, STAGE_PAGE,
+          STAGE_BACKOFF, STAGE_JPG_WRITE, STAGE_IMAGE, STAGE_PDF_INSERT, STAGE_PDF_SAVE, STAGE_MERGE)
+
+# 当前线程（或通过propagate传递到线程池中）正在下载的论文
+_current = contextvars.ContextVar('paper_metrics', default=None)
+
+
+def _new_stage():
+    return {'seconds': 0.0, 'count': 0, 'bytes': 0}
+
+
+class PaperMetrics:
+    """一篇论文各阶段的统计，下载线程池中的多个线程同时写入"""
+    def __init__(self, paper_filename):
+        self.paper_filename = paper_filename
+        self.started = time.time()
+        self.start_clock = time.perf_counter()
+        self.seconds = None
+        self.pages = None
+        self.error = None
+        self.stages = defaultdict(_new_stage)
+        self.retries = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, nbytes=0, count=1):
+        with self.lock:
+            entry = self.stages[stage]
+            entry['seconds'] += seconds
+            entry['count'] += count
+            entry['bytes'] += nbytes
+
+    def add_retry(self, kind):
+        with self.lock:
+            self.retries[kind] += 1
+
+    def to_dict(self):
+        with self.lock:
+            stages = {stage: {'seconds': round(s['seconds'], 4), 'count': s['count'], 'bytes': s['bytes']}
+                      for stage, s in self.stages.items()}
+            retries = dict(self.retries)
+        network = (STAGE_SEARCH, STAGE_REDIRECT, STAGE_JUMP, STAGE_PROBE, STAGE_PAGE)
+        return {
+            'paper': self.paper_filename,
+            'started': round(self.started, 3),
+            'seconds': round(self.seconds, 3) if self.seconds is not None else None,
+            'status': 'ok' if self.error is None else 'error',
+            'error': None if self.error is None else str(self.error),
+            'pages': self.pages,
+            'requests': sum(s['count'] for stage, s in stages.items() if stage in network),
+            'bytes': sum(s['bytes'] for stage, s in stages.items() if stage in network),
+            'retries': retries,
+            'stages': stages,
+        }
+
+
+class MetricsRegistry:
+    """进程内所有阶段的累计值，以及已结束论文的记录"""
+    def __init__(self, directory=METRICS_DIR, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = defaultdict(_new_stage)
+            self.retries = defaultdict(int)
+            self.papers = defaultdict(int)  # 状态 -> 篇数
+            self.started = time.time()
+
+    def add(self, stage, seconds, nbytes=0, count=1):
+        with self.lock:
+            entry = self.stages[stage]
+            entry['seconds'] += seconds
+            entry['count'] += count
+            entry['bytes'] += nbytes
+
+    def add_retry(self, kind):
+        with self.lock:
+            self.retries[kind] += 1
+
+    def finish(self, paper_metrics):
+        record = paper_metrics.to_dict()
+        with self.lock:
+            self.papers[record['status']] += 1
+        if self.enabled:
+            self.append_record(record)
+            self.write_snapshot()
+        return record
+
+    def append_record(self, record):
+        os.makedirs(self.directory, exist_ok=True)
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock, open(os.path.join(self.directory, PAPERS_FILE), 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    def snapshot(self):
+        """各阶段累计值的副本 {阶段: {'seconds', 'count', 'bytes'}}"""
+        with self.lock:
+            return {stage: {'seconds': round(s['seconds'], 4), 'count': s['count'], 'bytes': s['bytes']}
+                    for stage, s in self.stages.items()}
+
+    def prometheus(self):
+        """Prometheus文本格式的快照"""
+        with self.lock:
+            stages = {stage: dict(s) for stage, s in self.stages.items()}
+            retries = dict(self.retries)
+            papers = dict(self.papers)
+        lines = []
+
+        def metric(name, help_text, kind, samples):
+            lines.append('# HELP {}_{} {}'.format(PROM_PREFIX, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(PROM_PREFIX, name, kind))
+            for labels, value in samples:
+                lines.append('{}_{}{{{}}} {}'.format(PROM_PREFIX, name, labels, value))
+
+        metric('stage_seconds_total', 'Time spent in each stage.', 'counter',
+               [('stage="{}"'.format(stage), round(s['seconds'], 6)) for stage, s in sorted(stages.items())])
+        metric('stage_events_total', 'Number of timed events (requests, writes) in each stage.', 'counter',
+               [('stage="{}"'.format(stage), s['count']) for stage, s in sorted(stages.items())])
+        metric('stage_bytes_total', 'Bytes transferred or written in each stage.', 'counter',
+               [('stage="{}"'.format(stage), s['bytes']) for stage, s in sorted(stages.items())])
+        metric('retries_total', 'Retries by error kind.', 'counter',
+               [('kind="{}"'.format(kind), n) for kind, n in sorted(retries.items())])
+        metric('papers_total', 'Finished papers by status.', 'counter',
+               [('status="{}"'.format(status), n) for status, n in sorted(papers.items())])
+        return '\n'.join(lines) + '\n'
+
+    def write_snapshot(self):
+        """原子地覆盖写入快照文件，可供node_exporter的textfile收集器读取"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+    def summary(self):
+        """各阶段的汇总表"""
+        with self.lock:
+            stages = {stage: dict(s) for stage, s in self.stages.items()}
+            retries = dict(self.retries)
+            papers = dict(self.papers)
+            elapsed = time.time() - self.started
+        order = [stage for stage in STAGES if stage in stages] + sorted(set(stages) - set(STAGES))
+        lines = ["{:<14}{:>8}{:>12}{:>12}{:>12}".format('阶段', '次数', '总耗时(s)', '平均(ms)', '数据(MB)')]
+        for stage in order:
+            s = stages[stage]
+            mean = s['seconds'] * 1000 / s['count'] if s['count'] else 0
+            lines.append("{:<14}{:>8}{:>12.2f}{:>12.1f}{:>12.2f}".format(
+                stage, s['count'], s['seconds'], mean, s['bytes'] / 1024 / 1024))
+        lines.append("论文: 完成{}篇，失败{}篇；重试: {}；运行{:.1f}秒".format(
+            papers.get('ok', 0), papers.get('error', 0),
+            '，'.join('{} {}次'.format(kind, n) for kind, n in sorted(retries.items())) or '无', elapsed))
+        return '\n'.join(lines)
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry():
+    return _registry
+
+
+def configure(directory=None, enabled=None):
+    """修改输出文件夹，或关闭文件输出（仍然统计）"""
+    if directory is not None:
+        _registry.directory = directory
+    if enabled is not None:
+        _registry.enabled = enabled
+
+
+def record(stage, seconds, nbytes=0, count=1):
+    """记录一次计时，同时计入当前论文"""
+    _registry.add(stage, seconds, nbytes, count)
+    paper_metrics = _current.get()
+    if paper_metrics is not None:
+        paper_metrics.add(stage, seconds, nbytes, count)
+
+
+def record_stages(stages, paper_metrics=None):
+    """计入其他进程中统计的各阶段（PaperMetrics.to_dict()中的stages）"""
+    paper_metrics = paper_metrics or _current.get()
+    for stage, s in stages.items():
+        _registry.add(stage, s['seconds'], s['bytes'], s['count'])
+        if paper_metrics is not None:
+            paper_metrics.add(stage, s['seconds'], s['bytes'], s['count'])
+
+
+def record_retry(kind):
+    _registry.add_retry(kind)
+    paper_metrics = _current.get()
+    if paper_metrics is not None:
+        paper_metrics.add_retry(kind)
+
+
+@contextmanager
+def timed(stage):
+    """对一段代码计时，可以在代码块中设置 sample['bytes']"""
+    sample = {'bytes': 0}
+    start = time.perf_counter()
+    try:
+        yield sample
+    finally:
+        record(stage, time.perf_counter() - start, sample['bytes'])
+
+
+def current_paper():
+    return _current.get()
+
+
+def start_paper(paper_filename):
+    return PaperMetrics(paper_filename)
+
+
+@contextmanager
+def active(paper_metrics):
+    """在代码块中把统计计入paper_metrics"""
+    token = _current.set(paper_metrics)
+    try:
+        yield paper_metrics
+    finally:
+        _current.reset(token)
+
+
+def finish_paper(paper_metrics, error=None):
+    """论文结束（成功或失败），写入JSON行和快照
+        :return: 该论文的记录
+    """
+    paper_metrics.seconds = time.perf_counter() - paper_metrics.start_clock
+    paper_metrics.error = error
+    return _registry.finish(paper_metrics)
+
+
+@contextmanager
+def paper_scope(paper_filename):
+    """统计一篇论文的下载，代码块中抛出异常时记为失败"""
+    paper_metrics = start_paper(paper_filename)
+    with active(paper_metrics):
+        try:
+            yield paper_metrics
+        except BaseException as e:
+            finish_paper(paper_metrics, error=e)
+            raise
+    finish_paper(paper_metrics)
+
+
+def propagate(func):
+    """让提交到线程池的函数继续计入当前论文，每次提交时调用"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+
+def summary():
+    return _registry.summary()
+
+
+def write_snapshot():
+    if _registry.enabled:
+        _registry.write_snapshot()
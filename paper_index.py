@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   paper_index.py
+@Description    :   已下载论文的内存索引：启动时扫描一次papers文件夹，之后通过文件夹的修改时间判断是否需要重新扫描
+'''
+import os
+import threading
+import time
+import unicodedata
+
+PAPERS_DIR = "./papers"
+# 两次检查文件夹修改时间之间的最短间隔（秒），显示大量行时避免每行都stat一次
+CHECK_INTERVAL = 1.0
+PART_SUFFIX = ".part"
+
+
+def normalize_name(paper_filename):
+    """统一为NFC形式，macOS上文件名是分解形式，与网页上的题名不一致"""
+    return unicodedata.normalize('NFC', paper_filename)
+
+
+class PaperIndex:
+    """papers文件夹中已下载论文的文件名集合，查询为O(1)，线程安全
+        文件夹中新增、删除、重命名文件都会改变文件夹的修改时间，检测到变化时重新扫描
+    """
+    def __init__(self, directory=PAPERS_DIR, check_interval=CHECK_INTERVAL):
+        self.directory = directory
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.names = set()
+        self.mtime = None
+        self.checked_at = 0.0
+        self.scans = 0
+
+    def _dir_mtime(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _scan(self, mtime):
+        names = set()
+        if mtime is not None:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    # 未写完的.part文件不算已下载
+                    if not entry.name.endswith(PART_SUFFIX) and entry.is_file():
+                        names.add(normalize_name(entry.name))
+        self.names = names
+        self.mtime = mtime
+        self.scans += 1
+
+    def _sync(self, force=False):
+        now = time.monotonic()
+        if not force and self.mtime is not None and now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        mtime = self._dir_mtime()
+        if force or mtime != self.mtime or self.scans == 0:
+            self._scan(mtime)
+
+    def contains(self, paper_filename):
+        with self.lock:
+            self._sync()
+            return normalize_name(paper_filename) in self.names
+
+    def add(self, paper_filename):
+        """保存论文后调用，不必等到下次扫描"""
+        with self.lock:
+            self.names.add(normalize_name(paper_filename))
+
+    def discard(self, paper_filename):
+        with self.lock:
+            self.names.discard(normalize_name(paper_filename))
+
+    def refresh(self):
+        """强制重新扫描"""
+        with self.lock:
+            self._sync(force=True)
+
+    def __len__(self):
+        with self.lock:
+            self._sync()
+            return len(self.names)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_paper_index(directory=None):
+    """进程内共享的已下载论文索引，第一次调用时扫描"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = PaperIndex(directory or PAPERS_DIR)
+        return _index
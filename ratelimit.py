@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   ratelimit.py
+@Description    :   thesis.lib.sjtu.edu.cn 的共享限速层：令牌桶限制每秒请求数，AIMD 调整并发数
+'''
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# 请求结果，用于调整并发数
+OUTCOME_OK = 'ok'            # 正常响应
+OUTCOME_SHORT = 'short'      # 内容被截断，网站过载的表现
+OUTCOME_ERROR = 'error'      # 错误页面、5xx或连接异常
+OUTCOME_NEUTRAL = 'neutral'  # 不参与调整，例如论文末尾正常的404
+
+# 各个主机的默认参数：检索页面很慢，图片服务器稍快
+HOST_DEFAULTS = {
+    'thesis.lib.sjtu.edu.cn': dict(rate=2.0, burst=2, concurrency=2, max_concurrency=4, slow_latency=8.0),
+    'thesis.lib.sjtu.edu.cn:8443': dict(rate=8.0, burst=8, concurrency=4, max_concurrency=16, slow_latency=5.0),
+}
+DEFAULT_LIMITER = dict(rate=4.0, burst=4, concurrency=2, max_concurrency=8, slow_latency=5.0)
+
+
+class TokenBucket:
+    """令牌桶，平均每秒最多rate个请求，允许burst个突发"""
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(max(1, burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """不等待地取走一个令牌
+            :return: 0表示已取得令牌，否则为还需等待的秒数
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """取走一个令牌，没有令牌时等待
+            :return: 等待的秒数
+        """
+        waited = 0.0
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+
+class RequestSlot:
+    """一次受限请求，调用方在请求完成后设置outcome"""
+    def __init__(self):
+        self.outcome = OUTCOME_OK
+
+
+class AdaptiveLimiter:
+    """令牌桶限速 + AIMD并发控制，线程和协程下载引擎共用同一个实例
+        正常且延迟低于slow_latency的响应使并发上限每轮加1（加性增），
+        截断、错误页面或过慢的响应使并发上限减半（乘性减），每个slow_latency周期最多减一次
+    """
+    def __init__(self, rate, burst, concurrency, max_concurrency, slow_latency, min_concurrency=1):
+        self.bucket = TokenBucket(rate, burst)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = float(concurrency)
+        self.slow_latency = slow_latency
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+        self.waiters = []  # 等待空位的协程，释放名额时回调
+        self.requests = 0
+        self.failures = 0
+        self.decreases = 0
+        self.throttled_seconds = 0.0
+
+    def acquire(self):
+        """等待并发空位和令牌
+            :return: 请求开始时间
+        """
+        started = time.monotonic()
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+        self.bucket.acquire()
+        now = time.monotonic()
+        with self.cond:
+            self.throttled_seconds += now - started
+        return now
+
+    def try_enter(self, waiter):
+        """不等待地占用一个并发名额，供协程使用
+            :param waiter: 没有空位时登记的回调，下次释放名额时在释放的线程中调用一次
+            :return: 是否占用了名额
+        """
+        with self.cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            self.waiters.append(waiter)
+            return False
+
+    def release(self, started, outcome=OUTCOME_OK):
+        """请求完成，根据结果和延迟调整并发上限"""
+        now = time.monotonic()
+        latency = now - started
+        with self.cond:
+            self.in_flight -= 1
+            self.requests += 1
+            if outcome == OUTCOME_OK and latency < self.slow_latency:
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            elif outcome != OUTCOME_NEUTRAL:
+                if outcome != OUTCOME_OK:
+                    self.failures += 1
+                if now - self.last_decrease >= self.slow_latency:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self.last_decrease = now
+                    self.decreases += 1
+            self.cond.notify_all()
+            waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            waiter()
+
+    @contextmanager
+    def request(self):
+        """with limiter.request() as slot: ...; slot.outcome = OUTCOME_SHORT"""
+        slot = RequestSlot()
+        started = self.acquire()
+        try:
+            yield slot
+        except BaseException:
+            slot.outcome = OUTCOME_ERROR
+            raise
+        finally:
+            self.release(started, slot.outcome)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'failures': self.failures,
+                'decreases': self.decreases,
+                'throttled_seconds': round(self.throttled_seconds, 3),
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(url):
+    """按主机（含端口）获取共享的限速器"""
+    host = urlsplit(url).netloc
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = AdaptiveLimiter(**HOST_DEFAULTS.get(host, DEFAULT_LIMITER))
+            _limiters[host] = limiter
+        return limiter
+
+
+def configure_limiter(host, **kwargs):
+    """修改某个主机的限速参数，例如 configure_limiter('thesis.lib.sjtu.edu.cn:8443', rate=4)"""
+    params = dict(HOST_DEFAULTS.get(host, DEFAULT_LIMITER))
+    params.update(kwargs)
+    with _limiters_lock:
+        _limiters[host] = AdaptiveLimiter(**params)
+
+
+def limiter_stats():
+    """所有主机的限速统计"""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {host: limiter.stats() for host, limiter in limiters.items()}
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   resolver_cache.py
+@Description    :   阅读全文链接的解析缓存：保存三次重定向和jumpServlet得到的图片地址前缀和查询参数，
+                    重试、断点续传和重复运行时不再走完整的重定向链
+'''
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+RESOLVER_CACHE_PATH = "resolver_cache.sqlite3"
+DEFAULT_TTL = 24 * 3600   # 超过一天的解析结果不再使用
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS resolved_links (
+    link TEXT PRIMARY KEY,
+    image_base TEXT NOT NULL,
+    token TEXT NOT NULL,
+    resolved_at REAL NOT NULL
+);
+'''
+
+
+class ResolverCache:
+    """阅读全文链接 -> (图片地址前缀, 阅读器查询参数)，内存加磁盘（SQLite），线程安全
+    缓存不保证地址仍然有效，调用方使用前应校验（例如第1页是否存在），失效时调用invalidate
+        :param path: 磁盘缓存文件，为None时只使用内存
+    """
+    def __init__(self, path=RESOLVER_CACHE_PATH, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.memory = {}   # 链接 -> (图片地址前缀, 查询参数, 解析时间)
+        self.counts = defaultdict(int)
+        self.conn = None
+        if path is not None:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            with self.conn:
+                self.conn.executescript(SCHEMA)
+
+    def _expired(self, resolved_at, now):
+        return self.ttl is not None and now - resolved_at > self.ttl
+
+    def _delete(self, link):
+        self.memory.pop(link, None)
+        if self.conn is not None:
+            with self.conn:
+                self.conn.execute('DELETE FROM resolved_links WHERE link = ?', (link,))
+
+    def get(self, link):
+        """:return: (图片地址前缀, 查询参数)，未命中或已过期时返回None"""
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(link)
+            if entry is None and self.conn is not None:
+                row = self.conn.execute('SELECT image_base, token, resolved_at FROM resolved_links WHERE link = ?',
+                                        (link,)).fetchone()
+                if row is not None:
+                    entry = self.memory[link] = tuple(row)
+            if entry is not None and self._expired(entry[2], now):
+                self._delete(link)
+                self.counts['expired'] += 1
+                entry = None
+            if entry is None:
+                self.counts['misses'] += 1
+                return None
+            self.counts['hits'] += 1
+            return entry[0], entry[1]
+
+    def put(self, link, image_base, token):
+        now = time.time()
+        with self.lock:
+            self.memory[link] = (image_base, token, now)
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute('INSERT OR REPLACE INTO resolved_links (link, image_base, token, resolved_at) '
+                                      'VALUES (?, ?, ?, ?)', (link, image_base, token, now))
+
+    def invalidate(self, link):
+        """缓存的地址已失效，删除该链接的记录"""
+        with self.lock:
+            self._delete(link)
+            self.counts['invalidated'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute('DELETE FROM resolved_links')
+
+    def stats(self):
+        """:return: {'hits', 'misses', 'expired', 'invalidated'}"""
+        with self.lock:
+            return {key: self.counts[key] for key in ('hits', 'misses', 'expired', 'invalidated')}
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+def format_resolver_stats(stats):
+    """把解析缓存统计格式化为一行文字"""
+    return '命中{}次，未命中{}次，失效{}次'.format(stats['hits'], stats['misses'], stats['invalidated'])
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_resolver_cache(path=None):
+    """进程内共享的解析缓存，第一次调用时打开"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResolverCache(path or RESOLVER_CACHE_PATH)
+        return _cache
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   result_cache.py
+@Description    :   已解析检索结果页的缓存：进程内LRU加磁盘（SQLite），带过期时间和命中率统计
+'''
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from urllib.parse import urlsplit
+
+from catalog import query_params
+
+CACHE_PATH = "result_cache.sqlite3"
+DEFAULT_TTL = 24 * 3600          # 检索结果一天内视为有效
+DEFAULT_MEMORY_ENTRIES = 256     # 内存中最多缓存的页数
+DEFAULT_DISK_ENTRIES = 20000     # 磁盘上最多缓存的页数
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS result_pages (
+    cache_key TEXT PRIMARY KEY,
+    papers TEXT NOT NULL,
+    total_count INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_result_pages_accessed ON result_pages(accessed_at);
+'''
+
+
+def cache_key(info_url, page):
+    """(content, choose_key, xuewei, px, page) 组成的键，检索词去掉首尾空白"""
+    parts = urlsplit(info_url)
+    params = query_params(info_url)
+    return json.dumps([parts.netloc + parts.path, params['content'].strip(), params['choose_key'],
+                       params['xuewei'], params['px'], int(page)], ensure_ascii=False)
+
+
+def _copy_papers(papers):
+    return [defaultdict(str, paper) for paper in papers]
+
+
+class ResultPageCache:
+    """检索结果页缓存，先查内存LRU，再查磁盘，线程安全
+        :param path: 磁盘缓存文件，为None时只使用内存
+    """
+    def __init__(self, path=CACHE_PATH, ttl=DEFAULT_TTL, memory_entries=DEFAULT_MEMORY_ENTRIES,
+                 disk_entries=DEFAULT_DISK_ENTRIES):
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()   # 键 -> (论文列表, 总记录数, 抓取时间)
+        self.counts = defaultdict(int)
+        self.conn = None
+        if path is not None:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            with self.conn:
+                self.conn.executescript(SCHEMA)
+
+    def _expired(self, fetched_at, now):
+        return self.ttl is not None and now - fetched_at > self.ttl
+
+    def _remember(self, key, entry):
+        """放入内存LRU，超过容量时淘汰最久未使用的页"""
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+            self.counts['evictions'] += 1
+
+    def get(self, info_url, page):
+        """:return: (论文列表, 总记录数)，未命中或已过期时返回None"""
+        key = cache_key(info_url, page)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[2], now):
+                    self.memory.move_to_end(key)
+                    self.counts['hits'] += 1
+                    return _copy_papers(entry[0]), entry[1]
+                del self.memory[key]
+                self.counts['expired'] += 1
+            if self.conn is not None:
+                row = self.conn.execute('SELECT papers, total_count, fetched_at FROM result_pages WHERE cache_key = ?',
+                                        (key,)).fetchone()
+                if row is not None and not self._expired(row[2], now):
+                    entry = ([defaultdict(str, paper) for paper in json.loads(row[0])], row[1], row[2])
+                    with self.conn:
+                        self.conn.execute('UPDATE result_pages SET accessed_at = ? WHERE cache_key = ?', (now, key))
+                    self._remember(key, entry)
+                    self.counts['disk_hits'] += 1
+                    return _copy_papers(entry[0]), entry[1]
+                if row is not None:
+                    with self.conn:
+                        self.conn.execute('DELETE FROM result_pages WHERE cache_key = ?', (key,))
+                    self.counts['expired'] += 1
+            self.counts['misses'] += 1
+        return None
+
+    def contains(self, info_url, page):
+        """是否有未过期的缓存，不计入命中率"""
+        key = cache_key(info_url, page)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and not self._expired(entry[2], now):
+                return True
+            if self.conn is None:
+                return False
+            row = self.conn.execute('SELECT fetched_at FROM result_pages WHERE cache_key = ?', (key,)).fetchone()
+        return row is not None and not self._expired(row[0], now)
+
+    def fetched_at(self, info_url, page):
+        """该页未过期的缓存是什么时候从网站抓取的，没有缓存时返回None，不计入命中率"""
+        key = cache_key(info_url, page)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and not self._expired(entry[2], now):
+                return entry[2]
+            if self.conn is None:
+                return None
+            row = self.conn.execute('SELECT fetched_at FROM result_pages WHERE cache_key = ?', (key,)).fetchone()
+        return row[0] if row is not None and not self._expired(row[0], now) else None
+
+    def put(self, info_url, page, papers, total_count):
+        key = cache_key(info_url, page)
+        now = time.time()
+        entry = (_copy_papers(papers), total_count, now)
+        with self.lock:
+            self._remember(key, entry)
+            if self.conn is None:
+                return
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO result_pages (cache_key, papers, total_count, fetched_at, accessed_at) '
+                                  'VALUES (?, ?, ?, ?, ?)',
+                                  (key, json.dumps(papers, ensure_ascii=False), total_count, now, now))
+                # 超过容量时删除最久未访问的页
+                self.conn.execute('DELETE FROM result_pages WHERE cache_key IN (SELECT cache_key FROM result_pages '
+                                  'ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)', (self.disk_entries,))
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute('DELETE FROM result_pages')
+
+    def stats(self):
+        """:return: {'hits', 'disk_hits', 'misses', 'expired', 'evictions', 'hit_rate'}"""
+        with self.lock:
+            counts = {key: self.counts[key] for key in ('hits', 'disk_hits', 'misses', 'expired', 'evictions')}
+        lookups = counts['hits'] + counts['disk_hits'] + counts['misses']
+        counts['hit_rate'] = (counts['hits'] + counts['disk_hits']) / lookups if lookups else 0.0
+        return counts
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+def format_cache_stats(stats):
+    """把缓存统计格式化为一行文字"""
+    return '内存命中{}次，磁盘命中{}次，未命中{}次，命中率{:.0%}'.format(
+        stats['hits'], stats['disk_hits'], stats['misses'], stats['hit_rate'])
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache(path=None):
+    """进程内共享的检索结果缓存，第一次调用时打开"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultPageCache(path or CACHE_PATH)
+        return _cache
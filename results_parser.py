@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   results_parser.py
+@Description    :   sub.asp 检索结果页面的解析：定位一次结果表格，单次遍历所有行
+'''
+import re
+from collections import defaultdict
+from lxml import etree
+
+BASE_URL = "http://thesis.lib.sjtu.edu.cn/"
+PAGE_SIZE = 20  # 网站每页固定20条
+
+# 结果表格的位置，页面结构变化时退回到按内容查找
+_TABLE_XPATH = etree.XPath('/html/body/section/div/div[3]/div[2]/table')
+_FALLBACK_TABLE_XPATH = etree.XPath('//table[.//td/div/a[2]]')
+_ROWS_XPATH = etree.XPath('./tr | ./tbody/tr')
+# 只检查包含“条”字的文本节点，而不是拼接整个页面的文本
+_COUNT_TEXT_XPATH = etree.XPath("//text()[contains(., '条')]")
+_COUNT_PATTERNS = (re.compile(r'，共\s*(\d+)\s*条记录'), re.compile(r'共\s*(\d+)\s*条'))
+
+# 各字段所在的列（从0开始）；院系、专业、学位优先按表头文字确定
+DEFAULT_COLUMNS = {'filename': 1, 'author': 2, 'department': 3, 'subject': 4, 'mentor': 5,
+                   'degree': 6, 'year': 7, 'link': 8}
+HEADER_FIELDS = (('院系', 'department'), ('专业', 'subject'), ('学位', 'degree'))
+REQUIRED_FIELDS = ('filename', 'author', 'mentor', 'year', 'link')
+
+
+def _first_text(element):
+    """元素下第一个文本节点，相当于 xpath('text()')[0]"""
+    if element is None:
+        return None
+    if element.text is not None:
+        return element.text
+    for child in element:
+        if child.tail is not None:
+            return child.tail
+    return None
+
+
+def _div(cell):
+    """单元格中的div，直接按下标访问子元素，比find()快得多"""
+    if len(cell) and cell[0].tag == 'div':
+        return cell[0]
+    return None
+
+
+def _cell_text(cell):
+    """单元格文字：优先取div中的文字，与网站的结构一致"""
+    div = _div(cell)
+    text = _first_text(div) if div is not None else None
+    if text is None:
+        text = _first_text(cell)
+    return text
+
+
+def _cell_link(cell):
+    """“阅读全文”链接是操作列中的第二个a"""
+    div = _div(cell)
+    links = [child for child in (div if div is not None else cell) if child.tag == 'a']
+    if len(links) < 2 or not links[1].get('href'):
+        return None
+    return BASE_URL + links[1].get('href')
+
+
+def _header_columns(row):
+    """根据表头确定院系、专业、学位所在的列，其余字段使用固定的列"""
+    columns = dict(DEFAULT_COLUMNS)
+    cells = row.findall('td') or row.findall('th')
+    taken = set(index for field, index in DEFAULT_COLUMNS.items() if field in REQUIRED_FIELDS)
+    for index, cell in enumerate(cells):
+        if index in taken:
+            continue
+        text = ''.join(cell.itertext()).strip()
+        for label, field in HEADER_FIELDS:
+            if text.startswith(label):
+                columns[field] = index
+                break
+    return columns
+
+
+def find_results_table(html):
+    tables = _TABLE_XPATH(html)
+    if not tables:
+        tables = _FALLBACK_TABLE_XPATH(html)
+    return tables[0] if tables else None
+
+
+def parse_rows(table):
+    """单次遍历结果表格的所有行，返回论文列表"""
+    papers = []
+    rows = _ROWS_XPATH(table)
+    if not rows:
+        return papers
+    columns = _header_columns(rows[0])
+    width = max(columns.values()) + 1
+    fields = list(columns.items())
+    for row in rows[1:]:
+        cells = [cell for cell in row if cell.tag == 'td']
+        # 有些是论文保密，没有阅读链接，跳过
+        if len(cells) < width:
+            continue
+        info_dict = defaultdict(str)
+        for field, index in fields:
+            if field == 'link':
+                value = _cell_link(cells[index])
+            elif field == 'filename':
+                value = _first_text(cells[index])
+            else:
+                value = _cell_text(cells[index])
+            if value is not None:
+                info_dict[field] = value
+        if all(info_dict.get(field) for field in REQUIRED_FIELDS):
+            papers.append(info_dict)
+    return papers
+
+
+def parse_total_count(html):
+    """从包含“共 X 条记录”的文本节点中提取总记录数，找不到时返回0"""
+    texts = _COUNT_TEXT_XPATH(html)
+    for pattern in _COUNT_PATTERNS:
+        for text in texts:
+            match = pattern.search(text)
+            if match is None and text.getparent() is not None:
+                # 数字可能在单独的标签中，例如 共<b>123</b>条记录
+                match = pattern.search(''.join(text.getparent().itertext()))
+            if match:
+                return int(match.group(1))
+    return 0
+
+
+def parse_results(content):
+    """解析一页检索结果
+        :param content: 页面的原始字节
+        :return: (论文列表, 总记录数)
+    """
+    html = etree.HTML(content, etree.HTMLParser())
+    if html is None:
+        return [], 0
+    table = find_results_table(html)
+    papers = parse_rows(table) if table is not None else []
+    return papers, parse_total_count(html)
+
+
+def total_pages_for(total_count):
+    """每页20条，向上取整"""
+    return (total_count + PAGE_SIZE - 1) // PAGE_SIZE
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+@File    :   retry.py
+@Description    :   统一的重试策略：带随机抖动的指数退避、按错误类型区分的重试次数、每篇论文的失败预算
+'''
+import random
+import threading
+import time
+from collections import defaultdict
+
+import metrics
+
+# 错误类型
+RETRY_SHORT = 'short'            # 图片内容被截断
+RETRY_NOT_FOUND = 'not_found'    # 404页面，网站偶尔对存在的页面也返回404
+RETRY_CONNECTION = 'connection'  # 连接被重置、超时
+
+
+class RetryError(Exception):
+    """重试次数或失败预算用尽"""
+
+
+class RetryPolicy:
+    """指数退避：第n次重试前等待 [0, min(max_delay, base_delay * 2**n)] 之间的随机时间
+        :param max_retries: 最多重试次数
+    """
+    def __init__(self, max_retries, base_delay, max_delay, jitter=True):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(0, delay) if self.jitter else delay
+
+
+# 截断一般是网站过载，稍等即可；404要给网站足够的时间生成图片；连接错误退避更久
+POLICIES = {
+    RETRY_SHORT: RetryPolicy(max_retries=8, base_delay=0.5, max_delay=8),
+    RETRY_NOT_FOUND: RetryPolicy(max_retries=6, base_delay=1, max_delay=8),
+    RETRY_CONNECTION: RetryPolicy(max_retries=5, base_delay=1, max_delay=16),
+}
+
+# 每篇论文所有页面的重试总次数上限
+DEFAULT_FAILURE_BUDGET = 200
+
+
+class RetryBudget:
+    """每篇论文的失败预算，同时记录各类错误的重试次数，线程安全"""
+    def __init__(self, max_failures=DEFAULT_FAILURE_BUDGET):
+        self.max_failures = max_failures
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def spend(self, kind):
+        """记录一次重试，预算用尽时抛出RetryError"""
+        with self.lock:
+            self.counts[kind] += 1
+            total = sum(self.counts.values())
+        if self.max_failures is not None and total > self.max_failures:
+            raise RetryError("重试次数超过{}次，放弃该论文".format(self.max_failures))
+
+    @property
+    def total(self):
+        with self.lock:
+            return sum(self.counts.values())
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class RetryState:
+    """一次请求（例如一页图片）的重试状态"""
+    def __init__(self, budget=None, policies=POLICIES):
+        self.budget = budget
+        self.policies = policies
+        self.attempts = defaultdict(int)
+
+    def can_retry(self, kind):
+        return self.attempts[kind] < self.policies[kind].max_retries
+
+    def next_delay(self, kind):
+        """计入预算并返回本次重试前应等待的秒数，重试次数用尽时抛出RetryError
+            协程中使用 await asyncio.sleep(state.next_delay(kind))，不阻塞事件循环
+        """
+        if not self.can_retry(kind):
+            raise RetryError("{}类错误重试{}次后仍然失败".format(kind, self.attempts[kind]))
+        if self.budget is not None:
+            self.budget.spend(kind)
+        metrics.record_retry(kind)
+        delay = self.policies[kind].delay(self.attempts[kind])
+        metrics.record(metrics.STAGE_BACKOFF, delay)
+        self.attempts[kind] += 1
+        return delay
+
+    def backoff(self, kind):
+        """计入预算并等待退避时间，重试次数用尽时抛出RetryError"""
+        time.sleep(self.next_delay(kind))
+
+
+def call_with_retry(func, retry_on, kind=RETRY_CONNECTION, budget=None):
+    """调用func，遇到retry_on中的异常时按kind的策略退避重试"""
+    state = RetryState(budget)
+    while True:
+        try:
+            return func()
+        except retry_on:
+            if not state.can_retry(kind):
+                raise
+            state.backoff(kind)